@@ -0,0 +1 @@
+"""ベンチマーク（python -m benchmarks.pos_bench）"""
@@ -0,0 +1,404 @@
+"""
+POS決済のベンチマーク
+seeds/data.py のテンプレートから合成ユーザー（レシピ・ルール付き）を作り、
+execute_pos_payment を直接（inprocess）と ASGI アプリ経由（asgi）で指定並列数で叩いて、
+p50/p95/p99 レイテンシ・スループット・1決済あたりのクエリ数を JSON で保存する。
+
+使用例:
+    # SQLite（既定。一時ディレクトリに新しい app.db を作る）
+    python -m benchmarks.pos_bench --users 1000 --payments 5000 --concurrency 8
+    # ローカル MySQL コンテナ（空のDBを用意して DB_* で接続先を指定）
+    docker run -d --name irodori-bench-mysql -p 3306:3306 \\
+        -e MYSQL_ROOT_PASSWORD=bench -e MYSQL_DATABASE=irodori_bench mysql:8.0
+    DB_HOST=localhost DB_NAME=irodori_bench DB_USER=root DB_PASSWORD=bench \\
+        python -m benchmarks.pos_bench --mode both --out bench.json
+    # 前回の結果と比較
+    python -m benchmarks.pos_bench --compare bench.json
+
+ASGI 計測は POS ルーター（/pos, /pos/async）だけを載せたアプリで行う
+（main の起動処理・外部API初期化を含めないため）。
+既存データは消さないが、合成ユーザーとその取引を追加するため本番DBには向けないこと。
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+# 合成ユーザーに割り当てるレシピ数の範囲
+RECIPES_PER_USER = (1, 3)
+# カテゴリ無しの支払いの割合
+UNCATEGORIZED_RATIO = 0.3
+
+Payment = Tuple[int, int, Optional[str]]
+
+
+# ------------------------------------------------------------
+# クエリ数の計測
+# ------------------------------------------------------------
+class QueryCounter:
+    """エンジンに発行された SQL 文の数を数える"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def __call__(self, *args) -> None:
+        with self._lock:
+            self.count += 1
+
+    def reset(self) -> int:
+        with self._lock:
+            count, self.count = self.count, 0
+        return count
+
+
+# ------------------------------------------------------------
+# データ準備
+# ------------------------------------------------------------
+def use_integer_ids_on_sqlite() -> None:
+    """
+    使い捨ての SQLite では BIGINT の主キーが自動採番されないため、このプロセスで作るテーブルだけ INTEGER にする
+    （models のスキーマ定義は変えない）
+    """
+    from sqlalchemy import BigInteger
+    from sqlalchemy.ext.compiler import compiles
+
+    @compiles(BigInteger, "sqlite")
+    def _bigint_as_integer(type_, compiler, **kw):
+        return "INTEGER"
+
+
+def ensure_master_data(db) -> None:
+    """トリガー・アクション・テンプレートが無ければ seeds から投入する"""
+    from models import Trigger
+    from seeds.data import (
+        create_sample_users,
+        insert_sample_actions,
+        insert_sample_recipe_rule_relations,
+        insert_sample_recipe_templates,
+        insert_sample_rule_templates,
+        insert_sample_triggers,
+    )
+
+    if db.query(Trigger).first() is not None:
+        return
+    insert_sample_triggers(db)
+    insert_sample_actions(db)
+    create_sample_users(db)
+    db.commit()
+    insert_sample_rule_templates(db)
+    insert_sample_recipe_templates(db)
+    db.commit()
+    insert_sample_recipe_rule_relations(db)
+    db.commit()
+
+
+def create_synthetic_users(db, n_users: int, rng: random.Random) -> Tuple[List[int], List[str]]:
+    """
+    n_users 人の合成ユーザーを作り、公開レシピテンプレートを1〜3個ずつコピーする。
+    返り値: (ユーザーID一覧, テンプレートに登場するカテゴリ一覧)
+    """
+    from sqlalchemy import func, insert, select
+    from models import Recipe, RecipeRule, RecipeTemplate, Rule, User
+
+    templates = db.execute(select(RecipeTemplate).where(RecipeTemplate.is_public.is_(True))).scalars().all()
+    rule_sets = {t.id: list(t.rule_templates) for t in templates if t.rule_templates}
+    template_ids = sorted(rule_sets)
+    categories = sorted({
+        str(c)
+        for rules in rule_sets.values() for rt in rules
+        for key in ("categories", "mirror_categories")
+        for c in (rt.trigger_params or {}).get(key) or []
+    })
+
+    first_id = (db.execute(select(func.max(User.id))).scalar() or 0) + 1
+    run_tag = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+    user_ids = list(range(first_id, first_id + n_users))
+    db.execute(insert(User), [
+        {
+            "id": uid, "last_name": "bench", "first_name": str(uid),
+            "email": f"bench-{run_tag}-{uid}@example.com", "birthdate": date(1995, 1, 1),
+            "postal_code": "000-0000", "address": "-", "phone_number": "000",
+            "occupation": "-", "company_name": "-", "password_hash": "-",
+        }
+        for uid in user_ids
+    ])
+
+    recipe_id = (db.execute(select(func.max(Recipe.id))).scalar() or 0) + 1
+    rule_id = (db.execute(select(func.max(Rule.id))).scalar() or 0) + 1
+    recipes, rules, links = [], [], []
+    for uid in user_ids:
+        for tid in rng.sample(template_ids, rng.randint(*RECIPES_PER_USER)):
+            recipes.append({"id": recipe_id, "name": "bench", "description": "-", "template_id": tid, "user_id": uid})
+            for rt in rule_sets[tid]:
+                rules.append({
+                    "id": rule_id, "user_id": uid, "name": rt.name[:100], "description": "-",
+                    "category": rt.category, "template_id": rt.id,
+                    "trigger_id": rt.trigger_id, "trigger_params": rt.trigger_params,
+                    "action_id": rt.action_id, "action_params": rt.action_params,
+                })
+                links.append({"recipe_id": recipe_id, "rule_id": rule_id})
+                rule_id += 1
+            recipe_id += 1
+    db.execute(insert(Recipe), recipes)
+    db.execute(insert(Rule), rules)
+    db.execute(insert(RecipeRule), links)
+    db.commit()
+    return user_ids, categories
+
+
+def generate_payments(user_ids: List[int], categories: List[str], n: int, rng: random.Random) -> List[Payment]:
+    """金額は対数正規（中央値 約1,000円）、カテゴリはテンプレートに登場するものから選ぶ"""
+    payments = []
+    for _ in range(n):
+        amount = max(1, min(300_000, int(rng.lognormvariate(7.0, 1.0))))
+        category = None if not categories or rng.random() < UNCATEGORIZED_RATIO else rng.choice(categories)
+        payments.append((rng.choice(user_ids), amount, category))
+    return payments
+
+
+# ------------------------------------------------------------
+# 計測
+# ------------------------------------------------------------
+def summarize(name: str, latencies: List[float], errors: int, elapsed: float, queries: int, concurrency: int) -> Dict[str, Any]:
+    lat = np.asarray(latencies, dtype=np.float64) * 1000.0
+    done = len(latencies)
+    return {
+        "mode": name,
+        "concurrency": concurrency,
+        "payments": done,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 4),
+        "throughput_per_s": round(done / elapsed, 2) if elapsed > 0 else None,
+        "latency_ms": {
+            "p50": round(float(np.percentile(lat, 50)), 3) if done else None,
+            "p95": round(float(np.percentile(lat, 95)), 3) if done else None,
+            "p99": round(float(np.percentile(lat, 99)), 3) if done else None,
+            "mean": round(float(lat.mean()), 3) if done else None,
+            "max": round(float(lat.max()), 3) if done else None,
+        },
+        "queries_per_payment": round(queries / done, 3) if done else None,
+    }
+
+
+def run_inprocess(payments: List[Payment], concurrency: int, counter: QueryCounter) -> Dict[str, Any]:
+    """execute_pos_payment をスレッドプールから直接呼ぶ（1決済1セッション・1コミット）"""
+    from database import SessionLocal
+    from services.tanabota import execute_pos_payment
+
+    def one(payment: Payment) -> Optional[float]:
+        user_id, amount, category = payment
+        db = SessionLocal()
+        started = time.perf_counter()
+        try:
+            execute_pos_payment(db, user_id=user_id, amount_paid=amount, category=category)
+            db.commit()
+            return time.perf_counter() - started
+        except Exception:
+            db.rollback()
+            return None
+        finally:
+            db.close()
+
+    counter.reset()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, payments))
+    elapsed = time.perf_counter() - started
+    latencies = [r for r in results if r is not None]
+    return summarize("inprocess", latencies, len(results) - len(latencies), elapsed, counter.reset(), concurrency)
+
+
+def build_asgi_app():
+    from fastapi import FastAPI
+    from routers import pos, pos_async
+
+    app = FastAPI()
+    app.include_router(pos.router)
+    app.include_router(pos_async.router)
+    return app
+
+
+def run_asgi(payments: List[Payment], concurrency: int, counter: QueryCounter, path: str = "/pos/execute") -> Dict[str, Any]:
+    """ASGI アプリへ HTTP リクエストとして送る（ネットワークを介さない httpx.ASGITransport）"""
+    import httpx
+
+    app = build_asgi_app()
+
+    async def drive() -> Tuple[List[float], int, float]:
+        latencies: List[float] = []
+        errors = 0
+        queue: "asyncio.Queue[Payment]" = asyncio.Queue()
+        for p in payments:
+            queue.put_nowait(p)
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+            async def worker() -> None:
+                nonlocal errors
+                while True:
+                    try:
+                        user_id, amount, category = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    started = time.perf_counter()
+                    res = await client.post(path, json={"user_id": user_id, "amount": amount, "category": category})
+                    if res.status_code == 200:
+                        latencies.append(time.perf_counter() - started)
+                    else:
+                        errors += 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            return latencies, errors, time.perf_counter() - started
+
+    counter.reset()
+    latencies, errors, elapsed = asyncio.run(drive())
+    name = "asgi" if path == "/pos/execute" else "asgi_async"
+    return summarize(name, latencies, errors, elapsed, counter.reset(), concurrency)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, timeout=10
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+# ------------------------------------------------------------
+# 比較
+# ------------------------------------------------------------
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """モードごとに p50/p95/p99・スループット・クエリ数の変化率を並べる"""
+    lines = [f"baseline {baseline['meta'].get('git_commit')} → current {current['meta'].get('git_commit')}"]
+    base_runs = {r["mode"]: r for r in baseline["runs"]}
+    for run in current["runs"]:
+        base = base_runs.get(run["mode"])
+        if base is None:
+            continue
+        pairs = [(f"latency.{k}", run["latency_ms"][k], base["latency_ms"][k]) for k in ("p50", "p95", "p99")]
+        pairs += [("throughput", run["throughput_per_s"], base["throughput_per_s"])]
+        pairs += [("queries/payment", run["queries_per_payment"], base["queries_per_payment"])]
+        for label, now, before in pairs:
+            if now is None or not before:
+                continue
+            lines.append(f"  {run['mode']:<10} {label:<16} {before:>10} → {now:>10} ({(now - before) / before * 100:+.1f}%)")
+    return lines
+
+
+# ------------------------------------------------------------
+# エントリポイント
+# ------------------------------------------------------------
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="POS決済のベンチマーク")
+    parser.add_argument("--users", type=int, default=1000, help="合成ユーザー数")
+    parser.add_argument("--payments", type=int, default=5000, help="計測する決済数（モードごと）")
+    parser.add_argument("--warmup", type=int, default=200, help="計測前に流す決済数（ルールプランキャッシュを温める）")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時実行数")
+    parser.add_argument("--mode", choices=["inprocess", "asgi", "asgi_async", "both", "all"], default="both",
+                        help="both = inprocess + asgi、all は非同期版エンドポイントも含む")
+    parser.add_argument("--seed", type=int, default=42, help="合成データ・支払い列の乱数シード")
+    parser.add_argument("--workdir", default=None,
+                        help="SQLite の app.db を置くディレクトリ（省略時は一時ディレクトリ。DB_* 指定時は無関係）")
+    parser.add_argument("--out", default=None, help="結果JSONの保存先")
+    parser.add_argument("--compare", default=None, help="比較対象の結果JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    args = parse_args(argv)
+    out_path = os.path.abspath(args.out) if args.out else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    # SQLite は相対パス（./app.db）のため、アプリのモジュールを読み込む前に作業ディレクトリを移す
+    if not os.getenv("DB_HOST"):
+        os.chdir(args.workdir or tempfile.mkdtemp(prefix="pos-bench-"))
+        use_integer_ids_on_sqlite()
+
+    from sqlalchemy import event
+    from database import SessionLocal, engine
+    import models  # noqa: F401  テーブル作成
+    from services.schema_upgrade import upgrade_schema
+
+    upgrade_schema()
+
+    rng = random.Random(args.seed)
+    db = SessionLocal()
+    try:
+        ensure_master_data(db)
+        setup_started = time.perf_counter()
+        user_ids, categories = create_synthetic_users(db, args.users, rng)
+        setup_s = time.perf_counter() - setup_started
+    finally:
+        db.close()
+
+    counter = QueryCounter()
+    event.listen(engine, "before_cursor_execute", counter)
+
+    modes = {
+        "both": ["inprocess", "asgi"],
+        "all": ["inprocess", "asgi", "asgi_async"],
+    }.get(args.mode, [args.mode])
+    if "asgi_async" in modes:
+        from database import get_async_engine
+        event.listen(get_async_engine().sync_engine, "before_cursor_execute", counter)
+    runners: Dict[str, Callable[[List[Payment]], Dict[str, Any]]] = {
+        "inprocess": lambda ps: run_inprocess(ps, args.concurrency, counter),
+        "asgi": lambda ps: run_asgi(ps, args.concurrency, counter),
+        "asgi_async": lambda ps: run_asgi(ps, args.concurrency, counter, path="/pos/async/execute"),
+    }
+
+    runs = []
+    for mode in modes:
+        if args.warmup:
+            runners[mode](generate_payments(user_ids, categories, args.warmup, rng))
+        runs.append(runners[mode](generate_payments(user_ids, categories, args.payments, rng)))
+
+    report = {
+        "meta": {
+            "git_commit": git_commit(),
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "dialect": engine.dialect.name,
+            "users": args.users,
+            "categories": len(categories),
+            "seed": args.seed,
+            "warmup": args.warmup,
+            "setup_s": round(setup_s, 3),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "runs": runs,
+    }
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if compare_path:
+        with open(compare_path, encoding="utf-8") as f:
+            print("\n".join(compare(report, json.load(f))))
+    if out_path:
+        with open(out_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
+import ssl
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -47,4 +50,50 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+# ------------------------------------------------------------
+# 非同期エンジン（aiomysql / aiosqlite）
+# 同期側と同じ接続先を使う。ドライバ未導入の環境でも同期APIは動くよう、初回利用時に生成する
+# ------------------------------------------------------------
+ASYNC_DB_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", "20"))
+ASYNC_DB_MAX_OVERFLOW = int(os.getenv("ASYNC_DB_MAX_OVERFLOW", "40"))
+
+def get_async_database_url():
+    url = make_url(SQLALCHEMY_DATABASE_URL)
+    if url.drivername.startswith("mysql"):
+        # SSL 設定はクエリ文字列ではなく connect_args で渡す
+        return url.set(drivername="mysql+aiomysql", query={})
+    return url.set(drivername="sqlite+aiosqlite")
+
+def _async_engine_kwargs():
+    url = make_url(SQLALCHEMY_DATABASE_URL)
+    if not url.drivername.startswith("mysql"):
+        return {}
+    kwargs = {"pool_size": ASYNC_DB_POOL_SIZE, "max_overflow": ASYNC_DB_MAX_OVERFLOW, "pool_pre_ping": True}
+    ssl_ca = url.query.get("ssl_ca")
+    if ssl_ca:
+        # 証明書・ホスト名とも検証する（同期側の ssl_verify_cert / ssl_verify_identity 相当）
+        kwargs["connect_args"] = {"ssl": ssl.create_default_context(cafile=ssl_ca)}
+    return kwargs
+
+_async_engine = None
+AsyncSessionLocal = async_sessionmaker(class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+def get_async_engine() -> AsyncEngine:
+    global _async_engine
+    if _async_engine is None:
+        _async_engine = create_async_engine(get_async_database_url(), **_async_engine_kwargs())
+        AsyncSessionLocal.configure(bind=_async_engine)
+    return _async_engine
+
+async def get_async_db():
+    get_async_engine()
+    async with AsyncSessionLocal() as db:
+        yield db
+
+async def dispose_async_engine():
+    global _async_engine
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
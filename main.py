@@ -7,9 +7,12 @@ from openai import OpenAI
 from dotenv import load_dotenv
 from starlette.middleware.sessions import SessionMiddleware
 from fastapi.middleware.cors import CORSMiddleware
-from routers import auth, onboarding, pos
+from routers import auth, onboarding, pos, pos_async
 from sqlalchemy.orm import Session
-from database import SessionLocal
+from database import SessionLocal, dispose_async_engine
+from services.audit_log_writer import audit_log_writer
+from services.scheduler import scheduled_trigger_engine
+from services.schema_upgrade import upgrade_schema
 from routers.talk import router as talk_router
 
 load_dotenv()
@@ -40,9 +43,18 @@ app.include_router(onboarding.router)
 
 app.include_router(pos.router)
 
+app.include_router(pos_async.router)
+
 @app.on_event("startup")
 async def startup_event():
     """アプリケーション起動時のデモデータシード処理"""
+
+    # 既存DBへ後から追加したインデックス・列を足す（スピル復旧・決済より前に済ませる）
+    upgrade_schema()
+    # 監査ログ write-behind（有効時のみ。前回の未反映分をスピルから復旧してから起動）
+    audit_log_writer.start()
+    # 時刻トリガーのスケジューラ（有効時のみ。ルールの読み込みはバックグラウンドで行う）
+    scheduled_trigger_engine.start()
     
     # SEED_DEMO_DATAがtrueの場合のみ実行
     should_seed = os.getenv("SEED_DEMO_DATA", "false").lower() in ["true", "1", "yes"]
@@ -68,6 +80,13 @@ async def startup_event():
         except Exception as e:
             print(f"❌ デモデータのシード処理でエラーが発生しました: {e}")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """スケジューラを止め、監査ログのキューを書き切り、非同期DBエンジンの接続プールを閉じる"""
+    scheduled_trigger_engine.stop()
+    audit_log_writer.stop()
+    await dispose_async_engine()
+
 def has_existing_data():
     """既存データの存在チェック"""
     try:
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Date, DateTime, ForeignKey, Boolean, JSON, Enum, BigInteger, Numeric, UniqueConstraint 
+from sqlalchemy import Column, Integer, String, Date, DateTime, ForeignKey, Boolean, JSON, Enum, BigInteger, Numeric, UniqueConstraint, Index, LargeBinary
 from sqlalchemy.orm import relationship
 from datetime import datetime, timezone
 from database import Base, engine
@@ -149,13 +149,24 @@ class Recipe(Base):
 
 # ==== ここから たなぼた 取引・ログ テーブル（B版：FKのみ追加、整数・成功時のみ） ====
 
+# 取引ヘッダの種別（event_kind）。支払い履歴として読むのは決済（payment）だけ
+EVENT_KIND_PAYMENT = "payment"
+EVENT_KIND_INCOME = "income"      # 入金（給与・賞与など。amount_paid は 0）
+EVENT_KIND_SCHEDULE = "schedule"  # 時刻トリガーの発火（毎週・月末・特定時刻など。amount_paid は 0）
+EVENT_KINDS = (EVENT_KIND_PAYMENT, EVENT_KIND_INCOME, EVENT_KIND_SCHEDULE)
+
 class TanabotaTransaction(Base):
     __tablename__ = "tanabota_transactions"
+    __table_args__ = (
+        # ユーザー別の一覧（user_id 絞り込み + id 降順のキーセットページング）用
+        Index("ix_tanabota_transactions_user_id_id", "user_id", "id"),
+    )
 
     id = Column(BigInteger, primary_key=True, autoincrement=True)
-    user_id = Column(Integer, ForeignKey("users.id", onupdate="RESTRICT", ondelete="RESTRICT"), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", onupdate="RESTRICT", ondelete="RESTRICT"), nullable=False)
     amount_paid = Column(Numeric(12, 0), nullable=False)         # 円のみ（小数なし）
     tanabota_total = Column(Numeric(12, 0), nullable=False, default=0)  # 円のみ（小数なし）
+    event_kind = Column(String(16), nullable=False, default=EVENT_KIND_PAYMENT, server_default=EVENT_KIND_PAYMENT)
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
 
     # 1取引 : 多ログ（DBのON DELETE CASCADEを使うためpassive_deletes=True）
@@ -174,7 +185,9 @@ class TanabotaActionLog(Base):
     action_id = Column(Integer, ForeignKey("actions.id", onupdate="RESTRICT", ondelete="RESTRICT"), nullable=False, index=True)
 
     action_type = Column(String(64), nullable=False)         # 例: 'save_percentage' / 'roundup' / 'fixed'
-    action_params_json = Column(JSON, nullable=False)        # 実行時スナップショット
+    # 実行時スナップショット（action_param_snapshots を参照。旧形式の行は action_params_json に直接持つ）
+    action_params_id = Column(BigInteger, ForeignKey("action_param_snapshots.id", onupdate="RESTRICT", ondelete="RESTRICT"), nullable=True)
+    action_params_json = Column(JSON, nullable=True)
     tanabota_amount = Column(Numeric(12, 0), nullable=False) # 円のみ（小数なし）
     result_json = Column(JSON, nullable=True)                # 外部連携レス等（任意）
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
@@ -183,8 +196,80 @@ class TanabotaActionLog(Base):
     transaction = relationship("TanabotaTransaction", back_populates="action_logs")
     rule = relationship("Rule")     # 参照のみ
     action = relationship("Action") # 参照のみ
+    action_params_snapshot = relationship("ActionParamSnapshot")  # 参照のみ
+
+    @property
+    def action_params(self):
+        """実行時のアクションパラメータ（スナップショット参照・旧形式のどちらでも同じ形）"""
+        if self.action_params_json is not None or self.action_params_id is None:
+            return self.action_params_json
+        return self.action_params_snapshot.params_json
+
+# ログが参照するアクションパラメータのスナップショット（内容のハッシュで一意。同じパラメータは1行だけ）
+# 書き込みは services.action_param_snapshots 経由（追記のみ。更新・削除はしない）
+class ActionParamSnapshot(Base):
+    __tablename__ = "action_param_snapshots"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    params_hash = Column(String(64), nullable=False, unique=True)  # 正規化JSONの SHA-256
+    params_json = Column(JSON, nullable=False)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+# 保存期間を過ぎたログの退避先（取引1件につき1行。ログ行のJSON配列を zlib 圧縮して保持）
+# 取引ヘッダはホットテーブルに残すため、明細の読み出しはログが無ければこちらを見る
+class TanabotaActionLogArchive(Base):
+    __tablename__ = "tanabota_action_log_archive"
+
+    transaction_id = Column(BigInteger, ForeignKey("tanabota_transactions.id", onupdate="RESTRICT", ondelete="CASCADE"), primary_key=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    log_count = Column(Integer, nullable=False)
+    tanabota_amount = Column(Numeric(12, 0), nullable=False)  # 円のみ（小数なし）
+    payload = Column(LargeBinary, nullable=False)              # zlib(JSON配列)
+    archived_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+# POS決済の冪等キー（リトライ時に同じ応答を返すための保存先）
+class PosIdempotencyKey(Base):
+    __tablename__ = "pos_idempotency_keys"
+
+    idempotency_key = Column(String(255), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", onupdate="RESTRICT", ondelete="RESTRICT"), nullable=False, index=True)
+    request_hash = Column(String(64), nullable=False)        # リクエスト内容の指紋（同じキーの使い回し検出）
+    transaction_id = Column(BigInteger, ForeignKey("tanabota_transactions.id", onupdate="RESTRICT", ondelete="CASCADE"), nullable=False)
+    response_json = Column(JSON, nullable=False)             # 初回の応答ボディ
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+
+# 支出カテゴリの最大長（POS APIの入力検証と user_spend_counters.category の長さを揃える）
+SPEND_CATEGORY_MAX_LENGTH = 64
+
+# ユーザー別の支出カウンタ（決済のたびに加算。ゼロ日・レベルアップ判定用）
+# period は "YYYY-MM-DD"（日次）または "total"（累計）。category "*" は全カテゴリ合計
+class UserSpendCounter(Base):
+    __tablename__ = "user_spend_counters"
+
+    user_id = Column(Integer, ForeignKey("users.id", onupdate="RESTRICT", ondelete="CASCADE"), primary_key=True)
+    period = Column(String(10), primary_key=True)
+    category = Column(String(SPEND_CATEGORY_MAX_LENGTH), primary_key=True)
+    spend_amount = Column(Numeric(14, 0), nullable=False, default=0)     # 円のみ（小数なし）
+    spend_count = Column(Integer, nullable=False, default=0)
+    tanabota_amount = Column(Numeric(14, 0), nullable=False, default=0)  # 円のみ（小数なし）
+    updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+
+# ユーザー別・月別のたなぼた集計（決済のたびに加算。ダッシュボードはログを集計せずこれを読む）
+# period は "YYYY-MM"（月次）または "total"（累計）
+# dimension は "all"（全体。dimension_key "*"）/ "rule"（key = rule_id）/ "action_type"（key = action_type）
+class UserSavingsRollup(Base):
+    __tablename__ = "user_savings_rollups"
+
+    user_id = Column(Integer, ForeignKey("users.id", onupdate="RESTRICT", ondelete="CASCADE"), primary_key=True)
+    period = Column(String(7), primary_key=True)
+    dimension = Column(String(16), primary_key=True)
+    dimension_key = Column(String(64), primary_key=True)
+    tanabota_amount = Column(Numeric(14, 0), nullable=False, default=0)  # 円のみ（小数なし）
+    execution_count = Column(Integer, nullable=False, default=0)         # 記録されたログ件数
+    transaction_count = Column(Integer, nullable=False, default=0)       # そのキーのログを含む決済数（入金などは数えない）
+    updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
 
 # ==== ここまで たなぼた 取引・ログ テーブル ====
 
 
-Base.metadata.create_all(bind=engine)
\ No newline at end of file
+Base.metadata.create_all(bind=engine)
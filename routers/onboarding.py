@@ -5,14 +5,19 @@ from schemas import (
     PreferenceCreate, Preference, FinancialReport,
     RecipeWithUserAndRulesWithTriggerAndAction,
     RecipeTemplateWithUserAndRuleTemplatesWithTriggerAndAction,
-    RecipeCreate, UserNicknameSet, UserResponse
+    RecipeCreate, UserNicknameSet, UserResponse,
+    SimulationRequest, RecipeTemplateSimulation
 )
-from typing import List
+from typing import List, Optional
 from datetime import datetime
 from services.service_factory import ServiceFactory
 from services.preference_service import PreferenceService
 from services.recipe_service import RecipeService
 from services.user_service import UserService
+from services.simulator import (
+    DEFAULT_LOOKBACK_DAYS, public_recipe_template_ids, simulate_recipe_templates
+)
+from services.vectorized_engine import PaymentArrays
 from pydantic import BaseModel
 from constants import DEMO_FINANCIAL_PROVIDERS, FINANCIAL_PROVIDER_QUESTION
 
@@ -222,3 +227,66 @@ def get_recipes(user_id: int = Query(..., description="ユーザーID", ge=1), d
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"レシピの取得に失敗しました: {str(e)}")
+
+@router.get(
+    "/recipe_templates/simulate",
+    response_model=List[RecipeTemplateSimulation],
+    summary="複数のレシピテンプレートをユーザーの過去の支払い履歴で試算（保存はしない）",
+)
+def simulate_recipe_templates_for_user(
+    user_id: int = Query(..., description="ユーザーID", ge=1),
+    template_ids: Optional[List[int]] = Query(None, description="レシピテンプレートID（未指定なら公開テンプレート全件）"),
+    days: int = Query(DEFAULT_LOOKBACK_DAYS, description="遡る日数", ge=1, le=3660),
+    seed: Optional[int] = Query(None, description="乱数シード"),
+    db_session: Session = Depends(get_db),
+):
+    """レシピテンプレートをコピーした場合のたなぼた額を、過去の支払い履歴から試算"""
+    try:
+        ids = template_ids or public_recipe_template_ids(db_session)
+        return simulate_recipe_templates(db_session, ids, user_id=user_id, days=days, seed=seed)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"シミュレーションに失敗しました: {str(e)}")
+
+@router.get(
+    "/recipe_templates/{template_id}/simulate",
+    response_model=RecipeTemplateSimulation,
+    summary="レシピテンプレートをユーザーの過去の支払い履歴で試算（保存はしない）",
+)
+def simulate_recipe_template(
+    template_id: int,
+    user_id: int = Query(..., description="ユーザーID", ge=1),
+    days: int = Query(DEFAULT_LOOKBACK_DAYS, description="遡る日数", ge=1, le=3660),
+    seed: Optional[int] = Query(None, description="乱数シード"),
+    db_session: Session = Depends(get_db),
+):
+    """レシピテンプレートをコピーした場合のたなぼた額を、過去の支払い履歴から試算"""
+    try:
+        return simulate_recipe_templates(db_session, [template_id], user_id=user_id, days=days, seed=seed)[0]
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"シミュレーションに失敗しました: {str(e)}")
+
+@router.post(
+    "/recipe_templates/{template_id}/simulate",
+    response_model=RecipeTemplateSimulation,
+    summary="レシピテンプレートを任意の支払いストリームで試算（保存はしない）",
+)
+def simulate_recipe_template_with_payments(
+    template_id: int,
+    request_data: SimulationRequest,
+    db_session: Session = Depends(get_db),
+):
+    """渡された支払いストリーム（金額・カテゴリ）に対してレシピテンプレートを試算"""
+    try:
+        payments = PaymentArrays(
+            [p.amount_paid for p in request_data.payments],
+            [p.category for p in request_data.payments],
+        )
+        return simulate_recipe_templates(db_session, [template_id], payments=payments, seed=request_data.seed)[0]
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"シミュレーションに失敗しました: {str(e)}")
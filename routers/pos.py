@@ -1,16 +1,67 @@
 # routers/pos.py  —— 認可ヘッダなし（デモ用）
 from __future__ import annotations
 
-from typing import List, Optional
+from datetime import date
+from typing import Any, Dict, List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field, conint
 from sqlalchemy.orm import Session
 from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 
 from database import SessionLocal
-from models import User, TanabotaTransaction, TanabotaActionLog
-from services.tanabota import execute_pos_payment
+from models import (
+    EVENT_KIND_PAYMENT,
+    EVENT_KINDS,
+    SPEND_CATEGORY_MAX_LENGTH,
+    Rule,
+    TanabotaTransaction,
+    TanabotaActionLog,
+    User,
+    UserSavingsRollup,
+    UserSpendCounter,
+)
+from services.action_log_archive import archived_logs, missing_log_ids
+from services.action_param_snapshots import action_param_snapshots
+from services.audit_log_writer import audit_log_writer
+from services.idempotency import (
+    IdempotencyConflict,
+    IdempotencyInProgress,
+    check_fingerprint,
+    idempotency_cache,
+    load_stored_response,
+    request_fingerprint,
+    save_response,
+)
+from services.pos_metrics import STAGE_COMMIT, pos_metrics, stage
+from services.rng import request_rng
+from services.rule_plan_cache import rule_plan_cache
+from services.savings_rollup import DIMENSION_ACTION_TYPE, DIMENSION_ALL, DIMENSION_RULE
+from services.scheduler import scheduled_trigger_engine
+from services.transaction_export import MEDIA_TYPES, stream_transactions
+from services.user_locks import UserLockTimeout, user_groups, user_locks
+from services.spend_counters import ALL_CATEGORIES, PERIOD_TOTAL, business_day, period_of
+from services.tanabota import (
+    PaymentExplanation,
+    PaymentResult,
+    UserNotFoundError,
+    execute_income,
+    execute_incomes_batch,
+    execute_pos_payment,
+    execute_pos_payments_batch,
+    explain_pos_payment,
+    log_rows,
+)
+
+# 一括実行の最大件数
+MAX_BATCH_SIZE = 1000
+# ids 指定で一度に取得できる取引の最大件数
+MAX_LOOKUP_IDS = 200
+# 一覧・エクスポートの event_kind に "all" を渡すと入金などの記録も含める（既定は決済だけ）
+EVENT_KIND_ALL = "all"
+EVENT_KIND_PATTERN = f"^({'|'.join(EVENT_KINDS + (EVENT_KIND_ALL,))})$"
 
 router = APIRouter(prefix="/pos", tags=["POS"])
 
@@ -27,7 +78,9 @@ class ExecuteRequest(BaseModel):
     user_id: int = Field(..., ge=1)
     amount: conint(ge=0, le=999_999_999_999)
     # 追加: カテゴリを任意指定（カテゴリ依存トリガー用）
-    category: Optional[str] = Field(None, description="支出カテゴリ（例: 'コンビニ', 'エンタメ', '推し活' など）")
+    category: Optional[str] = Field(
+        None, max_length=SPEND_CATEGORY_MAX_LENGTH, description="支出カテゴリ（例: 'コンビニ', 'エンタメ', '推し活' など）"
+    )
 
 class ExecutionItem(BaseModel):
     rule_id: int
@@ -41,96 +94,690 @@ class ExecuteResponse(BaseModel):
     tanabota_total: int
     executions: List[ExecutionItem]
 
+class ExecuteBatchRequest(BaseModel):
+    items: List[ExecuteRequest] = Field(..., min_length=1, max_length=MAX_BATCH_SIZE)
+
+class BatchItemResult(BaseModel):
+    index: int  # items 内の位置
+    ok: bool
+    result: Optional[ExecuteResponse] = None
+    error: Optional[str] = None
+
+class ExecuteBatchResponse(BaseModel):
+    succeeded: int
+    failed: int
+    results: List[BatchItemResult]
+
+class IncomeRequest(BaseModel):
+    user_id: int = Field(..., ge=1)
+    amount: conint(ge=1, le=999_999_999_999)
+    description: Optional[str] = Field(None, max_length=200, description="入金の摘要（例: '給与 10月分'。キーワード判定に使う）")
+
+class IncomeResponse(BaseModel):
+    transaction_id: Optional[int] = None  # 一致ルールが無ければ取引は作らない
+    amount_received: int
+    tanabota_total: int
+    executions: List[ExecutionItem]
+
+class IncomeBatchRequest(BaseModel):
+    items: List[IncomeRequest] = Field(..., min_length=1, max_length=MAX_BATCH_SIZE)
+
+class IncomeBatchItemResult(BaseModel):
+    index: int  # items 内の位置
+    ok: bool
+    result: Optional[IncomeResponse] = None
+    error: Optional[str] = None
+
+class IncomeBatchResponse(BaseModel):
+    succeeded: int
+    failed: int
+    results: List[IncomeBatchItemResult]
+
+class SpendCounterItem(BaseModel):
+    category: Optional[str] = None  # None は全カテゴリ合計
+    spend_amount: int
+    spend_count: int
+    tanabota_amount: int
+
+class SpendCountersResponse(BaseModel):
+    user_id: int
+    day: date
+    daily: List[SpendCounterItem]       # 指定日の支出（カテゴリ別）
+    cumulative: List[SpendCounterItem]  # 累計（カテゴリ別）
+
+class SummaryRuleItem(BaseModel):
+    rule_id: int
+    rule_name: Optional[str] = None
+    tanabota_amount: int
+    execution_count: int
+    transaction_count: int
+
+class SummaryActionTypeItem(BaseModel):
+    action_type: str
+    tanabota_amount: int
+    execution_count: int
+    transaction_count: int
+
+class SummaryPeriod(BaseModel):
+    period: str                   # "YYYY-MM"（月次）または "total"（累計）
+    tanabota_amount: int
+    execution_count: int
+    transaction_count: int        # ログが1件以上ある決済の数（入金などの記録は数えない）
+    by_rule: List[SummaryRuleItem]
+    by_action_type: List[SummaryActionTypeItem]
+
+class SummaryResponse(BaseModel):
+    user_id: int
+    granularity: str
+    periods: List[SummaryPeriod]  # 古い月から順
+
+class RuleVerdictItem(BaseModel):
+    rule_id: int
+    action_id: int
+    trigger_id: int
+    trigger_name: str
+    event: Optional[str] = None
+    # "payment"（通常）/ "counter"（支出カウンタ）/ "demo_fallback"（デモ用フォールバック）/ None（支払いでは評価しない）
+    phase: Optional[str] = None
+    matched: Optional[bool] = None          # トリガ判定（評価しなかった場合は None）
+    computed_amount: Optional[int] = None   # 算出したたなぼた額（0円以下は記録されない）
+    fired: bool                             # この決済で明細になるか
+    forced_category: Optional[str] = None   # フォールバックで補完したカテゴリ
+    action_type: str
+    trigger_params: Dict[str, Any]
+    action_params: Dict[str, Any]
+
+class ExplainResponse(BaseModel):
+    user_id: int
+    amount_paid: int
+    category: Optional[str] = None
+    tanabota_total: int
+    executions: List[ExecutionItem]
+    demo_fallback_applied: bool
+    counters_loaded: bool                   # 支出カウンタ系ルールのために当日のカウンタを読んだか
+    rules: List[RuleVerdictItem]
+
 class TxSummary(BaseModel):
     id: int
     user_id: int
     amount_paid: int
     tanabota_total: int
+    event_kind: str = EVENT_KIND_PAYMENT   # payment（決済）/ income（入金）/ schedule（時刻トリガー）。決済以外は amount_paid 0
 
 class TxDetail(TxSummary):
     executions: List[ExecutionItem] = []
 
 # ======= Core API =======
-@router.post("/execute", response_model=ExecuteResponse, summary="POS決済の処理（日本円・整数）")
-def execute(request: ExecuteRequest, db: Session = Depends(get_db)):
-    user = db.get(User, request.user_id)
-    if not user:
+def to_execution_items(outcome: PaymentResult) -> List[ExecutionItem]:
+    return [
+        ExecutionItem(
+            rule_id=e["rule_id"],
+            action_id=e["action_id"],
+            action_type=e["action_type"],
+            tanabota_amount=int(e["tanabota_amount"]),
+        ) for e in outcome.executions
+    ]
+
+def to_execute_response(outcome: PaymentResult) -> ExecuteResponse:
+    return ExecuteResponse(
+        transaction_id=outcome.transaction_id,
+        amount_paid=outcome.amount_paid,
+        tanabota_total=outcome.tanabota_total,
+        executions=to_execution_items(outcome),
+    )
+
+def _execute_payment(
+    request: ExecuteRequest,
+    db: Session,
+    idempotency_key: Optional[str] = None,
+    fingerprint: str = "",
+    response: Optional[Response] = None,
+) -> ExecuteResponse:
+    try:
+        # 同じユーザーの決済は評価〜コミットを1件ずつ（別ユーザーは並列）
+        with pos_metrics.collect("execute", response), user_locks.hold(request.user_id):
+            # ユーザー存在確認はルールプラン（キャッシュ）で兼ねる
+            outcome = execute_pos_payment(
+                db,
+                user_id=request.user_id,
+                amount_paid=int(request.amount),
+                category=request.category,  # ← 追加
+                defer_logs=audit_log_writer.enabled,
+                # 決定的モードでは冪等キー（無ければリクエスト内容）から乱数を作る
+                rng=request_rng(request.user_id, int(request.amount), request.category, key=idempotency_key),
+            )
+            result = to_execute_response(outcome)
+            if idempotency_key is not None:
+                # 冪等キーも取引と同じトランザクションで保存する
+                save_response(
+                    db,
+                    idempotency_key,
+                    user_id=request.user_id,
+                    fingerprint=fingerprint,
+                    transaction_id=result.transaction_id,
+                    response=result.model_dump(),
+                )
+            with stage(STAGE_COMMIT):
+                db.commit()
+    except UserNotFoundError:
+        db.rollback()
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="user not found")
+    except UserLockTimeout as e:
+        db.rollback()
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"internal error: {e}")
+
+    if audit_log_writer.enabled:
+        # ヘッダのコミット後に監査ログを書き込みキューへ
+        audit_log_writer.submit(log_rows(outcome))
+    return result
 
+def _replay(stored, fingerprint: str, response: Response) -> ExecuteResponse:
     try:
-        tx, logs = execute_pos_payment(
+        body = check_fingerprint(stored, fingerprint)
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+    response.headers["Idempotent-Replayed"] = "true"
+    return ExecuteResponse(**body)
+
+@router.post("/execute", response_model=ExecuteResponse, summary="POS決済の処理（日本円・整数）")
+def execute(
+    request: ExecuteRequest,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", min_length=1, max_length=255),
+    db: Session = Depends(get_db),
+):
+    if idempotency_key is None:
+        return _execute_payment(request, db, response=response)
+
+    # 同じキーのリトライは保存済みの応答を返す（ルール評価・書き込みなし）
+    fingerprint = request_fingerprint(request.user_id, int(request.amount), request.category)
+    try:
+        stored = idempotency_cache.acquire(idempotency_key)
+    except IdempotencyInProgress:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="request with this Idempotency-Key is in progress")
+    if stored is not None:
+        return _replay(stored, fingerprint, response)
+
+    # 実行権を取得済み。プロセス内に無ければDBを確認してから実行する
+    try:
+        stored = load_stored_response(db, idempotency_key)
+        if stored is not None:
+            return _replay(stored, fingerprint, response)
+        try:
+            result = _execute_payment(request, db, idempotency_key, fingerprint, response)
+        except HTTPException as e:
+            # 別ワーカーが同じキーを先にコミットした（主キー重複）→ そちらの応答を返す
+            if not isinstance(e.__context__, IntegrityError):
+                raise
+            stored = load_stored_response(db, idempotency_key)
+            if stored is None:
+                raise
+            return _replay(stored, fingerprint, response)
+        stored = (fingerprint, result.model_dump())
+        return result
+    finally:
+        idempotency_cache.release(idempotency_key, stored)
+
+def _to_batch_item(idx: int, outcome: PaymentResult) -> BatchItemResult:
+    if outcome.error is not None:
+        return BatchItemResult(index=idx, ok=False, error=outcome.error)
+    return BatchItemResult(index=idx, ok=True, result=to_execute_response(outcome))
+
+def _run_in_user_groups(db: Session, rows: List[tuple], run, failed) -> List[PaymentResult]:
+    """
+    一括処理をユーザーの小グループ（ID順）ごとに ロック → 実行 → コミット する。
+    ロックはそのグループのユーザー分だけ・そのトランザクションの間だけ持つ。
+    グループ単位の失敗（ロック待ちタイムアウト等）はそのグループの明細のエラーとし、他のグループは続行する。
+    返り値は rows と同じ順序。
+    """
+    outcomes: List[Optional[PaymentResult]] = [None] * len(rows)
+    indexes_by_user: Dict[int, List[int]] = {}
+    for idx, row in enumerate(rows):
+        indexes_by_user.setdefault(row[0], []).append(idx)
+
+    for group in user_groups(indexes_by_user):
+        indexes = sorted(idx for uid in group for idx in indexes_by_user[uid])
+        try:
+            with user_locks.hold(*group):
+                group_outcomes = run([rows[idx] for idx in indexes])
+                with stage(STAGE_COMMIT):
+                    db.commit()
+        except Exception as e:
+            db.rollback()
+            error = str(e) if isinstance(e, UserLockTimeout) else f"internal error: {e}"
+            group_outcomes = [failed(rows[idx]) for idx in indexes]
+            for outcome in group_outcomes:
+                outcome.error = error
+        else:
+            if audit_log_writer.enabled:
+                audit_log_writer.submit([row for o in group_outcomes if o.error is None for row in log_rows(o)])
+        for idx, outcome in zip(indexes, group_outcomes):
+            outcomes[idx] = outcome
+    return outcomes
+
+@router.post("/execute_batch", response_model=ExecuteBatchResponse, summary="POS決済の一括処理（日本円・整数）")
+def execute_batch(request: ExecuteBatchRequest, response: Response, db: Session = Depends(get_db)):
+    items = request.items
+
+    payments = [(item.user_id, int(item.amount), item.category) for item in items]
+    rng = request_rng("batch", payments)
+
+    # ユーザー存在確認はルールプラン取得（キャッシュ・一括ロード）で兼ねる
+    with pos_metrics.collect("execute_batch", response):
+        outcomes = _run_in_user_groups(
             db,
-            user_id=request.user_id,
-            amount_paid=int(request.amount),
-            category=request.category,  # ← 追加
+            payments,
+            lambda rows: execute_pos_payments_batch(db, rows, defer_logs=audit_log_writer.enabled, rng=rng),
+            lambda row: PaymentResult(*row),
         )
-        db.commit()
-    except HTTPException:
-        raise
+
+    results = [_to_batch_item(idx, outcome) for idx, outcome in enumerate(outcomes)]
+    succeeded = sum(1 for r in results if r.ok)
+    return ExecuteBatchResponse(succeeded=succeeded, failed=len(results) - succeeded, results=results)
+
+# ======= Explain API =======
+def to_explain_response(explanation: PaymentExplanation) -> ExplainResponse:
+    outcome = explanation.result
+    return ExplainResponse(
+        user_id=outcome.user_id,
+        amount_paid=outcome.amount_paid,
+        category=outcome.category,
+        tanabota_total=outcome.tanabota_total,
+        executions=to_execution_items(outcome),
+        demo_fallback_applied=explanation.demo_fallback is not None,
+        counters_loaded=explanation.counters_loaded,
+        rules=[
+            RuleVerdictItem(
+                rule_id=v.rule.rule_id,
+                action_id=v.rule.action_id,
+                trigger_id=v.rule.trigger_id,
+                trigger_name=v.rule.trigger_name,
+                event=v.rule.event,
+                phase=v.phase or None,
+                matched=v.matched,
+                computed_amount=v.amount,
+                fired=v.fired,
+                forced_category=v.forced_category,
+                action_type=v.rule.action_type,
+                trigger_params=v.rule.trigger_params,
+                action_params=v.rule.action_params,
+            ) for v in explanation.verdicts
+        ],
+    )
+
+@router.post("/explain", response_model=ExplainResponse, summary="POS決済の評価内容を保存せずに確認（ドライラン）")
+def explain(request: ExecuteRequest, response: Response, db: Session = Depends(get_db)):
+    # 書き込み・ロックなし。決定的モードでは冪等キー無しの /execute と同じ乱数になる
+    try:
+        with pos_metrics.collect("explain", response):
+            explanation = explain_pos_payment(
+                db,
+                user_id=request.user_id,
+                amount_paid=int(request.amount),
+                category=request.category,
+                rng=request_rng(request.user_id, int(request.amount), request.category),
+            )
+    except UserNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="user not found")
     except Exception as e:
-        db.rollback()
         raise HTTPException(status_code=500, detail=f"internal error: {e}")
+    finally:
+        # 読み取りのトランザクションを閉じる
+        db.rollback()
+    return to_explain_response(explanation)
 
-    return ExecuteResponse(
-        transaction_id=tx.id,
-        amount_paid=int(tx.amount_paid),
-        tanabota_total=int(tx.tanabota_total),
-        executions=[
-            ExecutionItem(
-                rule_id=l.rule_id,
-                action_id=l.action_id,
-                action_type=l.action_type,
-                tanabota_amount=int(l.tanabota_amount),
-            ) for l in logs
-        ],
+# ======= Income API =======
+def to_income_response(outcome: PaymentResult, amount_received: int) -> IncomeResponse:
+    return IncomeResponse(
+        transaction_id=outcome.transaction_id,
+        amount_received=amount_received,
+        tanabota_total=outcome.tanabota_total,
+        executions=to_execution_items(outcome),
     )
 
+@router.post("/income", response_model=IncomeResponse, summary="入金（給与・賞与など）の処理（日本円・整数）")
+def income(request: IncomeRequest, response: Response, db: Session = Depends(get_db)):
+    try:
+        with pos_metrics.collect("income", response), user_locks.hold(request.user_id):
+            outcome = execute_income(
+                db,
+                user_id=request.user_id,
+                amount_received=int(request.amount),
+                description=request.description,
+                defer_logs=audit_log_writer.enabled,
+                rng=request_rng("income", request.user_id, int(request.amount), request.description),
+            )
+            with stage(STAGE_COMMIT):
+                db.commit()
+    except UserNotFoundError:
+        db.rollback()
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="user not found")
+    except UserLockTimeout as e:
+        db.rollback()
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"internal error: {e}")
+
+    if audit_log_writer.enabled:
+        audit_log_writer.submit(log_rows(outcome))
+    return to_income_response(outcome, int(request.amount))
+
+@router.post("/income_batch", response_model=IncomeBatchResponse, summary="入金の一括処理（給与日など）")
+def income_batch(request: IncomeBatchRequest, response: Response, db: Session = Depends(get_db)):
+    items = request.items
+
+    incomes = [(item.user_id, int(item.amount), item.description) for item in items]
+    rng = request_rng("income_batch", incomes)
+
+    # ユーザー存在確認はルールプラン取得（キャッシュ・一括ロード）で兼ねる
+    with pos_metrics.collect("income_batch", response):
+        outcomes = _run_in_user_groups(
+            db,
+            incomes,
+            lambda rows: execute_incomes_batch(db, rows, defer_logs=audit_log_writer.enabled, rng=rng),
+            lambda row: PaymentResult(row[0], 0),
+        )
+
+    results = [
+        IncomeBatchItemResult(index=idx, ok=False, error=outcome.error) if outcome.error is not None
+        else IncomeBatchItemResult(index=idx, ok=True, result=to_income_response(outcome, int(item.amount)))
+        for idx, (item, outcome) in enumerate(zip(items, outcomes))
+    ]
+    succeeded = sum(1 for r in results if r.ok)
+    return IncomeBatchResponse(succeeded=succeeded, failed=len(results) - succeeded, results=results)
+
 # ======= Read APIs =======
+# /transactions/{transaction_id} より先に登録すること（"export" が取引IDとして解釈されるため）
+@router.get("/transactions/export", summary="ユーザーの取引履歴を全件エクスポート（NDJSON / CSV・ストリーミング）")
+def export_transactions(
+    user_id: int = Query(..., ge=1),
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$", description="ndjson: 1行1取引（明細入り） / csv: 1行1明細"),
+    after_id: Optional[int] = Query(None, ge=1, description="この取引IDより後から（途中で切れた場合の再開用）"),
+    event_kind: str = Query(EVENT_KIND_PAYMENT, pattern=EVENT_KIND_PATTERN, description="取引種別（all で入金などの記録も含める）"),
+    db: Session = Depends(get_db),
+):
+    if db.get(User, user_id) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="user not found")
+    # 本体は応答の送信中に読むため、依存性のセッションではなく自前のセッションで流す
+    return StreamingResponse(
+        stream_transactions(user_id, format, after_id=after_id, event_kind=event_kind_filter(event_kind)),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="tanabota_{user_id}.{format}"'},
+    )
+
 @router.get("/transactions/{transaction_id}", response_model=TxDetail, summary="取引詳細を取得")
 def get_transaction(transaction_id: int, db: Session = Depends(get_db)):
     tx = db.get(TanabotaTransaction, transaction_id)
     if not tx:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="transaction not found")
     logs = db.query(TanabotaActionLog).filter_by(transaction_id=tx.id).all()
+    executions = [
+        ExecutionItem(
+            rule_id=l.rule_id,
+            action_id=l.action_id,
+            action_type=l.action_type,
+            tanabota_amount=int(l.tanabota_amount),
+        ) for l in logs
+    ]
+    if not executions and missing_log_ids([(tx.id, tx.tanabota_total)], []):
+        # 保存期間を過ぎてアーカイブへ移した明細
+        executions = archived_execution_items(archived_logs(db, [tx.id])).get(tx.id, [])
     return TxDetail(
         id=tx.id,
         user_id=tx.user_id,
         amount_paid=int(tx.amount_paid),
         tanabota_total=int(tx.tanabota_total),
-        executions=[
-            ExecutionItem(
-                rule_id=l.rule_id,
-                action_id=l.action_id,
-                action_type=l.action_type,
-                tanabota_amount=int(l.tanabota_amount),
-            ) for l in logs
-        ],
+        event_kind=tx.event_kind,
+        executions=executions,
     )
 
-@router.get("/transactions", response_model=List[TxSummary], summary="ユーザーの取引一覧")
-def list_transactions(
-    user_id: int = Query(..., ge=1),
-    limit: int = Query(50, ge=1, le=200),
-    offset: int = Query(0, ge=0),
-    db: Session = Depends(get_db),
+def event_kind_filter(event_kind: str) -> Optional[str]:
+    """クエリの event_kind → 絞り込む種別（all なら None）"""
+    return None if event_kind == EVENT_KIND_ALL else event_kind
+
+def transactions_page_query(
+    user_id: int,
+    limit: int,
+    offset: int = 0,
+    after_id: Optional[int] = None,
+    event_kind: Optional[str] = EVENT_KIND_PAYMENT,
 ):
+    """
+    ユーザーの取引一覧（id 降順）。after_id を渡すとキーセット方式（id < after_id）で、
+    (user_id, id) インデックスを範囲走査するだけなのでページの深さに依存しない。
+    event_kind で種別を絞る（None なら入金などの記録も含める）。
+    """
     q = (
         select(TanabotaTransaction)
         .where(TanabotaTransaction.user_id == user_id)
         .order_by(TanabotaTransaction.id.desc())
         .limit(limit)
-        .offset(offset)
     )
-    rows = db.execute(q).scalars().all()
+    if event_kind is not None:
+        q = q.where(TanabotaTransaction.event_kind == event_kind)
+    if after_id is not None:
+        return q.where(TanabotaTransaction.id < after_id)
+    return q.offset(offset)
+
+def validate_page_params(offset: int, after_id: Optional[int]) -> None:
+    if after_id is not None and offset:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="after_id and offset cannot be combined")
+
+def set_next_cursor(response: Response, rows: List[TanabotaTransaction], limit: int) -> None:
+    # 続きがありそうな場合だけ次ページのカーソルを返す
+    if len(rows) == limit:
+        response.headers["X-Next-After-Id"] = str(rows[-1].id)
+
+def transactions_by_ids_query(ids: List[int], user_id: Optional[int] = None):
+    q = (
+        select(TanabotaTransaction)
+        .where(TanabotaTransaction.id.in_(ids))
+        .order_by(TanabotaTransaction.id.desc())
+    )
+    if user_id is not None:
+        q = q.where(TanabotaTransaction.user_id == user_id)
+    return q
+
+def executions_query(transaction_ids: List[int]):
+    """ページ内の全取引のログを1回のIN検索で取る（必要な列だけ）"""
+    return (
+        select(
+            TanabotaActionLog.transaction_id,
+            TanabotaActionLog.rule_id,
+            TanabotaActionLog.action_id,
+            TanabotaActionLog.action_type,
+            TanabotaActionLog.tanabota_amount,
+        )
+        .where(TanabotaActionLog.transaction_id.in_(transaction_ids))
+        .order_by(TanabotaActionLog.transaction_id, TanabotaActionLog.id)
+    )
+
+def group_executions(rows) -> Dict[int, List[ExecutionItem]]:
+    grouped: Dict[int, List[ExecutionItem]] = {}
+    for transaction_id, rule_id, action_id, action_type, tanabota_amount in rows:
+        grouped.setdefault(transaction_id, []).append(ExecutionItem(
+            rule_id=rule_id,
+            action_id=action_id,
+            action_type=action_type,
+            tanabota_amount=int(tanabota_amount),
+        ))
+    return grouped
+
+def archived_execution_items(archived: Dict[int, List[Dict]]) -> Dict[int, List[ExecutionItem]]:
+    return {
+        tx_id: [
+            ExecutionItem(
+                rule_id=l["rule_id"],
+                action_id=l["action_id"],
+                action_type=l["action_type"],
+                tanabota_amount=int(l["tanabota_amount"]),
+            ) for l in logs
+        ]
+        for tx_id, logs in archived.items()
+    }
+
+def archive_lookup_ids(rows: List[TanabotaTransaction], executions: Dict[int, List[ExecutionItem]]) -> List[int]:
+    """明細がホット側に無く、アーカイブを見る必要がある取引ID"""
+    return missing_log_ids(((tx.id, tx.tanabota_total) for tx in rows), executions)
+
+def validate_list_params(user_id: Optional[int], ids: Optional[List[int]], offset: int, after_id: Optional[int]) -> None:
+    if ids:
+        if len(ids) > MAX_LOOKUP_IDS:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"too many ids (max {MAX_LOOKUP_IDS})")
+        return
+    if user_id is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="user_id or ids is required")
+    validate_page_params(offset, after_id)
+
+def to_tx_list(rows: List[TanabotaTransaction], executions: Optional[Dict[int, List[ExecutionItem]]]) -> List[TxDetail]:
+    # executions を渡さない場合はフィールド自体を省く（response_model_exclude_unset で従来の TxSummary 形）
+    if executions is None:
+        return [
+            TxDetail(
+                id=tx.id,
+                user_id=tx.user_id,
+                amount_paid=int(tx.amount_paid),
+                tanabota_total=int(tx.tanabota_total),
+                event_kind=tx.event_kind,
+            ) for tx in rows
+        ]
     return [
-        TxSummary(
+        TxDetail(
             id=tx.id,
             user_id=tx.user_id,
             amount_paid=int(tx.amount_paid),
             tanabota_total=int(tx.tanabota_total),
+            event_kind=tx.event_kind,
+            executions=executions.get(tx.id, []),
         ) for tx in rows
     ]
 
+@router.get(
+    "/transactions",
+    response_model=List[TxDetail],
+    response_model_exclude_unset=True,
+    summary="ユーザーの取引一覧（ids 指定で一括取得、include_executions で明細付き）",
+)
+def list_transactions(
+    response: Response,
+    user_id: Optional[int] = Query(None, ge=1),
+    ids: Optional[List[int]] = Query(None, description=f"取引IDで一括取得（最大{MAX_LOOKUP_IDS}件。指定時はページング無視）"),
+    include_executions: bool = Query(False, description="各取引の明細（executions）も返す"),
+    limit: int = Query(50, ge=1, le=200),
+    offset: int = Query(0, ge=0, description="旧クライアント向け（深いページほど遅い）"),
+    after_id: Optional[int] = Query(None, ge=1, description="カーソル（前ページの X-Next-After-Id をそのまま渡す）"),
+    event_kind: str = Query(EVENT_KIND_PAYMENT, pattern=EVENT_KIND_PATTERN, description="取引種別（all で入金などの記録も含める。ids 指定時は無視）"),
+    db: Session = Depends(get_db),
+):
+    validate_list_params(user_id, ids, offset, after_id)
+    if ids:
+        rows = db.execute(transactions_by_ids_query(ids, user_id)).scalars().all()
+    else:
+        rows = db.execute(
+            transactions_page_query(user_id, limit, offset, after_id, event_kind_filter(event_kind))
+        ).scalars().all()
+        set_next_cursor(response, rows, limit)
+
+    executions = None
+    if include_executions:
+        executions = group_executions(db.execute(executions_query([tx.id for tx in rows])).all()) if rows else {}
+        archived_ids = archive_lookup_ids(rows, executions)
+        if archived_ids:
+            executions.update(archived_execution_items(archived_logs(db, archived_ids)))
+    return to_tx_list(rows, executions)
+
+@router.get("/spend_counters", response_model=SpendCountersResponse, summary="ユーザーの支出カウンタ（日次・累計）")
+def get_spend_counters(
+    user_id: int = Query(..., ge=1),
+    day: Optional[date] = Query(None, description="対象日（省略時は今日）"),
+    db: Session = Depends(get_db),
+):
+    day = day or business_day()
+    rows = db.execute(
+        select(UserSpendCounter)
+        .where(
+            UserSpendCounter.user_id == user_id,
+            UserSpendCounter.period.in_([period_of(day), PERIOD_TOTAL]),
+        )
+        .order_by(UserSpendCounter.period, UserSpendCounter.category)
+    ).scalars().all()
+    items: Dict[str, List[SpendCounterItem]] = {period_of(day): [], PERIOD_TOTAL: []}
+    for r in rows:
+        items[r.period].append(SpendCounterItem(
+            category=None if r.category == ALL_CATEGORIES else r.category,
+            spend_amount=int(r.spend_amount),
+            spend_count=int(r.spend_count),
+            tanabota_amount=int(r.tanabota_amount),
+        ))
+    return SpendCountersResponse(user_id=user_id, day=day, daily=items[period_of(day)], cumulative=items[PERIOD_TOTAL])
+
+@router.get("/summary", response_model=SummaryResponse, summary="ユーザーのたなぼた集計（月次・累計、ルール別・アクション種別）")
+def get_summary(
+    user_id: int = Query(..., ge=1),
+    granularity: str = Query("month", pattern="^(month|total)$"),
+    from_month: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$", description="YYYY-MM（month のみ）"),
+    to_month: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$", description="YYYY-MM（month のみ）"),
+    db: Session = Depends(get_db),
+):
+    # 集計テーブル（決済時に加算済み）だけを読む。ログは走査しない
+    q = select(UserSavingsRollup).where(UserSavingsRollup.user_id == user_id)
+    if granularity == "total":
+        q = q.where(UserSavingsRollup.period == PERIOD_TOTAL)
+    else:
+        q = q.where(UserSavingsRollup.period != PERIOD_TOTAL)
+        if from_month:
+            q = q.where(UserSavingsRollup.period >= from_month)
+        if to_month:
+            q = q.where(UserSavingsRollup.period <= to_month)
+    rows = db.execute(q.order_by(UserSavingsRollup.period)).scalars().all()
+
+    rule_ids = {int(r.dimension_key) for r in rows if r.dimension == DIMENSION_RULE}
+    rule_names = dict(db.execute(select(Rule.id, Rule.name).where(Rule.id.in_(rule_ids))).all()) if rule_ids else {}
+
+    periods: Dict[str, SummaryPeriod] = {}
+    for r in rows:
+        p = periods.get(r.period)
+        if p is None:
+            p = periods[r.period] = SummaryPeriod(
+                period=r.period, tanabota_amount=0, execution_count=0, transaction_count=0, by_rule=[], by_action_type=[]
+            )
+        counts = dict(
+            tanabota_amount=int(r.tanabota_amount),
+            execution_count=int(r.execution_count),
+            transaction_count=int(r.transaction_count),
+        )
+        if r.dimension == DIMENSION_ALL:
+            p.tanabota_amount = counts["tanabota_amount"]
+            p.execution_count = counts["execution_count"]
+            p.transaction_count = counts["transaction_count"]
+        elif r.dimension == DIMENSION_RULE:
+            rule_id = int(r.dimension_key)
+            p.by_rule.append(SummaryRuleItem(rule_id=rule_id, rule_name=rule_names.get(rule_id), **counts))
+        elif r.dimension == DIMENSION_ACTION_TYPE:
+            p.by_action_type.append(SummaryActionTypeItem(action_type=r.dimension_key, **counts))
+
+    for p in periods.values():
+        p.by_rule.sort(key=lambda i: -i.tanabota_amount)
+        p.by_action_type.sort(key=lambda i: -i.tanabota_amount)
+    return SummaryResponse(user_id=user_id, granularity=granularity, periods=list(periods.values()))
+
+@router.get("/metrics", summary="POS処理の段階別レイテンシ・キャッシュ等の統計")
+def metrics():
+    # 段階別ヒストグラムは POS_METRICS_ENABLED=true の時だけ集計される
+    return {
+        "pos": pos_metrics.stats(),
+        "rule_plan_cache": rule_plan_cache.stats(),
+        "action_param_snapshots": action_param_snapshots.stats(),
+        "idempotency_cache": idempotency_cache.stats(),
+        "audit_log_writer": audit_log_writer.stats(),
+        "user_locks": user_locks.stats(),
+        "scheduler": scheduled_trigger_engine.stats(),
+    }
+
 @router.get("/health", summary="POS API ヘルスチェック")
 def health():
     return {"ok": True}
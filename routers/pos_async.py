@@ -0,0 +1,133 @@
+# routers/pos_async.py  —— /pos の非同期版（AsyncSession。認可ヘッダなし・デモ用）
+from __future__ import annotations
+
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import get_async_db
+from models import EVENT_KIND_PAYMENT, TanabotaTransaction, TanabotaActionLog
+from routers.pos import (
+    EVENT_KIND_PATTERN,
+    MAX_LOOKUP_IDS,
+    ExecuteRequest,
+    ExecuteResponse,
+    ExecutionItem,
+    TxDetail,
+    archive_lookup_ids,
+    archived_execution_items,
+    event_kind_filter,
+    executions_query,
+    group_executions,
+    set_next_cursor,
+    to_execute_response,
+    to_tx_list,
+    transactions_by_ids_query,
+    transactions_page_query,
+    validate_list_params,
+)
+from services.action_log_archive import archived_logs_async, missing_log_ids
+from services.audit_log_writer import audit_log_writer
+from services.pos_metrics import STAGE_COMMIT, pos_metrics, stage
+from services.rng import request_rng
+from services.tanabota import UserNotFoundError, execute_pos_payment_async, log_rows
+from services.user_locks import UserLockTimeout, user_locks
+
+router = APIRouter(prefix="/pos/async", tags=["POS (async)"])
+
+# ======= Core API =======
+@router.post("/execute", response_model=ExecuteResponse, summary="POS決済の処理（日本円・整数／非同期DB）")
+async def execute(request: ExecuteRequest, response: Response, db: AsyncSession = Depends(get_async_db)):
+    try:
+        with pos_metrics.collect("async_execute", response):
+            # 同じユーザーの決済は評価〜コミットを1件ずつ（同期版の /pos/execute ともロックを共有）
+            async with user_locks.hold_async(request.user_id):
+                # ユーザー存在確認はルールプラン（キャッシュ）で兼ねる
+                outcome = await execute_pos_payment_async(
+                    db,
+                    user_id=request.user_id,
+                    amount_paid=int(request.amount),
+                    category=request.category,
+                    defer_logs=audit_log_writer.enabled,
+                    rng=request_rng(request.user_id, int(request.amount), request.category),
+                )
+                with stage(STAGE_COMMIT):
+                    await db.commit()
+    except UserNotFoundError:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="user not found")
+    except UserLockTimeout as e:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=f"internal error: {e}")
+
+    if audit_log_writer.enabled:
+        audit_log_writer.submit(log_rows(outcome))
+    return to_execute_response(outcome)
+
+# ======= Read APIs =======
+@router.get("/transactions/{transaction_id}", response_model=TxDetail, summary="取引詳細を取得（非同期DB）")
+async def get_transaction(transaction_id: int, db: AsyncSession = Depends(get_async_db)):
+    tx = await db.get(TanabotaTransaction, transaction_id)
+    if not tx:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="transaction not found")
+    logs = (await db.execute(
+        select(TanabotaActionLog).where(TanabotaActionLog.transaction_id == tx.id)
+    )).scalars().all()
+    executions = [
+        ExecutionItem(
+            rule_id=l.rule_id,
+            action_id=l.action_id,
+            action_type=l.action_type,
+            tanabota_amount=int(l.tanabota_amount),
+        ) for l in logs
+    ]
+    if not executions and missing_log_ids([(tx.id, tx.tanabota_total)], []):
+        # 保存期間を過ぎてアーカイブへ移した明細
+        executions = archived_execution_items(await archived_logs_async(db, [tx.id])).get(tx.id, [])
+    return TxDetail(
+        id=tx.id,
+        user_id=tx.user_id,
+        amount_paid=int(tx.amount_paid),
+        tanabota_total=int(tx.tanabota_total),
+        event_kind=tx.event_kind,
+        executions=executions,
+    )
+
+@router.get(
+    "/transactions",
+    response_model=List[TxDetail],
+    response_model_exclude_unset=True,
+    summary="ユーザーの取引一覧（非同期DB。ids 指定で一括取得、include_executions で明細付き）",
+)
+async def list_transactions(
+    response: Response,
+    user_id: Optional[int] = Query(None, ge=1),
+    ids: Optional[List[int]] = Query(None, description=f"取引IDで一括取得（最大{MAX_LOOKUP_IDS}件。指定時はページング無視）"),
+    include_executions: bool = Query(False, description="各取引の明細（executions）も返す"),
+    limit: int = Query(50, ge=1, le=200),
+    offset: int = Query(0, ge=0, description="旧クライアント向け（深いページほど遅い）"),
+    after_id: Optional[int] = Query(None, ge=1, description="カーソル（前ページの X-Next-After-Id をそのまま渡す）"),
+    event_kind: str = Query(EVENT_KIND_PAYMENT, pattern=EVENT_KIND_PATTERN, description="取引種別（all で入金などの記録も含める。ids 指定時は無視）"),
+    db: AsyncSession = Depends(get_async_db),
+):
+    validate_list_params(user_id, ids, offset, after_id)
+    if ids:
+        rows = (await db.execute(transactions_by_ids_query(ids, user_id))).scalars().all()
+    else:
+        rows = (await db.execute(
+            transactions_page_query(user_id, limit, offset, after_id, event_kind_filter(event_kind))
+        )).scalars().all()
+        set_next_cursor(response, rows, limit)
+
+    executions = None
+    if include_executions:
+        executions = group_executions((await db.execute(executions_query([tx.id for tx in rows]))).all()) if rows else {}
+        archived_ids = archive_lookup_ids(rows, executions)
+        if archived_ids:
+            executions.update(archived_execution_items(await archived_logs_async(db, archived_ids)))
+    return to_tx_list(rows, executions)
@@ -1,12 +1,21 @@
 import os, json, re
 from typing import Dict, Any, List
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 MODEL_NAME = os.getenv("OPENAI_MODEL_NAME", "gpt-4o-mini")
 PERSONA_SUFFIX = "ブヒ"
 TONE_HINT = "優しく、友達のように。タメ口で、親しみやすく。"
 
-_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# 応答生成のタイムアウト（秒）と再試行回数。超えたら /talk/feedback は 504
+TALK_LLM_TIMEOUT = float(os.getenv("TALK_LLM_TIMEOUT", "20"))
+TALK_LLM_MAX_RETRIES = int(os.getenv("TALK_LLM_MAX_RETRIES", "1"))
+
+# 非同期クライアントは1プロセスで共有する（接続プールを会話間で使い回す）
+_client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    timeout=TALK_LLM_TIMEOUT,
+    max_retries=TALK_LLM_MAX_RETRIES,
+)
 MAX_TURNS = 20  # sessions と合わせる
 MAX_CHARS_CONSULT = 100
 MAX_CHARS_CHAT = 50
@@ -49,7 +58,7 @@ def build_user_block(user_text: str, user_context: Dict[str, Any]) -> str:
     )
     return f"{ctx}\n【ユーザー発話】\n{user_text}\n\n" + json_hint
 
-def generate_message(
+async def generate_message(
     user_text: str,
     user_context: Dict[str, Any],
     history_messages: List[Dict[str, str]],
@@ -62,7 +71,7 @@ def generate_message(
     messages.extend(history_messages[-(MAX_TURNS * 2):])
     messages.append({"role": "user", "content": user_block})
 
-    response = _client.chat.completions.create(
+    response = await _client.chat.completions.create(
         model=MODEL_NAME,
         messages=messages,
         response_format={"type": "json_object"},
@@ -1,6 +1,7 @@
 import os, json
 from fastapi import APIRouter, HTTPException
 from dotenv import load_dotenv
+from openai import APITimeoutError
 
 from .schemas import TalkRequest, TalkResponse, TalkResult
 from .sessions import get_or_create_session, append_history, reset_session as reset_session_store
@@ -16,11 +17,11 @@ async def talk_feedback(req: TalkRequest):
         # 1) セッション確立 & 既存履歴の取得
         session_id, history = get_or_create_session(req.session_id)
 
-        # 2) パーソナライズ用のユーザー文脈を取得（DB直読み）
+        # 2) パーソナライズ用のユーザー文脈を取得（DB直読みはスレッドで実行）
         user_ctx = await fetch_user_context(req.user_id)
 
-        # 3) 応答生成（履歴＋文脈＋テンプレート）
-        msg_json = generate_message(
+        # 3) 応答生成（履歴＋文脈＋テンプレート。非同期クライアントで待つ間も他のリクエストを処理できる）
+        msg_json = await generate_message(
             user_text=req.text,
             user_context=user_ctx,
             history_messages=list(history),
@@ -33,6 +34,8 @@ async def talk_feedback(req: TalkRequest):
         append_history(history, "assistant", message_text)
 
         return TalkResponse(result=TalkResult(session_id=session_id, message=message_text))
+    except APITimeoutError:
+        raise HTTPException(status_code=504, detail="応答の生成がタイムアウトしました")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
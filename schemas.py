@@ -223,3 +223,26 @@ class TanabotaTxSummary(BaseModel):
 
 class TanabotaTxDetail(TanabotaTxSummary):
     executions: List[TanabotaExecutionItem] = []
+
+class SimulationPaymentItem(BaseModel):
+    amount_paid: conint(ge=0, le=999_999_999_999) = Field(..., description="支払額（円）")
+    category: Optional[str] = Field(None, description="支出カテゴリ")
+
+class SimulationRequest(BaseModel):
+    payments: List[SimulationPaymentItem] = Field(..., max_length=100_000, description="試算に使う支払いストリーム")
+    seed: Optional[int] = Field(None, description="乱数シード（ガチャ・ランダム額を再現したい場合）")
+
+class RuleSimulationItem(BaseModel):
+    rule_template_id: int = Field(..., description="ルールテンプレートID")
+    name: str = Field(..., description="ルールテンプレートの名前")
+    action_type: str = Field(..., description="アクション種別")
+    fired_count: int = Field(..., description="たなぼたが発生した支払い件数")
+    tanabota_total: int = Field(..., description="このルールによるたなぼた額の合計（円）")
+
+class RecipeTemplateSimulation(BaseModel):
+    recipe_template_id: int = Field(..., description="レシピテンプレートID")
+    payment_count: int = Field(..., description="試算に使った支払い件数")
+    amount_paid_total: int = Field(..., description="支払額の合計（円）")
+    tanabota_total: int = Field(..., description="たなぼた額の合計（円）")
+    fired_payment_count: int = Field(..., description="1つ以上のルールが発火した支払い件数")
+    rules: List[RuleSimulationItem] = Field(..., description="ルールテンプレートごとの内訳")
@@ -0,0 +1,233 @@
+"""
+たなぼたログのアーカイブ（tanabota_action_logs → tanabota_action_log_archive）
+ログは決済のたびに増え、JSONスナップショットと3本の単一列インデックスを持つため、
+件数が増えるほど INSERT とインデックス更新が重くなる。保存期間を過ぎたログは
+取引1件につき1行（ログ行のJSON配列を zlib 圧縮）のアーカイブテーブルへ移し、ホット側の件数を一定に保つ。
+- 取引ヘッダは移さない（一覧・ページング・集計はそのまま）
+- 明細の読み出しは、ホット側にログが無く tanabota_total > 0 の取引だけアーカイブを見る
+  （ログの無い取引は合計0円なので、それ以外で余計な問い合わせはしない）
+- ジョブは取引ID順にバッチ単位で「読む → 圧縮して書く → 元のログを消す」を1トランザクションで行う
+  （python -m services.action_log_archive [--days N]。cron 等で定期実行する）
+MySQL のパーティショニングは外部キーを持つテーブルに使えないため、このテーブルでは使わない。
+"""
+from __future__ import annotations
+
+import json
+import os
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from models import ActionParamSnapshot, TanabotaActionLog, TanabotaActionLogArchive, TanabotaTransaction
+
+# ホット側に残す日数（これより古い取引のログを退避する）
+ACTION_LOG_RETENTION_DAYS = int(os.getenv("ACTION_LOG_RETENTION_DAYS", "180"))
+# 1トランザクションで退避する取引数
+ACTION_LOG_ARCHIVE_BATCH_SIZE = int(os.getenv("ACTION_LOG_ARCHIVE_BATCH_SIZE", "1000"))
+
+_LOG_COLUMNS = (
+    TanabotaActionLog.id,
+    TanabotaActionLog.transaction_id,
+    TanabotaActionLog.rule_id,
+    TanabotaActionLog.action_id,
+    TanabotaActionLog.action_type,
+    TanabotaActionLog.action_params_json,
+    ActionParamSnapshot.params_json.label("snapshot_params_json"),
+    TanabotaActionLog.tanabota_amount,
+    TanabotaActionLog.result_json,
+    TanabotaActionLog.created_at,
+)
+
+
+def _compress(logs: List[Dict[str, Any]]) -> bytes:
+    return zlib.compress(json.dumps(logs, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 9)
+
+
+def decompress_logs(payload: bytes) -> List[Dict[str, Any]]:
+    """アーカイブ1行分のログ（id, rule_id, action_id, action_type, action_params_json, tanabota_amount, result_json, created_at）"""
+    return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+
+def _log_dict(row) -> Dict[str, Any]:
+    return {
+        "id": row.id,
+        "rule_id": row.rule_id,
+        "action_id": row.action_id,
+        "action_type": row.action_type,
+        # アーカイブはスナップショット表に依存させず、パラメータ本体を持つ
+        "action_params_json": row.action_params_json if row.action_params_json is not None else row.snapshot_params_json,
+        "tanabota_amount": int(row.tanabota_amount),
+        "result_json": row.result_json,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+    }
+
+
+# ------------------------------------------------------------
+# 退避ジョブ
+# ------------------------------------------------------------
+def _archive_batch(db: Session, txs: List[Tuple[int, int]]) -> Tuple[int, int]:
+    """(transaction_id, user_id) のログをアーカイブへ移す。(取引数, ログ件数) を返す（コミットは呼び出し側）"""
+    tx_ids = [tx_id for tx_id, _ in txs]
+    logs: Dict[int, List[Dict[str, Any]]] = {}
+    log_ids: List[int] = []
+    for row in db.execute(
+        select(*_LOG_COLUMNS)
+        .outerjoin(ActionParamSnapshot, ActionParamSnapshot.id == TanabotaActionLog.action_params_id)
+        .where(TanabotaActionLog.transaction_id.in_(tx_ids))
+        .order_by(TanabotaActionLog.transaction_id, TanabotaActionLog.id)
+    ):
+        logs.setdefault(row.transaction_id, []).append(_log_dict(row))
+        log_ids.append(row.id)
+    if not log_ids:
+        return 0, 0
+
+    # 既に退避済みの取引（後から書かれたログ）は既存分とまとめて書き直す
+    existing = {
+        a.transaction_id: a
+        for a in db.execute(
+            select(TanabotaActionLogArchive).where(TanabotaActionLogArchive.transaction_id.in_(list(logs)))
+        ).scalars()
+    }
+    now = datetime.now(timezone.utc)
+    new_rows: List[Dict[str, Any]] = []
+    for tx_id, user_id in txs:
+        tx_logs = logs.get(tx_id)
+        if not tx_logs:
+            continue
+        archived = existing.get(tx_id)
+        if archived is not None:
+            tx_logs = decompress_logs(archived.payload) + tx_logs
+            archived.payload = _compress(tx_logs)
+            archived.log_count = len(tx_logs)
+            archived.tanabota_amount = sum(l["tanabota_amount"] for l in tx_logs)
+            archived.archived_at = now
+            continue
+        new_rows.append({
+            "transaction_id": tx_id,
+            "user_id": user_id,
+            "log_count": len(tx_logs),
+            "tanabota_amount": sum(l["tanabota_amount"] for l in tx_logs),
+            "payload": _compress(tx_logs),
+            "archived_at": now,
+        })
+    if new_rows:
+        db.execute(TanabotaActionLogArchive.__table__.insert(), new_rows)
+    db.flush()
+    db.execute(delete(TanabotaActionLog).where(TanabotaActionLog.id.in_(log_ids)))
+    return len(logs), len(log_ids)
+
+
+def archive_action_logs(
+    *,
+    older_than: Optional[datetime] = None,
+    batch_size: int = ACTION_LOG_ARCHIVE_BATCH_SIZE,
+    session_factory: Callable[[], Session] = SessionLocal,
+) -> Dict[str, int]:
+    """
+    older_than（既定: ACTION_LOG_RETENTION_DAYS 日前）より前の取引のログをアーカイブへ移す。
+    取引IDは時刻順に増えるため、ログの残っている最小の取引IDから順に読み、
+    older_than 以降の取引に達したところで止める（created_at のインデックスは使わない）。
+    バッチごとにコミットするので、途中で止めても次回はその続きから進む。
+    """
+    cutoff = older_than or datetime.now(timezone.utc) - timedelta(days=ACTION_LOG_RETENTION_DAYS)
+    # DateTime 列はタイムゾーン無し（UTC）で保存されている
+    cutoff = cutoff.astimezone(timezone.utc).replace(tzinfo=None)
+    totals = {"transactions": 0, "logs": 0, "batches": 0}
+
+    db = session_factory()
+    try:
+        start = db.execute(select(func.min(TanabotaActionLog.transaction_id))).scalar()
+        while start is not None:
+            rows = db.execute(
+                select(TanabotaTransaction.id, TanabotaTransaction.user_id, TanabotaTransaction.created_at)
+                .where(TanabotaTransaction.id >= start)
+                .order_by(TanabotaTransaction.id)
+                .limit(batch_size)
+            ).all()
+            txs = [(tx_id, user_id) for tx_id, user_id, created_at in rows if created_at is not None and created_at < cutoff]
+            reached_cutoff = len(txs) < len(rows)
+            if txs:
+                tx_count, log_count = _archive_batch(db, txs)
+                db.commit()
+                totals["transactions"] += tx_count
+                totals["logs"] += log_count
+                totals["batches"] += 1
+            if reached_cutoff or len(rows) < batch_size:
+                break
+            start = rows[-1][0] + 1
+        return totals
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+# ------------------------------------------------------------
+# 読み出し（ホット側に無い明細のフォールバック）
+# ------------------------------------------------------------
+def _archived_query(transaction_ids: List[int]):
+    return select(TanabotaActionLogArchive.transaction_id, TanabotaActionLogArchive.payload).where(
+        TanabotaActionLogArchive.transaction_id.in_(transaction_ids)
+    )
+
+
+def archived_logs(db: Session, transaction_ids: List[int]) -> Dict[int, List[Dict[str, Any]]]:
+    """transaction_id → 退避済みログのリスト（退避されていない取引は含まない）"""
+    if not transaction_ids:
+        return {}
+    return {tx_id: decompress_logs(payload) for tx_id, payload in db.execute(_archived_query(transaction_ids))}
+
+
+async def archived_logs_async(db: AsyncSession, transaction_ids: List[int]) -> Dict[int, List[Dict[str, Any]]]:
+    """archived_logs の非同期版"""
+    if not transaction_ids:
+        return {}
+    return {tx_id: decompress_logs(payload) for tx_id, payload in (await db.execute(_archived_query(transaction_ids)))}
+
+
+def missing_log_ids(txs: Iterable[Tuple[int, Any]], hot_ids: Iterable[int]) -> List[int]:
+    """(transaction_id, tanabota_total) のうち、ホット側にログが無いのに合計が正の取引（= 退避済みの可能性がある）"""
+    hot = set(hot_ids)
+    return [tx_id for tx_id, total in txs if tx_id not in hot and total and int(total) > 0]
+
+
+def iter_archived_logs(
+    db: Session, user_ids: Optional[List[int]] = None, fetch_size: int = 1000
+) -> Iterator[Tuple[int, int, datetime, str, List[Dict[str, Any]]]]:
+    """退避済みの (transaction_id, user_id, 取引日時, 取引種別, ログのリスト) を取引ID順に流す（集計の作り直し用）"""
+    stmt = (
+        select(
+            TanabotaActionLogArchive.transaction_id,
+            TanabotaActionLogArchive.user_id,
+            TanabotaTransaction.created_at,
+            TanabotaTransaction.event_kind,
+            TanabotaActionLogArchive.payload,
+        )
+        .join(TanabotaTransaction, TanabotaTransaction.id == TanabotaActionLogArchive.transaction_id)
+        .order_by(TanabotaActionLogArchive.transaction_id)
+    )
+    if user_ids is not None:
+        stmt = stmt.where(TanabotaActionLogArchive.user_id.in_(user_ids))
+    for tx_id, user_id, created_at, event_kind, payload in db.execute(stmt.execution_options(yield_per=fetch_size)):
+        yield tx_id, user_id, created_at, event_kind, decompress_logs(payload)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="保存期間を過ぎたたなぼたログをアーカイブへ移す")
+    parser.add_argument("--days", type=int, default=ACTION_LOG_RETENTION_DAYS, help="ホット側に残す日数")
+    parser.add_argument("--batch-size", type=int, default=ACTION_LOG_ARCHIVE_BATCH_SIZE)
+    args = parser.parse_args()
+
+    result = archive_action_logs(
+        older_than=datetime.now(timezone.utc) - timedelta(days=args.days),
+        batch_size=args.batch_size,
+    )
+    print(f"✅ 取引 {result['transactions']} 件・ログ {result['logs']} 件をアーカイブしました（{result['batches']} バッチ）")
@@ -0,0 +1,136 @@
+"""
+アクションパラメータのスナップショット（action_param_snapshots）
+たなぼたログは実行時の rule.action_params を残す必要があるが、同じパラメータが何百万回も繰り返されるため、
+内容（正規化JSON）のハッシュで一意なスナップショット行を1つだけ作り、ログはそのIDだけを持つ。
+- ログを書くときに CompiledRule ごとに1回だけ解決し、ルールに保持する（決済のたびにハッシュしない。
+  /pos/explain など書き込まない経路ではスナップショットを作らない）
+- 正規化JSON → ID はプロセス内LRUに保持し、未知のパラメータだけDBを見る
+- 作成は決済とは別の短いトランザクションで行い、すぐコミットする
+  （決済がロールバックされても、キャッシュしたIDが消えることはない）
+- 読み出し側は TanabotaActionLog.action_params か、action_params_json が空ならスナップショットを引く
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List
+
+from sqlalchemy import select
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from models import ActionParamSnapshot
+
+# 正規化JSON → スナップショットID の最大保持件数
+ACTION_PARAM_SNAPSHOT_CACHE_SIZE = int(os.getenv("ACTION_PARAM_SNAPSHOT_CACHE_SIZE", "4096"))
+
+
+def canonical_params(params: Dict[str, Any] | None) -> str:
+    """キー順・区切り文字を固定したJSON（同じ内容なら常に同じ文字列）"""
+    return json.dumps(params or {}, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+def params_hash(canonical: str) -> str:
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _insert_ignore(dialect_name: str):
+    """params_hash が重複したら何もしない INSERT（別ワーカーが同時に作っても1行になる）"""
+    table = ActionParamSnapshot.__table__
+    if dialect_name == "mysql":
+        return mysql.insert(table).prefix_with("IGNORE")
+    return (postgresql if dialect_name == "postgresql" else sqlite).insert(table).on_conflict_do_nothing(
+        index_elements=[table.c.params_hash]
+    )
+
+
+class ActionParamSnapshotStore:
+    """正規化JSON → スナップショットID のスレッドセーフなLRU（未知のものはDBで解決・作成）"""
+
+    def __init__(
+        self,
+        maxsize: int = ACTION_PARAM_SNAPSHOT_CACHE_SIZE,
+        *,
+        session_factory: Callable[[], Session] = SessionLocal,
+    ):
+        self.maxsize = max(1, int(maxsize))
+        self.session_factory = session_factory
+        self._ids: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+
+    def resolve_many(self, params_list: List[Dict[str, Any] | None]) -> List[int]:
+        """パラメータのリストに対応するスナップショットIDのリスト（無ければ作ってコミットする）"""
+        canonicals = [canonical_params(p) for p in params_list]
+        found: Dict[str, int] = {}
+        with self._lock:
+            for c in canonicals:
+                snapshot_id = self._ids.get(c)
+                if snapshot_id is None:
+                    self.misses += 1
+                    continue
+                self._ids.move_to_end(c)
+                found[c] = snapshot_id
+                self.hits += 1
+
+        missing = {params_hash(c): c for c in set(canonicals) - set(found)}
+        if missing:
+            loaded = self._load_or_create(missing)
+            with self._lock:
+                for c, snapshot_id in loaded.items():
+                    self._ids[c] = snapshot_id
+                    self._ids.move_to_end(c)
+                while len(self._ids) > self.maxsize:
+                    self._ids.popitem(last=False)
+            found.update(loaded)
+        return [found[c] for c in canonicals]
+
+    def _load_or_create(self, missing: Dict[str, str]) -> Dict[str, int]:
+        """ハッシュ → 正規化JSON のうち、無いものを作ってから 正規化JSON → ID を返す"""
+        query = select(ActionParamSnapshot.params_hash, ActionParamSnapshot.id).where(
+            ActionParamSnapshot.params_hash.in_(list(missing))
+        )
+        db = self.session_factory()
+        try:
+            ids = dict(db.execute(query).tuples().all())
+            new_rows = [
+                {"params_hash": h, "params_json": json.loads(c)}
+                for h, c in missing.items()
+                if h not in ids
+            ]
+            if new_rows:
+                db.execute(_insert_ignore(db.get_bind().dialect.name), new_rows)
+                db.commit()
+                ids = dict(db.execute(query).tuples().all())
+                with self._lock:
+                    self.created += len(new_rows)
+            return {c: ids[h] for h, c in missing.items()}
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._ids.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._ids),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "created": self.created,
+            }
+
+
+action_param_snapshots = ActionParamSnapshotStore()
+
@@ -0,0 +1,370 @@
+"""
+TanabotaActionLog の書き込み遅延（write-behind）
+有効時は、取引ヘッダ（合計込み）だけを決済トランザクションでコミットし、
+ログ行はプロセス内キューへ積んでバックグラウンドスレッドが件数・時間単位でまとめてINSERTする。
+- キューに積む前にローカルの追記専用ファイル（スピル）へ書き出すため、プロセスが落ちても失われない
+- 起動時にスピルを読み直して未反映の行だけを投入する（(transaction_id, rule_id) で重複を除く）
+- スピルはワーカーごとに別ファイル（名前に pid と乱数）で、書いているプロセスが排他ロック（fcntl.flock）を持つ。
+  復旧はロックを取れたファイル（持ち主のプロセスが居ないもの）だけを対象にするため、
+  同じディレクトリを使う他ワーカーの反映前の行を消したり二重に投入したりしない
+- 停止時はキューを空になるまで書き切る
+反映までの間は取引詳細APIでログが見えないことがある（結果整合）。
+"""
+from __future__ import annotations
+
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import insert, select, tuple_
+
+try:
+    import fcntl
+except ImportError:  # Windows（ロックの代わりに持ち主の pid が生きているかで判定する）
+    fcntl = None
+
+from database import SessionLocal
+from models import TanabotaActionLog
+
+# write-behind を有効にするか（既定は従来どおり決済トランザクション内で書く）
+AUDIT_LOG_WRITE_BEHIND = os.getenv("AUDIT_LOG_WRITE_BEHIND", "false").lower() in ["true", "1", "yes"]
+# 1回のINSERTでまとめる最大行数
+AUDIT_LOG_BATCH_SIZE = int(os.getenv("AUDIT_LOG_BATCH_SIZE", "500"))
+# 行数が溜まらなくても書き出す間隔（秒）
+AUDIT_LOG_FLUSH_INTERVAL = float(os.getenv("AUDIT_LOG_FLUSH_INTERVAL", "0.5"))
+# スピルファイルの置き場所
+AUDIT_LOG_SPILL_DIR = os.getenv("AUDIT_LOG_SPILL_DIR", "./audit_log_spill")
+# スピルファイルを切り替えるサイズ（バイト）
+AUDIT_LOG_SPILL_SEGMENT_BYTES = int(os.getenv("AUDIT_LOG_SPILL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+# 書き込みごとに fsync するか（電源断まで守る場合。既定はプロセス異常終了まで）
+AUDIT_LOG_FSYNC = os.getenv("AUDIT_LOG_FSYNC", "false").lower() in ["true", "1", "yes"]
+# DB書き込み失敗時の再試行間隔（秒）
+AUDIT_LOG_RETRY_INTERVAL = float(os.getenv("AUDIT_LOG_RETRY_INTERVAL", "2"))
+
+_SPILL_PREFIX = "segment-"
+_SPILL_SUFFIX = ".ndjson"
+# 作成直後（ロック前）のファイル。ロックを取ってから本来の名前に変える（復旧の対象にしない）
+_SPILL_TMP_SUFFIX = ".tmp"
+
+
+def _encode(row: Dict[str, Any]) -> str:
+    data = dict(row)
+    data["created_at"] = data["created_at"].isoformat()
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def _decode(line: str) -> Dict[str, Any]:
+    data = json.loads(line)
+    data["created_at"] = datetime.fromisoformat(data["created_at"])
+    return data
+
+
+def _try_lock(f) -> bool:
+    """ファイルの排他ロックを取る（他プロセスが持っていれば False）。ロックは close で外れる"""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _owner_pid(name: str) -> Optional[int]:
+    """segment-<pid>-<乱数>-<seq> の pid（形式が違えば None）"""
+    try:
+        return int(name[len(_SPILL_PREFIX):].split("-", 1)[0])
+    except ValueError:
+        return None
+
+
+def _is_orphan(name: str, f) -> bool:
+    """持ち主のプロセスが居ないスピルか（True ならロックを取得済み）"""
+    if not _try_lock(f):
+        return False
+    if fcntl is None:
+        pid = _owner_pid(name)
+        return pid is None or not _pid_alive(pid)
+    return True
+
+
+class _SpillSegment:
+    """
+    スピルファイル1本分（書いた行数とDB反映済み行数を数え、全件反映済みで閉じていれば削除できる）。
+    書き込みを終えた後も、削除するまでファイルを開いたまま（＝ロックを持ったまま）にする
+    """
+    __slots__ = ("seq", "path", "file", "written", "committed", "closed")
+
+    def __init__(self, directory: str, owner: str, seq: int):
+        self.seq = seq
+        self.path = os.path.join(directory, f"{_SPILL_PREFIX}{owner}-{seq:012d}{_SPILL_SUFFIX}")
+        tmp_path = self.path + _SPILL_TMP_SUFFIX
+        self.file = open(tmp_path, "a", encoding="utf-8")
+        _try_lock(self.file)
+        os.rename(tmp_path, self.path)
+        self.written = 0
+        self.committed = 0
+        self.closed = False
+
+
+class AuditLogWriter:
+    """TanabotaActionLog 行をまとめて非同期に書き込むライター（1プロセス1インスタンス）"""
+
+    def __init__(
+        self,
+        *,
+        enabled: bool = AUDIT_LOG_WRITE_BEHIND,
+        batch_size: int = AUDIT_LOG_BATCH_SIZE,
+        flush_interval: float = AUDIT_LOG_FLUSH_INTERVAL,
+        spill_dir: str = AUDIT_LOG_SPILL_DIR,
+        segment_bytes: int = AUDIT_LOG_SPILL_SEGMENT_BYTES,
+        fsync: bool = AUDIT_LOG_FSYNC,
+        session_factory=SessionLocal,
+    ):
+        self.enabled = enabled
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = float(flush_interval)
+        self.spill_dir = spill_dir
+        self.segment_bytes = int(segment_bytes)
+        self.fsync = fsync
+        self.session_factory = session_factory
+
+        self._queue: "queue.Queue[Tuple[int, Dict[str, Any]]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._segments: Dict[int, _SpillSegment] = {}
+        self._current: Optional[_SpillSegment] = None
+        # スピルファイル名に入れるこのプロセスの識別子（fork 後の start で決める）
+        self._owner = ""
+        self._next_seq = 0
+        self._stop = threading.Event()
+        self._stop_deadline = 0.0
+        self._thread: Optional[threading.Thread] = None
+        self.flushed_rows = 0
+        self.failed_flushes = 0
+
+    # ---------------- 投入側 ----------------
+    def submit(self, rows: List[Dict[str, Any]]) -> None:
+        """ヘッダのコミット後に呼ぶ。スピルへ追記してからキューに積む"""
+        if not rows:
+            return
+        now = datetime.now(timezone.utc)
+        rows = [{**row, "created_at": row.get("created_at") or now} for row in rows]
+        payload = "".join(_encode(row) + "\n" for row in rows)
+        with self._lock:
+            segment = self._writable_segment()
+            segment.file.write(payload)
+            segment.file.flush()
+            if self.fsync:
+                os.fsync(segment.file.fileno())
+            segment.written += len(rows)
+            seq = segment.seq
+        for row in rows:
+            self._queue.put((seq, row))
+
+    def _writable_segment(self) -> _SpillSegment:
+        # ロック取得済みで呼ぶこと
+        current = self._current
+        if current is not None and current.file.tell() < self.segment_bytes:
+            return current
+        if current is not None:
+            current.closed = True
+            self._maybe_remove(current)
+        if not self._owner:
+            self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        segment = _SpillSegment(self.spill_dir, self._owner, self._next_seq)
+        self._next_seq += 1
+        self._segments[segment.seq] = segment
+        self._current = segment
+        return segment
+
+    def _maybe_remove(self, segment: _SpillSegment) -> None:
+        # ロック取得済みで呼ぶこと。ファイルのロックは削除してから外す
+        if segment.closed and segment.committed >= segment.written:
+            self._segments.pop(segment.seq, None)
+            try:
+                os.remove(segment.path)
+            except FileNotFoundError:
+                pass
+            segment.file.close()
+
+    def _mark_committed(self, seqs: List[int]) -> None:
+        with self._lock:
+            for seq in seqs:
+                segment = self._segments.get(seq)
+                if segment is not None:
+                    segment.committed += 1
+            for segment in list(self._segments.values()):
+                if segment is self._current and segment.committed >= segment.written and segment.written:
+                    # 現在のファイルも全件反映済みなら切り替えて削除（スピルを伸ばし続けない）
+                    segment.closed = True
+                    self._current = None
+                self._maybe_remove(segment)
+
+    # ---------------- 書き出し側 ----------------
+    def _insert(self, rows: List[Dict[str, Any]]) -> None:
+        db = self.session_factory()
+        try:
+            db.execute(insert(TanabotaActionLog), rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _take_batch(self, timeout: float) -> List[Tuple[int, Dict[str, Any]]]:
+        batch: List[Tuple[int, Dict[str, Any]]] = []
+        deadline = time.monotonic() + timeout
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+        return batch
+
+    def _flush_batch(self, batch: List[Tuple[int, Dict[str, Any]]]) -> None:
+        """成功するまで再試行する（停止要求中でも行は捨てない。最終的にはスピルから復旧できる）"""
+        while True:
+            try:
+                self._insert([row for _, row in batch])
+                break
+            except Exception as e:
+                self.failed_flushes += 1
+                print(f"⚠️  監査ログの書き込みに失敗しました（再試行します）: {e}")
+                if self._stop_deadline_passed():
+                    return
+                time.sleep(AUDIT_LOG_RETRY_INTERVAL)
+        self.flushed_rows += len(batch)
+        self._mark_committed([seq for seq, _ in batch])
+
+    def _run(self) -> None:
+        while True:
+            batch = self._take_batch(self.flush_interval)
+            if batch:
+                self._flush_batch(batch)
+            elif self._stop.is_set():
+                return
+
+    def _stop_deadline_passed(self) -> bool:
+        return self._stop_deadline > 0 and time.monotonic() >= self._stop_deadline
+
+    # ---------------- ライフサイクル ----------------
+    def start(self) -> None:
+        """スピルに残った行を反映してから書き出しスレッドを起動する"""
+        if not self.enabled or self._thread is not None:
+            return
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._next_seq = 0
+        self.recover()
+        self._stop.clear()
+        self._stop_deadline = 0.0
+        self._thread = threading.Thread(target=self._run, name="audit-log-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """キューを書き切ってから停止する（書き切れなかった行はスピルに残り、次回起動時に反映される）"""
+        if self._thread is None:
+            return
+        self._stop_deadline = time.monotonic() + timeout
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+        with self._lock:
+            for segment in list(self._segments.values()):
+                segment.closed = True
+                self._maybe_remove(segment)
+            # 書き切れなかったファイルはロックを外して残す（次に起動したワーカーが復旧する）
+            for segment in self._segments.values():
+                segment.file.close()
+            self._segments.clear()
+            self._current = None
+
+    def recover(self) -> int:
+        """
+        持ち主の居ないスピル（落ちたプロセス・停止したワーカーの分）を読み、DBに無い行だけを投入する。
+        動いている他ワーカーのファイルはロックが取れないので触らない。投入した行数を返す
+        """
+        names = sorted(
+            name for name in os.listdir(self.spill_dir)
+            if name.startswith(_SPILL_PREFIX) and name.endswith(_SPILL_SUFFIX)
+            and not name.startswith(f"{_SPILL_PREFIX}{self._owner}-")
+        )
+        inserted = 0
+        seen: Set[Tuple[int, int]] = set()
+        for name in names:
+            path = os.path.join(self.spill_dir, name)
+            try:
+                f = open(path, encoding="utf-8")
+            except FileNotFoundError:
+                continue  # 持ち主が削除・改名した
+            with f:
+                if not _is_orphan(name, f):
+                    continue
+                # 書き込み途中で落ちた最終行は読み捨てる
+                rows = []
+                for line in f:
+                    try:
+                        rows.append(_decode(line))
+                    except (ValueError, KeyError):
+                        continue
+                for start in range(0, len(rows), self.batch_size):
+                    inserted += self._insert_missing(rows[start:start + self.batch_size], seen)
+                # ロックを持ったまま消す（他ワーカーの復旧と重ならない）
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        return inserted
+
+    def _insert_missing(self, rows: List[Dict[str, Any]], seen: Set[Tuple[int, int]]) -> int:
+        keys = {(r["transaction_id"], r["rule_id"]) for r in rows} - seen
+        db = self.session_factory()
+        try:
+            existing: Set[Tuple[int, int]] = set(db.execute(
+                select(TanabotaActionLog.transaction_id, TanabotaActionLog.rule_id)
+                .where(tuple_(TanabotaActionLog.transaction_id, TanabotaActionLog.rule_id).in_(list(keys)))
+            ).tuples())
+        finally:
+            db.close()
+        seen.update(existing)
+        missing = []
+        for r in rows:
+            key = (r["transaction_id"], r["rule_id"])
+            if key not in seen:
+                seen.add(key)  # スピル内の重複（再投入済みの行）も除く
+                missing.append(r)
+        if missing:
+            self._insert(missing)
+        return len(missing)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            spilled = sum(s.written - s.committed for s in self._segments.values())
+        return {
+            "enabled": self.enabled,
+            "queued": self._queue.qsize(),
+            "spilled_pending": spilled,
+            "flushed_rows": self.flushed_rows,
+            "failed_flushes": self.failed_flushes,
+        }
+
+
+audit_log_writer = AuditLogWriter()
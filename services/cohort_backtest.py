@@ -0,0 +1,389 @@
+"""
+大規模コホートのバックテスト（「ユーザー10万人がテンプレートXを使っていたら」の試算）
+services.simulator と同じベクトル評価（services.vectorized_engine）を、全ユーザーの支払い履歴に対して
+プロセスプールで並列に行い、テンプレートごとの集計とユーザー別の結果を出す（DBには何も書き込まない）。
+- 親プロセス: ユーザーIDを CHUNK 人ずつ読み、その分の支払い履歴だけをストリーミングで取得して
+  共有メモリ（支払額 int64 + ユーザー境界のオフセット）へ書き、ワーカーへ渡す
+- ワーカー: テンプレートのルールを起動時に1回だけコンパイルし、チャンク全体を一括評価して
+  ユーザー別の合計へ畳み込む（同じルールは複数テンプレートで使い回す）
+- 実行中のチャンクはワーカー数の2倍までに抑え、投入した順にユーザー別の結果をファイルへ書き出す
+  （メモリに載るのは実行中のチャンクとユーザー別合計の配列だけ）
+使い方: python -m services.cohort_backtest --templates 1 2 --days 365 --workers 8 --output out.ndjson
+取引ヘッダにはカテゴリが無いため、カテゴリ系トリガーは発火しない（simulator と同じ）。
+デモ用の強制発火も含めない。
+"""
+from __future__ import annotations
+
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from multiprocessing import shared_memory
+from typing import Any, Callable, Deque, Dict, IO, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from models import EVENT_KIND_PAYMENT, TanabotaTransaction, User
+from services.rng import derive_seed, numpy_rng
+from services.simulator import DEFAULT_LOOKBACK_DAYS, load_template_rules, public_recipe_template_ids
+from services.vectorized_engine import PaymentArrays, VectorRule
+
+# 1チャンクのユーザー数（= 共有メモリ1ブロック・ワーカーへの1タスク）
+BACKTEST_CHUNK_USERS = int(os.getenv("BACKTEST_CHUNK_USERS", "2000"))
+# ワーカープロセス数（既定はCPU数）
+BACKTEST_WORKERS = int(os.getenv("BACKTEST_WORKERS", "0")) or (os.cpu_count() or 1)
+# 履歴を読むときの1回あたりの取得件数
+BACKTEST_FETCH_SIZE = 10000
+
+
+class RuleSpec:
+    """ワーカーへ渡すルール定義（CompiledRule は評価関数を持つため pickle できない。ワーカー側で VectorRule にする）"""
+    __slots__ = (
+        "rule_id", "name", "action_id", "action_type", "trigger_id", "trigger_name", "trigger_params", "action_params",
+    )
+
+    def __init__(self, rule: Any, name: str):
+        self.rule_id: int = rule.rule_id
+        self.name = name
+        self.action_id: int = rule.action_id
+        self.action_type: str = rule.action_type
+        self.trigger_id: int = rule.trigger_id
+        self.trigger_name: str = rule.trigger_name
+        self.trigger_params: Dict[str, Any] = rule.trigger_params
+        self.action_params: Dict[str, Any] = rule.action_params
+
+
+# ------------------------------------------------------------
+# ワーカー側
+# ------------------------------------------------------------
+# ワーカープロセスごとのコンパイル済みルール（_init_worker で設定）
+_worker_rules: Dict[int, VectorRule] = {}
+_worker_templates: Dict[int, List[int]] = {}
+
+
+def _init_worker(templates: Dict[int, List[RuleSpec]]) -> None:
+    _worker_rules.clear()
+    _worker_templates.clear()
+    for template_id, specs in templates.items():
+        for spec in specs:
+            if spec.rule_id not in _worker_rules:
+                _worker_rules[spec.rule_id] = VectorRule(spec)
+        _worker_templates[template_id] = [spec.rule_id for spec in specs]
+
+
+def _per_user(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """支払い単位の値をユーザー単位の合計へ（累積和の差分。支払いの無いユーザーは 0）"""
+    cumsum = np.concatenate(([0], np.cumsum(values, dtype=np.int64)))
+    return cumsum[offsets[1:]] - cumsum[offsets[:-1]]
+
+
+def _evaluate_chunk(
+    shm_name: str, payment_count: int, user_count: int, seed: Optional[int], chunk_index: int
+) -> Dict[str, Any]:
+    """
+    共有メモリのチャンクを評価する。返り値:
+    {"users": {"payment_count", "amount_paid_total"}, "templates": {template_id: {"saved", "fired", "rules"}}}
+    saved / fired はユーザー別の配列、rules は rule_id → (発火件数, たなぼた合計)
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        buf = np.ndarray((payment_count + user_count + 1,), dtype=np.int64, buffer=shm.buf)
+        amounts = buf[:payment_count]
+        offsets = buf[payment_count:]
+        payments = PaymentArrays(amounts)
+        rng = numpy_rng(seed, "cohort_backtest", chunk_index)
+
+        per_rule = {rule_id: rule.evaluate(payments, rng) for rule_id, rule in _worker_rules.items()}
+        templates: Dict[int, Dict[str, Any]] = {}
+        for template_id, rule_ids in _worker_templates.items():
+            saved = np.zeros(payment_count, dtype=np.int64)
+            rules: Dict[int, Tuple[int, int]] = {}
+            for rule_id in rule_ids:
+                values = per_rule[rule_id]
+                saved += values
+                rules[rule_id] = (int(np.count_nonzero(values)), int(values.sum()))
+            templates[template_id] = {
+                "saved": _per_user(saved, offsets),
+                "fired": _per_user((saved > 0).astype(np.int64), offsets),
+                "rules": rules,
+            }
+        result = {
+            "users": {
+                "payment_count": np.diff(offsets),
+                "amount_paid_total": _per_user(amounts, offsets),
+            },
+            "templates": templates,
+        }
+        # 共有メモリを閉じる前にビューを手放す
+        del buf, amounts, offsets, payments, per_rule
+        return result
+    finally:
+        shm.close()
+
+
+# ------------------------------------------------------------
+# 親プロセス側：入力のストリーミング
+# ------------------------------------------------------------
+def iter_user_chunks(
+    db: Session, chunk_users: int, user_ids: Optional[Sequence[int]] = None
+) -> Iterator[np.ndarray]:
+    """対象ユーザーIDを昇順に chunk_users 人ずつ返す（user_ids=None で全ユーザー）"""
+    if user_ids is not None:
+        ids = np.unique(np.asarray(user_ids, dtype=np.int64))
+        for start in range(0, len(ids), chunk_users):
+            yield ids[start:start + chunk_users]
+        return
+    stmt = select(User.id).order_by(User.id).execution_options(yield_per=chunk_users)
+    for part in db.execute(stmt).partitions():
+        yield np.fromiter((row[0] for row in part), dtype=np.int64, count=len(part))
+
+
+def _history_query(user_ids: np.ndarray, since: Optional[datetime]):
+    stmt = (
+        select(TanabotaTransaction.user_id, TanabotaTransaction.amount_paid)
+        .where(
+            TanabotaTransaction.user_id.in_(user_ids.tolist()),
+            TanabotaTransaction.event_kind == EVENT_KIND_PAYMENT,  # 入金などの記録は支払いとして再生しない
+        )
+        .order_by(TanabotaTransaction.user_id, TanabotaTransaction.id)
+    )
+    if since is not None:
+        stmt = stmt.where(TanabotaTransaction.created_at >= since)
+    return stmt.execution_options(yield_per=BACKTEST_FETCH_SIZE)
+
+
+def load_chunk(
+    db: Session, user_ids: np.ndarray, since: Optional[datetime]
+) -> Tuple[shared_memory.SharedMemory, int]:
+    """
+    チャンクのユーザーの支払い履歴を共有メモリへ書き、(共有メモリ, 支払い件数) を返す。
+    レイアウト: [支払額 × 支払い件数][ユーザー境界オフセット × (ユーザー数 + 1)]（いずれも int64）
+    """
+    owners: List[np.ndarray] = []
+    amounts: List[np.ndarray] = []
+    for part in db.execute(_history_query(user_ids, since)).partitions():
+        owners.append(np.fromiter((row[0] for row in part), dtype=np.int64, count=len(part)))
+        amounts.append(np.fromiter((int(row[1]) for row in part), dtype=np.int64, count=len(part)))
+    # 履歴用の接続でトランザクションを開きっぱなしにしない
+    db.rollback()
+    owner = np.concatenate(owners) if owners else np.zeros(0, dtype=np.int64)
+    offsets = np.append(np.searchsorted(owner, user_ids, side="left"), len(owner)).astype(np.int64)
+
+    size = (len(owner) + len(offsets)) * np.dtype(np.int64).itemsize
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    buf = np.ndarray((len(owner) + len(offsets),), dtype=np.int64, buffer=shm.buf)
+    if amounts:
+        np.concatenate(amounts, out=buf[:len(owner)])
+    buf[len(owner):] = offsets
+    del buf
+    return shm, len(owner)
+
+
+# ------------------------------------------------------------
+# 親プロセス側：集計
+# ------------------------------------------------------------
+class TemplateAggregate:
+    """テンプレート1件分の集計（チャンクの結果を順に足し込む）"""
+
+    def __init__(self, template_id: int, specs: List[RuleSpec]):
+        self.template_id = template_id
+        self.specs = specs
+        self.user_count = 0
+        self.saving_user_count = 0
+        self.payment_count = 0
+        self.amount_paid_total = 0
+        self.tanabota_total = 0
+        self.fired_payment_count = 0
+        self.rules: Dict[int, List[int]] = {spec.rule_id: [0, 0] for spec in specs}
+        self._per_user: List[np.ndarray] = []
+
+    def add(self, users: Dict[str, np.ndarray], template: Dict[str, Any]) -> None:
+        saved: np.ndarray = template["saved"]
+        self.user_count += len(saved)
+        self.saving_user_count += int(np.count_nonzero(saved))
+        self.payment_count += int(users["payment_count"].sum())
+        self.amount_paid_total += int(users["amount_paid_total"].sum())
+        self.tanabota_total += int(saved.sum())
+        self.fired_payment_count += int(template["fired"].sum())
+        for rule_id, (fired, total) in template["rules"].items():
+            self.rules[rule_id][0] += fired
+            self.rules[rule_id][1] += total
+        self._per_user.append(saved)
+
+    def result(self) -> Dict[str, Any]:
+        per_user = np.concatenate(self._per_user) if self._per_user else np.zeros(0, dtype=np.int64)
+        p50, p90, p99 = (int(v) for v in np.percentile(per_user, [50, 90, 99], method="lower")) if len(per_user) else (0, 0, 0)
+        return {
+            "recipe_template_id": self.template_id,
+            "user_count": self.user_count,
+            "saving_user_count": self.saving_user_count,
+            "payment_count": self.payment_count,
+            "amount_paid_total": self.amount_paid_total,
+            "tanabota_total": self.tanabota_total,
+            "fired_payment_count": self.fired_payment_count,
+            "tanabota_per_user": {
+                "mean": round(self.tanabota_total / self.user_count, 2) if self.user_count else 0,
+                "p50": p50,
+                "p90": p90,
+                "p99": p99,
+                "max": int(per_user.max()) if len(per_user) else 0,
+            },
+            "rules": [
+                {
+                    "rule_template_id": spec.rule_id,
+                    "name": spec.name,
+                    "action_type": spec.action_type,
+                    "fired_count": self.rules[spec.rule_id][0],
+                    "tanabota_total": self.rules[spec.rule_id][1],
+                }
+                for spec in self.specs
+            ],
+        }
+
+
+def _write_user_rows(out: IO[str], user_ids: np.ndarray, result: Dict[str, Any]) -> None:
+    """ユーザー × テンプレート 1行の NDJSON"""
+    users = result["users"]
+    lines: List[str] = []
+    for template_id, template in result["templates"].items():
+        for uid, count, paid, saved, fired in zip(
+            user_ids.tolist(),
+            users["payment_count"].tolist(),
+            users["amount_paid_total"].tolist(),
+            template["saved"].tolist(),
+            template["fired"].tolist(),
+        ):
+            lines.append(json.dumps({
+                "user_id": uid,
+                "recipe_template_id": template_id,
+                "payment_count": count,
+                "amount_paid_total": paid,
+                "tanabota_total": saved,
+                "fired_payment_count": fired,
+            }, separators=(",", ":")))
+    if lines:
+        out.write("\n".join(lines) + "\n")
+
+
+# ------------------------------------------------------------
+# 公開API
+# ------------------------------------------------------------
+def run_cohort_backtest(
+    template_ids: Optional[Sequence[int]] = None,
+    *,
+    user_ids: Optional[Sequence[int]] = None,
+    days: Optional[int] = DEFAULT_LOOKBACK_DAYS,
+    workers: int = BACKTEST_WORKERS,
+    chunk_users: int = BACKTEST_CHUNK_USERS,
+    seed: Optional[int] = None,
+    output: Optional[IO[str]] = None,
+    session_factory: Callable[[], Session] = SessionLocal,
+) -> Dict[str, Any]:
+    """
+    テンプレート群（None なら公開テンプレート全件）をコホート（None なら全ユーザー）の履歴で試算する。
+    output を渡すとユーザー × テンプレートの結果を NDJSON でチャンクの順に書き出す。
+    seed を渡すと（ワーカー数によらず）チャンク単位で決定的になる。
+    存在しない（ルールを持たない）テンプレートIDは ValueError。
+    返り値: {"templates": [テンプレートごとの集計], "user_count", "chunks", "elapsed_seconds"}
+    """
+    started = time.perf_counter()
+    since = datetime.now(timezone.utc) - timedelta(days=days) if days is not None and days > 0 else None
+    user_db = session_factory()
+    history_db = session_factory()
+    try:
+        ids = list(dict.fromkeys(template_ids or public_recipe_template_ids(user_db)))
+        loaded = load_template_rules(user_db, ids)
+        missing = [tid for tid in ids if tid not in loaded]
+        if missing:
+            raise ValueError(f"レシピテンプレート（ルールあり）が見つかりません: {missing}")
+        templates = {tid: [RuleSpec(rule, name) for rule, name in loaded[tid]] for tid in ids}
+        aggregates = {tid: TemplateAggregate(tid, specs) for tid, specs in templates.items()}
+
+        stats = {"user_count": 0, "chunks": 0}
+        pending: Deque[Tuple[Future, shared_memory.SharedMemory, np.ndarray]] = deque()
+
+        def drain_one() -> None:
+            future, shm, chunk_ids = pending.popleft()
+            try:
+                result = future.result()
+            finally:
+                shm.close()
+                shm.unlink()
+            for tid, template in result["templates"].items():
+                aggregates[tid].add(result["users"], template)
+            if output is not None:
+                _write_user_rows(output, chunk_ids, result)
+            stats["user_count"] += len(chunk_ids)
+            stats["chunks"] += 1
+
+        workers = max(1, int(workers))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(templates,)) as pool:
+            try:
+                for index, chunk_ids in enumerate(iter_user_chunks(user_db, max(1, int(chunk_users)), user_ids)):
+                    shm, payment_count = load_chunk(history_db, chunk_ids, since)
+                    chunk_seed = derive_seed(seed, "cohort_backtest", index) if seed is not None else None
+                    try:
+                        future = pool.submit(_evaluate_chunk, shm.name, payment_count, len(chunk_ids), chunk_seed, index)
+                    except Exception:
+                        shm.close()
+                        shm.unlink()
+                        raise
+                    pending.append((future, shm, chunk_ids))
+                    # 実行中のチャンクを抑えてメモリを一定に保つ（完了順ではなく投入順に書き出す）
+                    while len(pending) >= workers * 2:
+                        drain_one()
+                while pending:
+                    drain_one()
+            finally:
+                for future, shm, _ in pending:
+                    future.cancel()
+                    shm.close()
+                    shm.unlink()
+    finally:
+        history_db.close()
+        user_db.close()
+
+    return {
+        "templates": [aggregates[tid].result() for tid in ids],
+        "user_count": stats["user_count"],
+        "chunks": stats["chunks"],
+        "workers": workers,
+        "elapsed_seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="レシピテンプレートを全ユーザー（コホート）の支払い履歴で並列に試算する")
+    parser.add_argument("--templates", type=int, nargs="*", help="レシピテンプレートID（省略時は公開テンプレート全件）")
+    parser.add_argument("--user-id", type=int, nargs="*", help="対象ユーザー（省略時は全ユーザー）")
+    parser.add_argument("--days", type=int, default=DEFAULT_LOOKBACK_DAYS, help="遡る日数（0 で全期間）")
+    parser.add_argument("--workers", type=int, default=BACKTEST_WORKERS)
+    parser.add_argument("--chunk-users", type=int, default=BACKTEST_CHUNK_USERS)
+    parser.add_argument("--seed", type=int, help="乱数シード（ガチャ・random_range を再現する）")
+    parser.add_argument("--output", help="ユーザー別の結果（NDJSON）の書き出し先")
+    args = parser.parse_args()
+
+    out = open(args.output, "w", encoding="utf-8") if args.output else None
+    try:
+        summary = run_cohort_backtest(
+            args.templates or None,
+            user_ids=args.user_id or None,
+            days=args.days,
+            workers=args.workers,
+            chunk_users=args.chunk_users,
+            seed=args.seed,
+            output=out,
+        )
+    finally:
+        if out is not None:
+            out.close()
+    json.dump(summary, sys.stdout, ensure_ascii=False, indent=2)
+    print()
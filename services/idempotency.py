@@ -0,0 +1,216 @@
+"""
+POS決済の冪等キー管理
+Idempotency-Key ごとに初回の応答を保持し、リトライには保存済みの応答を返す。
+- プロセス内: 件数上限・TTL付きのLRU（ヒット時はDBアクセスなし）
+- 永続化: pos_idempotency_keys テーブル（取引と同じトランザクションで保存）
+- 同一キーの同時リクエストは1件だけ実行し、残りはその完了を待って同じ応答を返す
+- 保存済み応答の保持期間は IDEMPOTENCY_RETENTION_HOURS（既定24時間。created_at 基準）
+  期限切れのキーは参照時に消して新しいリクエストとして扱い、残りは定期ジョブで削除する
+  （python -m services.idempotency [--hours N]。cron 等で定期実行する）
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from models import PosIdempotencyKey
+
+# 保存済み応答を保持する時間（これを過ぎた同じキーは新しいリクエストとして処理する）
+IDEMPOTENCY_RETENTION_HOURS = float(os.getenv("IDEMPOTENCY_RETENTION_HOURS", "24"))
+# 期限切れキーの削除を1トランザクションで行う件数
+IDEMPOTENCY_PURGE_BATCH_SIZE = int(os.getenv("IDEMPOTENCY_PURGE_BATCH_SIZE", "1000"))
+# プロセス内に保持するキー数（LRUで追い出し）
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+# プロセス内キャッシュの保持秒数（DBの保持期間より長くはしない）
+IDEMPOTENCY_CACHE_TTL = min(
+    float(os.getenv("IDEMPOTENCY_CACHE_TTL", "86400")), IDEMPOTENCY_RETENTION_HOURS * 3600
+)
+# 同一キーの先行リクエストを待つ最大秒数
+IDEMPOTENCY_WAIT_TIMEOUT = float(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT", "10"))
+
+
+class IdempotencyConflict(Exception):
+    """同じキーが別内容のリクエストで使われた"""
+
+
+class IdempotencyInProgress(Exception):
+    """同じキーの先行リクエストが待ち時間内に終わらなかった"""
+
+
+def request_fingerprint(user_id: int, amount: int, category: Optional[str]) -> str:
+    payload = json.dumps([int(user_id), int(amount), category], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class IdempotencyCache:
+    """Idempotency-Key → (指紋, 応答) のスレッドセーフなLRU＋実行中キーの合流"""
+
+    def __init__(self, maxsize: int = IDEMPOTENCY_CACHE_SIZE, ttl_seconds: float = IDEMPOTENCY_CACHE_TTL):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl_seconds = float(ttl_seconds)
+        self._entries: "OrderedDict[str, Tuple[str, Dict[str, Any], float]]" = OrderedDict()
+        self._inflight: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key: str, now: float) -> Optional[Tuple[str, Dict[str, Any]]]:
+        # ロック取得済みで呼ぶこと
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        fingerprint, response, expires_at = entry
+        if expires_at > 0 and now >= expires_at:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return fingerprint, response
+
+    def acquire(self, key: str, timeout: float = IDEMPOTENCY_WAIT_TIMEOUT) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """
+        保存済みなら (指紋, 応答) を返す。無ければ実行権を取って None を返す
+        （None を受け取った側は必ず release すること）。
+        同じキーを実行中のスレッドがあれば、その完了まで待つ。
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                found = self._lookup(key, time.monotonic())
+                if found is not None:
+                    return found
+                event = self._inflight.get(key)
+                if event is None:
+                    self._inflight[key] = threading.Event()
+                    return None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not event.wait(remaining):
+                raise IdempotencyInProgress(key)
+            # 先行リクエストが失敗した場合は次の周回で実行権を取り直す
+
+    def release(self, key: str, stored: Optional[Tuple[str, Dict[str, Any]]] = None) -> None:
+        """実行権を返す。stored を渡せば応答を保存し、待っているリクエストに返す"""
+        with self._lock:
+            if stored is not None:
+                self._store(key, *stored)
+            event = self._inflight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def _store(self, key: str, fingerprint: str, response: Dict[str, Any]) -> None:
+        # ロック取得済みで呼ぶこと
+        expires_at = (time.monotonic() + self.ttl_seconds) if self.ttl_seconds > 0 else 0.0
+        self._entries[key] = (fingerprint, response, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._entries), "maxsize": self.maxsize, "inflight": len(self._inflight)}
+
+
+idempotency_cache = IdempotencyCache()
+
+
+# ------------------------------------------------------------
+# DB 永続化
+# ------------------------------------------------------------
+def retention_cutoff(now: Optional[datetime] = None) -> datetime:
+    """これより前に作られたキーは期限切れ（DateTime 列はタイムゾーン無し（UTC）で保存されている）"""
+    now = now or datetime.now(timezone.utc)
+    cutoff = now - timedelta(hours=IDEMPOTENCY_RETENTION_HOURS)
+    return cutoff.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def load_stored_response(db: Session, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """
+    保存済みの (指紋, 応答)。期限切れなら行を消して None を返す
+    （削除はこれから行う決済と同じトランザクションでコミットされ、同じキーで保存し直せる）
+    """
+    row = db.get(PosIdempotencyKey, key)
+    if row is None:
+        return None
+    if row.created_at is not None and row.created_at < retention_cutoff():
+        db.delete(row)
+        db.flush()
+        return None
+    return row.request_hash, dict(row.response_json)
+
+
+def save_response(
+    db: Session,
+    key: str,
+    *,
+    user_id: int,
+    fingerprint: str,
+    transaction_id: int,
+    response: Dict[str, Any],
+) -> None:
+    """取引と同じトランザクションで応答を保存する（コミットは呼び出し側）"""
+    db.add(PosIdempotencyKey(
+        idempotency_key=key,
+        user_id=user_id,
+        request_hash=fingerprint,
+        transaction_id=transaction_id,
+        response_json=response,
+    ))
+
+
+def check_fingerprint(stored: Tuple[str, Dict[str, Any]], fingerprint: str) -> Dict[str, Any]:
+    """保存済み応答を返す。別内容のリクエストなら IdempotencyConflict"""
+    stored_fingerprint, response = stored
+    if stored_fingerprint != fingerprint:
+        raise IdempotencyConflict("Idempotency-Key is already used for a different request")
+    return response
+
+
+def purge_expired_keys(
+    *,
+    older_than: Optional[datetime] = None,
+    batch_size: int = IDEMPOTENCY_PURGE_BATCH_SIZE,
+    session_factory: Callable[[], Session] = SessionLocal,
+) -> int:
+    """older_than（既定: 保持期間の境目）より前に作られたキーをバッチごとにコミットしながら消し、件数を返す"""
+    cutoff = retention_cutoff() if older_than is None else older_than.astimezone(timezone.utc).replace(tzinfo=None)
+    purged = 0
+    db = session_factory()
+    try:
+        while True:
+            keys = db.execute(
+                select(PosIdempotencyKey.idempotency_key)
+                .where(PosIdempotencyKey.created_at < cutoff)
+                .limit(batch_size)
+            ).scalars().all()
+            if not keys:
+                return purged
+            db.execute(delete(PosIdempotencyKey).where(PosIdempotencyKey.idempotency_key.in_(keys)))
+            db.commit()
+            purged += len(keys)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="保持期間を過ぎた冪等キーを削除する")
+    parser.add_argument("--hours", type=float, default=IDEMPOTENCY_RETENTION_HOURS, help="保持する時間")
+    parser.add_argument("--batch-size", type=int, default=IDEMPOTENCY_PURGE_BATCH_SIZE)
+    args = parser.parse_args()
+
+    count = purge_expired_keys(
+        older_than=datetime.now(timezone.utc) - timedelta(hours=args.hours),
+        batch_size=args.batch_size,
+    )
+    print(f"✅ 期限切れの冪等キーを {count} 件削除しました")
@@ -7,6 +7,10 @@ import openai
 from typing import List, Optional, Any
 from .prompt_templates import FinancialAnalysisPrompts
 
+# API呼び出しのタイムアウト（秒）と再試行回数（ライブラリ既定の600秒では遅い応答にワーカーが張り付く）
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "30"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+
 
 class OpenAIService:
     """OpenAI API呼び出しを管理するサービスクラス"""
@@ -20,9 +24,21 @@ class OpenAIService:
         """
         self.api_key = api_key or os.getenv("OPENAI_API_KEY")
         self.client = None
+        self._async_client = None
         
         if self.api_key:
-            self.client = openai.OpenAI(api_key=self.api_key)
+            self.client = openai.OpenAI(
+                api_key=self.api_key, timeout=OPENAI_TIMEOUT_SECONDS, max_retries=OPENAI_MAX_RETRIES
+            )
+
+    @property
+    def async_client(self) -> Optional[openai.AsyncOpenAI]:
+        """非同期クライアント（初回利用時に作成。イベントループ上の呼び出し用）"""
+        if self._async_client is None and self.api_key:
+            self._async_client = openai.AsyncOpenAI(
+                api_key=self.api_key, timeout=OPENAI_TIMEOUT_SECONDS, max_retries=OPENAI_MAX_RETRIES
+            )
+        return self._async_client
     
     def _format_user_preferences(self, preference_entities) -> str:
         """
@@ -58,6 +74,65 @@ class OpenAIService:
                     formatted_transaction_summary += f"カテゴリ: {category}, 金額: {amount}円\n"
         return formatted_transaction_summary
     
+    def _financial_insight_messages(self, preference_entities, financial_transactions: Any) -> List[dict]:
+        """
+        財務インサイト生成のメッセージを組み立てる
+        
+        Args:
+            preference_entities: ユーザーの設定データ
+            financial_transactions: 取引データ（辞書 {income:[], expense:[]} or 配列 [..]）
+            
+        Returns:
+            List[dict]: chat.completions に渡すメッセージ
+        """
+        # 取引データを正規化（辞書 {income:[], expense:[]} or 配列 [..] の両方に対応）
+        normalized_transactions: List[dict] = []
+        try:
+            if isinstance(financial_transactions, dict):
+                income_list = financial_transactions.get("income") or []
+                expense_list = financial_transactions.get("expense") or []
+                if isinstance(income_list, list):
+                    normalized_transactions.extend(income_list)
+                if isinstance(expense_list, list):
+                    normalized_transactions.extend(expense_list)
+            elif isinstance(financial_transactions, list):
+                normalized_transactions = financial_transactions
+        except Exception:
+            normalized_transactions = []
+
+        # データをフォーマット
+        formatted_user_preferences = self._format_user_preferences(preference_entities)
+        formatted_transaction_summary = self._format_transaction_summary(normalized_transactions)
+        
+        # プロンプトを生成
+        analysis_prompt = FinancialAnalysisPrompts.get_financial_insight_prompt(
+            formatted_user_preferences, formatted_transaction_summary
+        )
+        return [{"role": "user", "content": analysis_prompt}]
+
+    def _parse_insights(self, response_content: Optional[str]) -> List[str]:
+        """
+        レスポンスからinsightsを抽出
+        
+        Args:
+            response_content: APIレスポンスの本文（JSON）
+            
+        Returns:
+            List[str]: インサイトのリスト（解析できなければエラー時のインサイト）
+        """
+        try:
+            parsed_json_response = json.loads(response_content)
+            generated_insights = parsed_json_response.get("insights", [])
+            
+            if not generated_insights:  # insightsが空の場合
+                return FinancialAnalysisPrompts.get_json_parse_error_insights()
+                
+            return generated_insights
+            
+        except json.JSONDecodeError as json_error:
+            print(f"JSONパースエラー: {json_error}")
+            return FinancialAnalysisPrompts.get_json_parse_error_insights()
+
     def generate_financial_insights(self, preference_entities, financial_transactions: Any) -> List[str]:
         """
         財務インサイトを生成
@@ -75,55 +150,48 @@ class OpenAIService:
             return FinancialAnalysisPrompts.get_fallback_insights()
         
         try:
-            # 取引データを正規化（辞書 {income:[], expense:[]} or 配列 [..] の両方に対応）
-            normalized_transactions: List[dict] = []
-            try:
-                if isinstance(financial_transactions, dict):
-                    income_list = financial_transactions.get("income") or []
-                    expense_list = financial_transactions.get("expense") or []
-                    if isinstance(income_list, list):
-                        normalized_transactions.extend(income_list)
-                    if isinstance(expense_list, list):
-                        normalized_transactions.extend(expense_list)
-                elif isinstance(financial_transactions, list):
-                    normalized_transactions = financial_transactions
-            except Exception:
-                normalized_transactions = []
-
-            # データをフォーマット
-            formatted_user_preferences = self._format_user_preferences(preference_entities)
-            formatted_transaction_summary = self._format_transaction_summary(normalized_transactions)
-            
-            # プロンプトを生成
-            analysis_prompt = FinancialAnalysisPrompts.get_financial_insight_prompt(
-                formatted_user_preferences, formatted_transaction_summary
-            )
-            
             # OpenAI APIを呼び出し
             api_response = self.client.chat.completions.create(
                 model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "user", "content": analysis_prompt}
-                ],
+                messages=self._financial_insight_messages(preference_entities, financial_transactions),
                 max_tokens=500,
                 temperature=0.7
             )
-            
-            # レスポンスからinsightsを抽出
-            response_content = api_response.choices[0].message.content
-            
-            try:
-                parsed_json_response = json.loads(response_content)
-                generated_insights = parsed_json_response.get("insights", [])
-                
-                if not generated_insights:  # insightsが空の場合
-                    return FinancialAnalysisPrompts.get_json_parse_error_insights()
-                    
-                return generated_insights
+            return self._parse_insights(api_response.choices[0].message.content)
                 
-            except json.JSONDecodeError as json_error:
-                print(f"JSONパースエラー: {json_error}")
-                return FinancialAnalysisPrompts.get_json_parse_error_insights()
+        except Exception as api_error:
+            print(f"OpenAI API呼び出しエラー: {api_error}")
+            return FinancialAnalysisPrompts.get_fallback_insights()
+
+    async def generate_financial_insights_async(
+        self, preference_entities, financial_transactions: Any, timeout: Optional[float] = None
+    ) -> List[str]:
+        """
+        generate_financial_insights の非同期版（イベントループを止めない）
+        
+        Args:
+            preference_entities: ユーザーの設定データ
+            financial_transactions: 取引データのリスト
+            timeout: この呼び出しのタイムアウト（秒）。指定がなければクライアントの既定
+            
+        Returns:
+            List[str]: 生成されたインサイトのリスト（失敗・タイムアウト時はフォールバック）
+        """
+        client = self.async_client
+        if not client:
+            print("OpenAI APIキーが設定されていません。フォールバックインサイトを返します。")
+            return FinancialAnalysisPrompts.get_fallback_insights()
+        
+        try:
+            if timeout is not None:
+                client = client.with_options(timeout=timeout)
+            api_response = await client.chat.completions.create(
+                model="gpt-3.5-turbo",
+                messages=self._financial_insight_messages(preference_entities, financial_transactions),
+                max_tokens=500,
+                temperature=0.7
+            )
+            return self._parse_insights(api_response.choices[0].message.content)
                 
         except Exception as api_error:
             print(f"OpenAI API呼び出しエラー: {api_error}")
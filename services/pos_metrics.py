@@ -0,0 +1,248 @@
+"""
+POS決済パイプラインの段階別計測
+1リクエストの中で「ユーザーロック待ち・ルール読込・評価・ログ行作成・書き込み・コミット」の各段階の所要時間と、
+評価・発火したルール数を集め、エンドポイント別のヒストグラムに積む（/pos/metrics で参照）。
+- POS_METRICS_ENABLED=false（既定）の間は計測しない（stage は共有の空コンテキストを返すだけ）
+- POS_SERVER_TIMING=true で各段階の時間を Server-Timing ヘッダでも返す
+- 計測はリクエスト単位（contextvars）なので、同期・非同期どちらのエンドポイントでも使える。
+  collect の外（スケジューラ等）から呼ばれた stage は何も記録しない
+"""
+from __future__ import annotations
+
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from fastapi import Response
+
+# ヒストグラムへの集計を行うか
+POS_METRICS_ENABLED = os.getenv("POS_METRICS_ENABLED", "false").lower() in ["true", "1", "yes"]
+# Server-Timing ヘッダを返すか（ヒストグラムとは独立に有効化できる）
+POS_SERVER_TIMING = os.getenv("POS_SERVER_TIMING", "false").lower() in ["true", "1", "yes"]
+
+# 段階名（Server-Timing のメトリクス名にもそのまま使う）
+STAGE_LOCK_WAIT = "lock_wait"    # プロセス内のユーザーロック待ち
+STAGE_ROW_LOCK = "row_lock"      # users 行の SELECT ... FOR UPDATE（待ち時間を含む）
+STAGE_LOAD_RULES = "load_rules"
+STAGE_EVALUATE = "evaluate"
+STAGE_BUILD_LOGS = "build_logs"
+STAGE_FLUSH = "flush"
+STAGE_COMMIT = "commit"
+
+# 所要時間（ミリ秒）のバケット上限
+LATENCY_BUCKETS_MS: Tuple[float, ...] = (
+    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+)
+# ルール数のバケット上限
+COUNT_BUCKETS: Tuple[float, ...] = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+_NOOP = nullcontext()
+
+
+class Histogram:
+    """固定バケットのヒストグラム（スレッドセーフ）。分位点はバケット上限で近似する"""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # 最後の1つは上限超え（+Inf）
+        self._counts = [0] * (len(buckets) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[idx] += 1
+            self._count += 1
+            self._sum += value
+            if value > self._max:
+                self._max = value
+
+    def _quantile(self, counts: List[int], total: int, q: float) -> Optional[float]:
+        if total == 0:
+            return None
+        rank = q * total
+        cumulative = 0
+        for upper, n in zip(self.buckets, counts):
+            cumulative += n
+            if cumulative >= rank:
+                return upper
+        return self._max
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = list(self._counts)
+            total, total_sum, max_value = self._count, self._sum, self._max
+        cumulative = 0
+        buckets: List[Dict[str, Any]] = []
+        for upper, n in zip(self.buckets, counts):
+            cumulative += n
+            buckets.append({"le": upper, "count": cumulative})
+        buckets.append({"le": "+Inf", "count": total})
+        return {
+            "count": total,
+            "sum": round(total_sum, 3),
+            "mean": round(total_sum / total, 3) if total else None,
+            "max": round(max_value, 3),
+            "p50": self._quantile(counts, total, 0.50),
+            "p95": self._quantile(counts, total, 0.95),
+            "p99": self._quantile(counts, total, 0.99),
+            "buckets": buckets,
+        }
+
+
+class RequestTimings:
+    """1リクエスト分の計測値（同じ段階を複数回通った場合は合算）"""
+    __slots__ = ("pipeline", "stages", "rules_evaluated", "rules_fired")
+
+    def __init__(self, pipeline: str):
+        self.pipeline = pipeline
+        # 段階名 → 秒（挿入順 = 通過順）
+        self.stages: Dict[str, float] = {}
+        self.rules_evaluated = 0
+        self.rules_fired = 0
+
+    def add(self, name: str, seconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in self.stages.items())
+
+
+class _Stage:
+    __slots__ = ("timings", "name", "started")
+
+    def __init__(self, timings: RequestTimings, name: str):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        self.timings.add(self.name, time.perf_counter() - self.started)
+
+
+_current: ContextVar[Optional[RequestTimings]] = ContextVar("pos_request_timings", default=None)
+
+
+def stage(name: str):
+    """with stage("evaluate"): ... の区間を計測する（collect の外では何もしない）"""
+    timings = _current.get()
+    if timings is None:
+        return _NOOP
+    return _Stage(timings, name)
+
+
+def count_rules(evaluated: int, fired: int) -> None:
+    """評価したルール数・発火（記録）したルール数を加算する（collect の外では何もしない）"""
+    timings = _current.get()
+    if timings is not None:
+        timings.rules_evaluated += evaluated
+        timings.rules_fired += fired
+
+
+class _PipelineMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.failed = 0
+        self.stages: Dict[str, Histogram] = {}
+        self.total = Histogram(LATENCY_BUCKETS_MS)
+        self.rules_evaluated = Histogram(COUNT_BUCKETS)
+        self.rules_fired = Histogram(COUNT_BUCKETS)
+
+
+class PosMetrics:
+    """エンドポイント（pipeline）別・段階別のヒストグラム（1プロセス1インスタンス）"""
+
+    def __init__(self, enabled: bool = POS_METRICS_ENABLED, server_timing: bool = POS_SERVER_TIMING):
+        self.enabled = enabled
+        self.server_timing = server_timing
+        self._pipelines: Dict[str, _PipelineMetrics] = {}
+        self._lock = threading.Lock()
+
+    def _pipeline(self, name: str) -> _PipelineMetrics:
+        metrics = self._pipelines.get(name)
+        if metrics is None:
+            with self._lock:
+                metrics = self._pipelines.setdefault(name, _PipelineMetrics())
+        return metrics
+
+    @contextmanager
+    def collect(self, pipeline: str, response: Optional[Response] = None) -> Iterator[Optional[RequestTimings]]:
+        """
+        with の間を1リクエストとして計測する。無効時は何もせず None を返す。
+        正常終了時のみヒストグラムへ積み、response を渡せば Server-Timing ヘッダを付ける。
+        """
+        if not (self.enabled or self.server_timing):
+            yield None
+            return
+        timings = RequestTimings(pipeline)
+        token = _current.set(timings)
+        started = time.perf_counter()
+        try:
+            yield timings
+        except BaseException:
+            if self.enabled:
+                metrics = self._pipeline(pipeline)
+                with self._lock:
+                    metrics.failed += 1
+            raise
+        finally:
+            _current.reset(token)
+        elapsed = time.perf_counter() - started
+
+        if self.enabled:
+            self._observe(timings, elapsed)
+        if self.server_timing and response is not None:
+            response.headers["Server-Timing"] = ", ".join(
+                filter(None, (timings.server_timing(), f"total;dur={elapsed * 1000:.3f}"))
+            )
+
+    def _observe(self, timings: RequestTimings, elapsed: float) -> None:
+        metrics = self._pipeline(timings.pipeline)
+        with self._lock:
+            metrics.requests += 1
+            histograms = [
+                metrics.stages.get(name) or metrics.stages.setdefault(name, Histogram(LATENCY_BUCKETS_MS))
+                for name in timings.stages
+            ]
+        for histogram, seconds in zip(histograms, timings.stages.values()):
+            histogram.observe(seconds * 1000)
+        metrics.total.observe(elapsed * 1000)
+        metrics.rules_evaluated.observe(timings.rules_evaluated)
+        metrics.rules_fired.observe(timings.rules_fired)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._pipelines = {}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            pipelines = list(self._pipelines.items())
+        return {
+            "enabled": self.enabled,
+            "server_timing": self.server_timing,
+            "pipelines": {
+                name: {
+                    "requests": metrics.requests,
+                    "failed": metrics.failed,
+                    "latency_ms": {
+                        **{stage_name: h.snapshot() for stage_name, h in list(metrics.stages.items())},
+                        "total": metrics.total.snapshot(),
+                    },
+                    "rules_evaluated": metrics.rules_evaluated.snapshot(),
+                    "rules_fired": metrics.rules_fired.snapshot(),
+                }
+                for name, metrics in pipelines
+            },
+        }
+
+
+pos_metrics = PosMetrics()
@@ -21,6 +21,7 @@ from schemas import (
     Action
 )
 from .user_validation_service import UserValidationService
+from .rule_plan_cache import invalidate_rule_plan
 
 
 class RecipeService:
@@ -101,6 +102,9 @@ class RecipeService:
             
             db_session.commit()
             
+            # POS評価用のルールプランを作り直させる
+            invalidate_rule_plan(user_id)
+            
             # 作成されたレシピの詳細情報を取得してレスポンス用に変換
             created_recipe = RecipeService._get_recipe_with_relations(
                 recipe_instance.id, db_session
@@ -0,0 +1,78 @@
+"""
+ガチャ・random_range の乱数
+- 既定はスレッドごとの random.Random（グローバルの random を全スレッドで共有しない）
+- use_rng で評価単位（1リクエスト・1バッチ）の生成器を差し込める
+- TANABOTA_RNG_SEED を設定すると、冪等キーまたはリクエスト内容から決定的な生成器を作る
+  （リプレイ・負荷試験・バックテストの結果がバイト単位で一致する）。
+  シードはこの値と混ぜて作るため、本番で使う場合は推測できない値にすること
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import random
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, Optional
+
+import numpy as np
+
+# 決定的モードの基準シード（未設定なら毎回ランダム）
+TANABOTA_RNG_SEED = os.getenv("TANABOTA_RNG_SEED") or None
+
+_thread_local = threading.local()
+_current: ContextVar[Optional[random.Random]] = ContextVar("tanabota_rng", default=None)
+
+
+def current_rng() -> random.Random:
+    """評価中の生成器（use_rng で差し込まれたもの。無ければスレッドごとの生成器）"""
+    rng = _current.get()
+    if rng is not None:
+        return rng
+    rng = getattr(_thread_local, "rng", None)
+    if rng is None:
+        rng = _thread_local.rng = random.Random()
+    return rng
+
+
+@contextmanager
+def use_rng(rng: Optional[random.Random]) -> Iterator[None]:
+    """with の間だけ rng を使う（None なら既定のまま）"""
+    if rng is None:
+        yield
+        return
+    token = _current.set(rng)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def derive_seed(*parts: Any) -> int:
+    """parts（JSON化できる値）から64bitのシードを作る"""
+    payload = json.dumps(parts, ensure_ascii=False, separators=(",", ":"), default=str)
+    return int.from_bytes(hashlib.sha256(payload.encode("utf-8")).digest()[:8], "big")
+
+
+def request_rng(*parts: Any, key: Optional[str] = None) -> Optional[random.Random]:
+    """
+    決定的モードなら、冪等キー（あれば）またはリクエスト内容 parts から生成器を作る。
+    決定的モードでなければ None（既定の生成器を使う）。
+    """
+    if TANABOTA_RNG_SEED is None:
+        return None
+    if key is not None:
+        return random.Random(derive_seed(TANABOTA_RNG_SEED, "idempotency", key))
+    return random.Random(derive_seed(TANABOTA_RNG_SEED, *parts))
+
+
+def numpy_rng(seed: Optional[int] = None, *parts: Any) -> np.random.Generator:
+    """
+    一括評価（ベクトル版）用の Generator。
+    seed 指定時はそれを、無ければ決定的モードで parts から作ったシードを使う。
+    """
+    if seed is None and TANABOTA_RNG_SEED is not None:
+        seed = derive_seed(TANABOTA_RNG_SEED, *parts)
+    return np.random.default_rng(seed)
@@ -0,0 +1,202 @@
+"""
+ルールプランキャッシュ
+ユーザー単位のコンパイル済みルールプランを保持するLRUキャッシュと、
+ルール編集時の無効化フックを提供
+"""
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from itertools import chain
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.util import identity_key
+
+from models import Rule, Recipe, RecipeRule, User
+
+# 最大保持ユーザー数（LRUで追い出し）
+RULE_PLAN_CACHE_SIZE = int(os.getenv("RULE_PLAN_CACHE_SIZE", "10000"))
+# 他ワーカーでの編集を取りこぼした場合の鮮度保証（秒）。0以下で無期限
+RULE_PLAN_CACHE_TTL = float(os.getenv("RULE_PLAN_CACHE_TTL", "300"))
+
+
+class RulePlanCache:
+    """ユーザーID → コンパイル済みルールプラン のスレッドセーフなLRUキャッシュ"""
+
+    def __init__(self, maxsize: int = RULE_PLAN_CACHE_SIZE, ttl_seconds: float = RULE_PLAN_CACHE_TTL):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl_seconds = float(ttl_seconds)
+        self._entries: "OrderedDict[int, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # 無効化のたびに進める世代番号（ロード中に無効化された古いプランを格納しないため）
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, user_id: int, now: float) -> Tuple[bool, Any]:
+        # ロック取得済みで呼ぶこと
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            plan, expires_at = entry
+            if expires_at <= 0 or now < expires_at:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return True, plan
+            del self._entries[user_id]
+        self.misses += 1
+        return False, None
+
+    def _store(self, user_id: int, plan: Any, now: float) -> None:
+        # ロック取得済みで呼ぶこと
+        expires_at = (now + self.ttl_seconds) if self.ttl_seconds > 0 else 0.0
+        self._entries[user_id] = (plan, expires_at)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get_or_load(self, user_id: int, loader: Callable[[], Any]) -> Any:
+        """キャッシュ済みならそれを返し、無ければ loader() の結果を格納して返す"""
+        now = time.monotonic()
+        with self._lock:
+            found, plan = self._lookup(user_id, now)
+            if found:
+                return plan
+            epoch = self._epoch
+
+        # DBアクセスはロック外で行う
+        plan = loader()
+
+        with self._lock:
+            if epoch == self._epoch:
+                self._store(user_id, plan, now)
+        return plan
+
+    async def get_or_load_async(self, user_id: int, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """get_or_load の非同期版（loader はコルーチン関数）"""
+        now = time.monotonic()
+        with self._lock:
+            found, plan = self._lookup(user_id, now)
+            if found:
+                return plan
+            epoch = self._epoch
+
+        plan = await loader()
+
+        with self._lock:
+            if epoch == self._epoch:
+                self._store(user_id, plan, now)
+        return plan
+
+    def get_many_or_load(
+        self, user_ids: Iterable[int], loader: Callable[[List[int]], Dict[int, Any]]
+    ) -> Dict[int, Any]:
+        """複数ユーザー分を取得。未キャッシュ分は loader(missing_ids) で一括ロードする"""
+        now = time.monotonic()
+        plans: Dict[int, Any] = {}
+        missing: List[int] = []
+        with self._lock:
+            for uid in dict.fromkeys(user_ids):
+                found, plan = self._lookup(uid, now)
+                if found:
+                    plans[uid] = plan
+                else:
+                    missing.append(uid)
+            epoch = self._epoch
+
+        if not missing:
+            return plans
+
+        loaded = loader(missing)
+
+        with self._lock:
+            store = epoch == self._epoch
+            for uid in missing:
+                plans[uid] = loaded[uid]
+                if store:
+                    self._store(uid, loaded[uid], now)
+        return plans
+
+    def invalidate(self, user_id: Optional[int] = None) -> None:
+        """指定ユーザーのプランを破棄（user_id=None で全件）"""
+        with self._lock:
+            self._epoch += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+rule_plan_cache = RulePlanCache()
+
+
+_invalidation_listeners: List[Callable[[Optional[int]], None]] = []
+
+
+def add_invalidation_listener(listener: Callable[[Optional[int]], None]) -> None:
+    """ルール変更の通知先を追加（プラン以外にルールを保持するもの＝スケジューラ等が使う）"""
+    _invalidation_listeners.append(listener)
+
+
+def invalidate_rule_plan(user_id: Optional[int] = None) -> None:
+    """ルール編集後に呼び出す（user_id=None で全ユーザー分を破棄）"""
+    rule_plan_cache.invalidate(user_id)
+    for listener in _invalidation_listeners:
+        listener(user_id)
+
+
+# ------------------------------------------------------------
+# ORMフック：Rule / Recipe / RecipeRule / User の変更をコミット時に反映
+# ------------------------------------------------------------
+_DIRTY_KEY = "rule_plan_dirty_users"
+_ALL_USERS = -1
+
+
+def _collect_user_ids(session: Session) -> Set[int]:
+    user_ids: Set[int] = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, User):
+            # プランはユーザーの存在有無も保持しているため、登録・削除でも作り直す
+            user_ids.add(obj.id if obj.id is not None else _ALL_USERS)
+        elif isinstance(obj, (Rule, Recipe)):
+            user_ids.add(obj.user_id if obj.user_id is not None else _ALL_USERS)
+        elif isinstance(obj, RecipeRule):
+            recipe = session.identity_map.get(identity_key(Recipe, obj.recipe_id))
+            user_ids.add(recipe.user_id if recipe is not None else _ALL_USERS)
+    return user_ids
+
+
+@event.listens_for(Session, "after_flush")
+def _on_after_flush(session: Session, flush_context) -> None:
+    user_ids = _collect_user_ids(session)
+    if user_ids:
+        session.info.setdefault(_DIRTY_KEY, set()).update(user_ids)
+
+
+@event.listens_for(Session, "after_commit")
+def _on_after_commit(session: Session) -> None:
+    user_ids = session.info.pop(_DIRTY_KEY, None)
+    if not user_ids:
+        return
+    if _ALL_USERS in user_ids:
+        invalidate_rule_plan(None)
+        return
+    for uid in user_ids:
+        invalidate_rule_plan(uid)
+
+
+@event.listens_for(Session, "after_rollback")
+def _on_after_rollback(session: Session) -> None:
+    session.info.pop(_DIRTY_KEY, None)
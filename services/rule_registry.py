@@ -0,0 +1,757 @@
+"""
+トリガー／アクション評価レジストリ
+トリガーは Trigger.id ごと、アクションは action_type ごとに
+パラメータスキーマ（__slots__ 付きクラス）と評価関数を一度だけ登録する。
+評価時はレジストリを引かず、コンパイル済みの関数を呼ぶだけにする。
+"""
+from __future__ import annotations
+
+import calendar
+import os
+from datetime import datetime, timedelta, timezone, tzinfo
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from services.rng import current_rng
+
+MatchFn = Callable[[int, Optional[str]], bool]
+AmountFn = Callable[[int], int]
+# (params, amount_paid, category) → (採用するか, 以降に引き継ぐカテゴリ)
+FallbackFn = Callable[[Any, int, Optional[str]], Tuple[bool, Optional[str]]]
+# 基準時刻（UTC, aware）より後の次回発火時刻（UTC, aware）を返す
+NextFireFn = Callable[[datetime], datetime]
+
+# イベント種別（どの入口で評価されるトリガーか）
+EVENT_PAYMENT = "payment"
+EVENT_INCOME = "income"      # 入金で発火（/pos/income が評価。金額は入金額、第3引数は入金の摘要）
+EVENT_COUNTER = "counter"    # 支払い時に支出カウンタで判定（第3引数は services.spend_counters.CounterContext）
+EVENT_SCHEDULE = "schedule"  # 時刻で発火（services.scheduler が評価）
+
+# デモ用フォールバックで候補を探す段（小さいほど優先）
+FALLBACK_STAGE_UNCONDITIONAL = 1
+FALLBACK_STAGE_CATEGORY = 2
+FALLBACK_STAGE_GACHA = 3  # 確率を強制成功にする
+FALLBACK_STAGE_CONDITIONAL = 4
+
+
+class InvalidParams(ValueError):
+    """パラメータが解釈できない（このルールは発火しない）"""
+
+
+def _always(a: int, category: Optional[str]) -> bool:
+    return True
+
+
+def _never(a: int, category: Optional[str]) -> bool:
+    return False
+
+
+def _zero_amount(a: int) -> int:
+    return 0
+
+
+def _to_int(value: Any, default: int = 0) -> int:
+    try:
+        return int(value or default)
+    except (TypeError, ValueError):
+        return default
+
+
+# ------------------------------------------------------------
+# レジストリ本体
+# ------------------------------------------------------------
+class TriggerSpec:
+    """トリガー種別の定義"""
+    __slots__ = ("trigger_id", "name", "params_type", "evaluate", "event", "fallback_stage", "fallback")
+
+    def __init__(
+        self,
+        trigger_id: int,
+        name: str,
+        params_type: Type,
+        evaluate: Callable[..., bool],
+        event: str,
+        fallback_stage: Optional[int],
+        fallback: Optional[FallbackFn],
+    ):
+        self.trigger_id = trigger_id
+        self.name = name
+        self.params_type = params_type
+        self.evaluate = evaluate
+        self.event = event
+        self.fallback_stage = fallback_stage
+        self.fallback = fallback
+
+    def compile(self, raw_params: Dict[str, Any] | None) -> Tuple[Any, MatchFn]:
+        """(解釈済みパラメータ or None, 評価関数) を返す"""
+        try:
+            params = self.params_type.parse(raw_params or {})
+        except InvalidParams:
+            return None, _never
+        return params, partial(self.evaluate, params)
+
+
+class ActionSpec:
+    """アクション種別の定義（randomized: 乱数で金額が決まる＝支払額0でも0円とは限らない）"""
+    __slots__ = ("action_type", "params_type", "evaluate", "randomized")
+
+    def __init__(self, action_type: str, params_type: Type, evaluate: Callable[..., int], randomized: bool = False):
+        self.action_type = action_type
+        self.params_type = params_type
+        self.evaluate = evaluate
+        self.randomized = randomized
+
+    def compile(self, raw_params: Dict[str, Any]) -> Tuple[Any, AmountFn]:
+        """(解釈済みパラメータ or None, 評価関数) を返す"""
+        try:
+            params = self.params_type.parse(raw_params)
+        except InvalidParams:
+            return None, _zero_amount
+        return params, partial(self.evaluate, params)
+
+
+_TRIGGERS_BY_ID: Dict[int, TriggerSpec] = {}
+_TRIGGERS_BY_NAME: Dict[str, TriggerSpec] = {}
+_ACTIONS: Dict[str, ActionSpec] = {}
+
+
+def register_trigger(
+    trigger_id: int,
+    name: str,
+    params_type: Type,
+    *,
+    event: str = EVENT_PAYMENT,
+    fallback_stage: Optional[int] = None,
+    fallback: Optional[FallbackFn] = None,
+):
+    """
+    トリガー評価関数を登録するデコレータ。
+    EVENT_PAYMENT: evaluate(params, amount_paid, category) -> bool
+    EVENT_INCOME: evaluate(params, amount_received, description) -> bool
+    EVENT_COUNTER: evaluate(params, amount_paid, counter_context) -> bool
+    EVENT_SCHEDULE: evaluate(params, after) -> 次回発火時刻（NextFireFn の形）
+    """
+    def decorator(fn: Callable[..., bool]) -> Callable[..., bool]:
+        spec = TriggerSpec(trigger_id, name, params_type, fn, event, fallback_stage, fallback)
+        _TRIGGERS_BY_ID[trigger_id] = spec
+        _TRIGGERS_BY_NAME[name] = spec
+        return fn
+    return decorator
+
+
+def register_action(action_type: str, params_type: Type, *, randomized: bool = False):
+    """アクション評価関数 evaluate(params, amount_paid) -> int を登録するデコレータ"""
+    def decorator(fn: Callable[..., int]) -> Callable[..., int]:
+        _ACTIONS[action_type] = ActionSpec(action_type, params_type, fn, randomized)
+        return fn
+    return decorator
+
+
+def find_trigger_spec(trigger_id: Optional[int] = None, name: str | None = None) -> Optional[TriggerSpec]:
+    """Trigger.id で引き、名前が食い違う（マスタが別採番）場合は名前で引き直す"""
+    name = (name or "").strip()
+    spec = _TRIGGERS_BY_ID.get(trigger_id) if trigger_id is not None else None
+    if spec is not None and (not name or spec.name == name):
+        return spec
+    return _TRIGGERS_BY_NAME.get(name) if name else None
+
+
+def find_action_spec(action_type: str) -> Optional[ActionSpec]:
+    return _ACTIONS.get(action_type)
+
+
+def registered_triggers() -> List[TriggerSpec]:
+    return list(_TRIGGERS_BY_ID.values())
+
+
+# ------------------------------------------------------------
+# コンパイル
+# ------------------------------------------------------------
+def infer_action_type(p: Dict[str, Any] | None) -> str:
+    """
+    action_params からアクション種別を決める（金額算出とログの両方で使う唯一の推測ロジック）。
+    明示の "type" が最優先。無ければキーから推測する。
+    """
+    if not p:
+        return "unknown"
+    if p.get("type"):
+        return str(p["type"])
+    if "percentage" in p or "percent" in p or "growth_multiplier" in p:
+        return "save_percentage"
+    if "base_amount" in p:
+        return "penalty_over_base"
+    if "min_amount" in p and "max_amount" in p:
+        return "random_range"
+    if "amount" in p:
+        return "fixed"
+    if "to" in p:
+        return "roundup"
+    if "level_bonus" in p:
+        return "percentage_plus_bonus"
+    return "unknown"
+
+
+def compile_action_spec(
+    action_params: Dict[str, Any] | None,
+) -> Tuple[Optional[ActionSpec], Any, AmountFn]:
+    """(アクション定義, 解釈済みパラメータ, 評価関数) を返す。未登録の種別は 0 円。"""
+    p = action_params or {}
+    spec = _ACTIONS.get(infer_action_type(p))
+    if spec is None:
+        return None, None, _zero_amount
+    params, amount = spec.compile(p)
+    return spec, params, amount
+
+
+def compile_action(action_params: Dict[str, Any] | None) -> AmountFn:
+    """action_params を一度だけ解釈し、支払額 → たなぼた額 の関数を返す。"""
+    return compile_action_spec(action_params)[2]
+
+
+def compile_trigger_spec(
+    trigger_id: Optional[int],
+    trigger_name: str | None,
+    trigger_params: Dict[str, Any] | None,
+) -> Tuple[Optional[TriggerSpec], Any, MatchFn]:
+    """(トリガー定義, 解釈済みパラメータ, 評価関数) を返す。未登録のトリガーは発火しない。"""
+    spec = find_trigger_spec(trigger_id, trigger_name)
+    if spec is None:
+        return None, None, _never
+    params, match = spec.compile(trigger_params)
+    return spec, params, match
+
+
+def compile_schedule(
+    trigger_id: Optional[int],
+    trigger_name: str | None,
+    trigger_params: Dict[str, Any] | None,
+) -> Optional[NextFireFn]:
+    """時刻トリガーなら次回発火時刻の関数を返す（それ以外・パラメータ不正は None）"""
+    spec, params, next_fire = compile_trigger_spec(trigger_id, trigger_name, trigger_params)
+    if spec is None or params is None or spec.event != EVENT_SCHEDULE:
+        return None
+    return next_fire
+
+
+def schedule_trigger_specs() -> List[TriggerSpec]:
+    return [spec for spec in _TRIGGERS_BY_ID.values() if spec.event == EVENT_SCHEDULE]
+
+
+def compile_trigger(
+    trigger_name: str | None,
+    trigger_params: Dict[str, Any] | None,
+    trigger_id: Optional[int] = None,
+) -> MatchFn:
+    """trigger_params を一度だけ解釈し、(支払額, カテゴリ) → 発火可否 の関数を返す。"""
+    spec, _, match = compile_trigger_spec(trigger_id, trigger_name, trigger_params)
+    if spec is None or spec.event != EVENT_PAYMENT:
+        return _never
+    return match
+
+
+# ------------------------------------------------------------
+# アクション定義（日本円・整数）
+# ------------------------------------------------------------
+class SavePercentageParams:
+    """percentage/percent（割合）+ level_bonus（固定ボーナス）。growth_multiplier(1.5) → 150%"""
+    __slots__ = ("percentage", "level_bonus")
+
+    def __init__(self, percentage: int, level_bonus: int):
+        self.percentage = percentage
+        self.level_bonus = level_bonus
+
+    @classmethod
+    def parse(cls, p: Dict[str, Any]) -> "SavePercentageParams":
+        if "growth_multiplier" in p and "percentage" not in p and "percent" not in p:
+            try:
+                pct = int(round(float(p["growth_multiplier"]) * 100))
+            except (TypeError, ValueError):
+                pct = 0
+        else:
+            pct = _to_int(p.get("percent", p.get("percentage", 0)))
+        return cls(pct, _to_int(p.get("level_bonus", 0)))
+
+
+@register_action("save_percentage", SavePercentageParams)
+def _save_percentage(p: SavePercentageParams, a: int) -> int:
+    amt = (a * p.percentage) // 100 if p.percentage > 0 else 0
+    return max(0, amt + p.level_bonus)
+
+
+class FixedParams:
+    """amount（固定額）"""
+    __slots__ = ("amount",)
+
+    def __init__(self, amount: int):
+        self.amount = amount
+
+    @classmethod
+    def parse(cls, p: Dict[str, Any]) -> "FixedParams":
+        try:
+            return cls(max(0, int(p.get("amount", 0) or 0)))
+        except (TypeError, ValueError):
+            raise InvalidParams("amount")
+
+
+@register_action("fixed", FixedParams)
+def _fixed(p: FixedParams, a: int) -> int:
+    return p.amount
+
+
+class RoundupParams:
+    """{"to": 100} → 100円単位に切り上げ差額"""
+    __slots__ = ("to",)
+
+    def __init__(self, to: int):
+        self.to = to
+
+    @classmethod
+    def parse(cls, p: Dict[str, Any]) -> "RoundupParams":
+        try:
+            step = int(p.get("to", 100) or 100)
+        except (TypeError, ValueError):
+            raise InvalidParams("to")
+        if step <= 0:
+            raise InvalidParams("to")
+        return cls(step)
+
+
+@register_action("roundup", RoundupParams)
+def _roundup(p: RoundupParams, a: int) -> int:
+    rem = a % p.to
+    return (p.to - rem) if rem else 0
+
+
+class PenaltyOverBaseParams:
+    """{"base_amount": 700} → max(0, amount - base)"""
+    __slots__ = ("base_amount",)
+
+    def __init__(self, base_amount: int):
+        self.base_amount = base_amount
+
+    @classmethod
+    def parse(cls, p: Dict[str, Any]) -> "PenaltyOverBaseParams":
+        return cls(_to_int(p.get("base_amount", 0)))
+
+
+@register_action("penalty_over_base", PenaltyOverBaseParams)
+def _penalty_over_base(p: PenaltyOverBaseParams, a: int) -> int:
+    return max(0, a - p.base_amount)
+
+
+class RandomRangeParams:
+    """{"min_amount": 1, "max_amount": 1000} → 範囲内の乱数"""
+    __slots__ = ("min_amount", "max_amount")
+
+    def __init__(self, min_amount: int, max_amount: int):
+        self.min_amount = min_amount
+        self.max_amount = max_amount
+
+    @classmethod
+    def parse(cls, p: Dict[str, Any]) -> "RandomRangeParams":
+        try:
+            lo = int(p.get("min_amount", 0) or 0)
+            hi = int(p.get("max_amount", 0) or 0)
+        except (TypeError, ValueError):
+            raise InvalidParams("min_amount/max_amount")
+        if hi < lo:
+            lo, hi = hi, lo
+        if hi <= 0:
+            raise InvalidParams("max_amount")
+        return cls(lo, hi)
+
+
+@register_action("random_range", RandomRangeParams, randomized=True)
+def _random_range(p: RandomRangeParams, a: int) -> int:
+    return current_rng().randint(p.min_amount, p.max_amount)
+
+
+# ------------------------------------------------------------
+# トリガー定義（POS支払い）
+# ------------------------------------------------------------
+def _fallback_fire(params: Any, a: int, category: Optional[str]) -> Tuple[bool, Optional[str]]:
+    return True, None
+
+
+def _fallback_first_category(params: Any, a: int, category: Optional[str]) -> Tuple[bool, Optional[str]]:
+    # 最初のカテゴリを強制セット
+    if params.first_category is None:
+        return False, category
+    return True, params.first_category
+
+
+class SpendParams:
+    """min_amount（任意）: この金額未満の支出は対象外"""
+    __slots__ = ("min_amount",)
+
+    def __init__(self, min_amount: Optional[int]):
+        self.min_amount = min_amount
+
+    @classmethod
+    def parse(cls, p: Dict[str, Any]) -> "SpendParams":
+        min_amt = p.get("min_amount")
+        if min_amt is None:
+            return cls(None)
+        try:
+            return cls(int(min_amt))
+        except (TypeError, ValueError):
+            raise InvalidParams("min_amount")
+
+
+# 3) 支出発生
+@register_trigger(
+    3, "支出発生", SpendParams,
+    fallback_stage=FALLBACK_STAGE_UNCONDITIONAL, fallback=_fallback_fire,
+)
+def _spend(p: SpendParams, a: int, category: Optional[str]) -> bool:
+    return p.min_amount is None or a >= p.min_amount
+
+
+class CategoryParams:
+    """categories: 対象カテゴリ（未設定なら素通し）"""
+    __slots__ = ("categories", "first_category")
+    key = "categories"
+
+    def __init__(self, categories: frozenset, first_category: Optional[str]):
+        self.categories = categories
+        self.first_category = first_category
+
+    @classmethod
+    def parse(cls, p: Dict[str, Any]) -> "CategoryParams":
+        cats = list(p.get(cls.key) or [])
+        return cls(frozenset(cats), str(cats[0]) if cats else None)
+
+
+class MirrorCategoryParams(CategoryParams):
+    """mirror_categories: ミラーリング対象カテゴリ（未設定なら素通し）"""
+    __slots__ = ()
+    key = "mirror_categories"
+
+
+def _category_in(p: CategoryParams, a: int, category: Optional[str]) -> bool:
+    if not p.categories:
+        return True  # 定義ミスの保険（categories未設定なら素通し）
+    return bool(category) and category in p.categories
+
+
+# 4) 特定カテゴリでの支出
+register_trigger(
+    4, "特定カテゴリでの支出", CategoryParams,
+    fallback_stage=FALLBACK_STAGE_CATEGORY, fallback=_fallback_first_category,
+)(_category_in)
+
+# 12) 推し活同額ミラーリング
+register_trigger(
+    12, "推し活同額ミラーリング", MirrorCategoryParams,
+    fallback_stage=FALLBACK_STAGE_CATEGORY, fallback=_fallback_first_category,
+)(_category_in)
+
+
+class GachaParams:
+    """trigger_probability: 発火確率（%、0〜100 に丸める）"""
+    __slots__ = ("probability",)
+
+    def __init__(self, probability: int):
+        self.probability = probability
+
+    @classmethod
+    def parse(cls, p: Dict[str, Any]) -> "GachaParams":
+        try:
+            prob = int(p.get("trigger_probability", 30))
+        except (TypeError, ValueError):
+            prob = 30
+        return cls(max(0, min(100, prob)))
+
+
+# 9) ガチャタイム（支出発生時ランダム）— フォールバック時は確率を強制成功に
+@register_trigger(
+    9, "ガチャタイム（支出発生時ランダム）", GachaParams,
+    fallback_stage=FALLBACK_STAGE_GACHA, fallback=_fallback_fire,
+)
+def _gacha(p: GachaParams, a: int, category: Optional[str]) -> bool:
+    return current_rng().randint(1, 100) <= p.probability
+
+
+_OPERATORS: Dict[str, Callable[[int, int], bool]] = {
+    ">": lambda a, thr: a > thr,
+    ">=": lambda a, thr: a >= thr,
+    "<": lambda a, thr: a < thr,
+    "<=": lambda a, thr: a <= thr,
+}
+
+
+class ConditionalSpendParams:
+    """amount（閾値）+ operator（既定 ">"）+ category（任意）"""
+    __slots__ = ("amount", "operator", "compare", "category")
+
+    def __init__(self, amount: int, operator: str, category: Optional[str]):
+        self.amount = amount
+        self.operator = operator
+        self.compare = _OPERATORS.get(operator)  # 未知演算子は None（通す）
+        self.category = category
+
+    @classmethod
+    def parse(cls, p: Dict[str, Any]) -> "ConditionalSpendParams":
+        try:
+            thr = int(p.get("amount"))
+        except (TypeError, ValueError):
+            raise InvalidParams("amount")
+        op = (p.get("operator") or ">").strip()
+        return cls(thr, op, p.get("category") or None)
+
+
+def _fallback_conditional(
+    p: Optional[ConditionalSpendParams], a: int, category: Optional[str]
+) -> Tuple[bool, Optional[str]]:
+    # 今の金額で条件を満たすもの（カテゴリはデモ用に強制セット）
+    if p is None:
+        return False, category
+    if p.category:
+        category = p.category
+    op = p.operator
+    if (op in (">", ">=") and a >= p.amount) or (op in ("<", "<=") and a <= p.amount):
+        return True, category
+    return False, category
+
+
+# 6) 条件付き支出
+@register_trigger(
+    6, "条件付き支出", ConditionalSpendParams,
+    fallback_stage=FALLBACK_STAGE_CONDITIONAL, fallback=_fallback_conditional,
+)
+def _conditional_spend(p: ConditionalSpendParams, a: int, category: Optional[str]) -> bool:
+    # カテゴリ条件が指定されていればチェック（無ければ金額条件だけで判定）
+    if p.category and category != p.category:
+        return False
+    return p.compare is None or p.compare(a, p.amount)
+
+
+
+# ------------------------------------------------------------
+# 入金トリガー（EVENT_INCOME）
+# ------------------------------------------------------------
+class KeywordParams:
+    """keyword: 入金の摘要に含まれる文字列（例: "給与"）"""
+    __slots__ = ("keyword",)
+
+    def __init__(self, keyword: str):
+        self.keyword = keyword
+
+    @classmethod
+    def parse(cls, p: Dict[str, Any]) -> "KeywordParams":
+        keyword = str(p.get("keyword") or "").strip()
+        if not keyword:
+            raise InvalidParams("keyword is required")
+        return cls(keyword)
+
+
+# 5) 給与・賞与の入金
+@register_trigger(5, "給与・賞与の入金", KeywordParams, event=EVENT_INCOME)
+def _income_keyword(p: KeywordParams, a: int, description: Optional[str]) -> bool:
+    return a > 0 and p.keyword in (description or "")
+
+
+# ------------------------------------------------------------
+# 支出カウンタで判定するトリガー（EVENT_COUNTER）
+# ctx は services.spend_counters.CounterContext（当日・前日・累計の値を O(1) で参照できる）
+# ------------------------------------------------------------
+class ZeroDayParams:
+    """categories: 前日の支出がゼロだったか調べるカテゴリ（必須）"""
+    __slots__ = ("categories",)
+
+    def __init__(self, categories: Tuple[str, ...]):
+        self.categories = categories
+
+    @classmethod
+    def parse(cls, p: Dict[str, Any]) -> "ZeroDayParams":
+        cats = tuple(str(c) for c in (p.get("categories") or []) if c)
+        if not cats:
+            raise InvalidParams("categories is required")
+        return cls(cats)
+
+
+# 8) カテゴリ支出ゼロの日 — 前日に対象カテゴリの支出が無ければ、その日最初の支出で1回発火
+@register_trigger(8, "カテゴリ支出ゼロの日", ZeroDayParams, event=EVENT_COUNTER)
+def _zero_day(p: ZeroDayParams, a: int, ctx: Any) -> bool:
+    return ctx.first_of_day and all(ctx.spend(c, days_ago=1) == 0 for c in p.categories)
+
+
+class LevelUpParams:
+    """threshold_amount: 1レベルあたりの累計たなぼた額（累計がこの倍数を超えるたびに発火）"""
+    __slots__ = ("threshold",)
+
+    def __init__(self, threshold: int):
+        self.threshold = threshold
+
+    @classmethod
+    def parse(cls, p: Dict[str, Any]) -> "LevelUpParams":
+        threshold = _to_int(p.get("threshold_amount", 0))
+        if threshold <= 0:
+            raise InvalidParams("threshold_amount must be positive")
+        return cls(threshold)
+
+
+# 10) レベルアップ検知
+@register_trigger(10, "レベルアップ検知", LevelUpParams, event=EVENT_COUNTER)
+def _level_up(p: LevelUpParams, a: int, ctx: Any) -> bool:
+    return ctx.saved_before // p.threshold < ctx.saved_after // p.threshold
+
+
+# 13) 推し活マイルストーン接近 は未登録（トリガーマスタ・テンプレートのパラメータは event_name と days_before だけで、
+#     判定に必要なイベントの日付が無い。日付をルールに持たせるまでは発火させない）
+# その他（SNSライブ配信コメント など）は未登録＝POS即時では扱わない
+
+
+# ------------------------------------------------------------
+# 時刻トリガー（EVENT_SCHEDULE）— 日付・時刻は SCHEDULE_TIMEZONE の壁時計で解釈
+# ------------------------------------------------------------
+def _schedule_timezone() -> tzinfo:
+    try:
+        return ZoneInfo(os.getenv("SCHEDULE_TIMEZONE", "Asia/Tokyo"))
+    except (ZoneInfoNotFoundError, ValueError):
+        return timezone(timedelta(hours=9))
+
+
+SCHEDULE_TZ = _schedule_timezone()
+
+_DAYS_OF_WEEK = {
+    "monday": 0, "mon": 0, "月": 0, "月曜": 0, "月曜日": 0,
+    "tuesday": 1, "tue": 1, "火": 1, "火曜": 1, "火曜日": 1,
+    "wednesday": 2, "wed": 2, "水": 2, "水曜": 2, "水曜日": 2,
+    "thursday": 3, "thu": 3, "木": 3, "木曜": 3, "木曜日": 3,
+    "friday": 4, "fri": 4, "金": 4, "金曜": 4, "金曜日": 4,
+    "saturday": 5, "sat": 5, "土": 5, "土曜": 5, "土曜日": 5,
+    "sunday": 6, "sun": 6, "日": 6, "日曜": 6, "日曜日": 6,
+}
+
+
+def _parse_time_of_day(p: Dict[str, Any], default_hour: int = 0) -> Tuple[int, int]:
+    hour = _to_int(p.get("hour", default_hour), default_hour)
+    minute = _to_int(p.get("minute", 0))
+    if not (0 <= hour <= 23 and 0 <= minute <= 59):
+        raise InvalidParams("hour/minute out of range")
+    return hour, minute
+
+
+def _local(after: datetime) -> datetime:
+    return after.astimezone(SCHEDULE_TZ)
+
+
+def _at(day: datetime, hour: int, minute: int) -> datetime:
+    return day.replace(hour=hour, minute=minute, second=0, microsecond=0)
+
+
+class WeeklyParams:
+    """day_of_week（"Sunday" / "日曜" / 0=月〜6=日）+ 任意の hour/minute（既定 0:00）"""
+    __slots__ = ("weekday", "hour", "minute")
+
+    def __init__(self, weekday: int, hour: int, minute: int):
+        self.weekday = weekday
+        self.hour = hour
+        self.minute = minute
+
+    @classmethod
+    def parse(cls, p: Dict[str, Any]) -> "WeeklyParams":
+        raw = p.get("day_of_week")
+        if isinstance(raw, int) and 0 <= raw <= 6:
+            weekday = raw
+        else:
+            weekday = _DAYS_OF_WEEK.get(str(raw or "").strip().lower())
+            if weekday is None:
+                raise InvalidParams("unknown day_of_week")
+        return cls(weekday, *_parse_time_of_day(p))
+
+
+# 1) 定期実行 (毎週)
+@register_trigger(1, "定期実行 (毎週)", WeeklyParams, event=EVENT_SCHEDULE)
+def _next_weekly(p: WeeklyParams, after: datetime) -> datetime:
+    local = _local(after)
+    candidate = _at(local + timedelta(days=(p.weekday - local.weekday()) % 7), p.hour, p.minute)
+    if candidate <= local:
+        candidate = _at(candidate + timedelta(days=7), p.hour, p.minute)
+    return candidate.astimezone(timezone.utc)
+
+
+class TimeOfDayParams:
+    """hour/minute（月末は既定 0:00、特定時刻は必須）"""
+    __slots__ = ("hour", "minute")
+
+    def __init__(self, hour: int, minute: int):
+        self.hour = hour
+        self.minute = minute
+
+    @classmethod
+    def parse(cls, p: Dict[str, Any]) -> "TimeOfDayParams":
+        return cls(*_parse_time_of_day(p))
+
+
+class DailyTimeParams(TimeOfDayParams):
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, p: Dict[str, Any]) -> "DailyTimeParams":
+        if "hour" not in p:
+            raise InvalidParams("hour is required")
+        return cls(*_parse_time_of_day(p))
+
+
+def _month_end(year: int, month: int) -> int:
+    return calendar.monthrange(year, month)[1]
+
+
+# 2) 定期実行 (月末)
+@register_trigger(2, "定期実行 (月末)", TimeOfDayParams, event=EVENT_SCHEDULE)
+def _next_month_end(p: TimeOfDayParams, after: datetime) -> datetime:
+    local = _local(after)
+    year, month = local.year, local.month
+    while True:
+        candidate = _at(local.replace(year=year, month=month, day=_month_end(year, month)), p.hour, p.minute)
+        if candidate > local:
+            return candidate.astimezone(timezone.utc)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        local = local.replace(year=year, month=month, day=1)
+
+
+# 11) 時空の歪み（特定時刻）— 毎日 hour:minute
+@register_trigger(11, "時空の歪み（特定時刻）", DailyTimeParams, event=EVENT_SCHEDULE)
+def _next_daily(p: DailyTimeParams, after: datetime) -> datetime:
+    local = _local(after)
+    candidate = _at(local, p.hour, p.minute)
+    if candidate <= local:
+        candidate = _at(local + timedelta(days=1), p.hour, p.minute)
+    return candidate.astimezone(timezone.utc)
+
+
+class IntervalWeeksParams:
+    """interval_weeks（N週ごと。基準週からの経過週数が N の倍数の月曜 hour:minute、既定 0:00）"""
+    __slots__ = ("weeks", "hour", "minute")
+
+    def __init__(self, weeks: int, hour: int, minute: int):
+        self.weeks = weeks
+        self.hour = hour
+        self.minute = minute
+
+    @classmethod
+    def parse(cls, p: Dict[str, Any]) -> "IntervalWeeksParams":
+        weeks = _to_int(p.get("interval_weeks", 0))
+        if weeks <= 0:
+            raise InvalidParams("interval_weeks must be positive")
+        return cls(weeks, *_parse_time_of_day(p))
+
+
+# 再起動しても周期がずれないよう、固定の基準週（1970-01-05 月曜）から数える
+_INTERVAL_EPOCH_ORDINAL = datetime(1970, 1, 5).toordinal()
+
+
+# 14) 断捨離リマインダー
+@register_trigger(14, "断捨離リマインダー", IntervalWeeksParams, event=EVENT_SCHEDULE)
+def _next_interval_weeks(p: IntervalWeeksParams, after: datetime) -> datetime:
+    local = _local(after)
+    monday = local - timedelta(days=local.weekday())
+    weeks_since = (monday.toordinal() - _INTERVAL_EPOCH_ORDINAL) // 7
+    monday -= timedelta(weeks=weeks_since % p.weeks)
+    candidate = _at(monday, p.hour, p.minute)
+    while candidate <= local:
+        candidate = _at(candidate + timedelta(weeks=p.weeks), p.hour, p.minute)
+    return candidate.astimezone(timezone.utc)
@@ -0,0 +1,213 @@
+"""
+たなぼた額の月次集計（user_savings_rollups）
+取引を保存するたびに、そのログを (ユーザー, 月, 全体／ルール別／アクション種別) の行へ加算しておき、
+集計APIやダッシュボードが tanabota_action_logs を SUM せずに済むようにする。
+- 月の区切りは支出カウンタと同じタイムゾーン（SCHEDULE_TIMEZONE）
+- 加算は UPSERT の executemany 1回（ログの write-behind とは独立に、決済時点の明細から作る）
+- 導入前の履歴や手修正後は rebuild_savings_rollups でログから作り直す
+  （python -m services.savings_rollup --user-id 1 2 / 全ユーザーは引数なし）
+"""
+from __future__ import annotations
+
+import os
+from datetime import date, datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from models import EVENT_KIND_PAYMENT, TanabotaActionLog, TanabotaTransaction, UserSavingsRollup
+from services.action_log_archive import iter_archived_logs
+from services.spend_counters import PERIOD_TOTAL, additive_upsert, business_day
+from services.user_locks import lock_user_rows
+
+# 決済時に集計へ加算するか（無効にした期間は rebuild で埋める）
+SAVINGS_ROLLUP_ENABLED = os.getenv("SAVINGS_ROLLUP_ENABLED", "true").lower() in ["true", "1", "yes"]
+# 作り直し時にログを読む件数（ストリーミング）
+ROLLUP_REBUILD_FETCH_SIZE = 5000
+
+DIMENSION_ALL = "all"
+DIMENSION_RULE = "rule"
+DIMENSION_ACTION_TYPE = "action_type"
+ALL_KEY = "*"
+
+_Key = Tuple[int, str, str, str]  # (user_id, period, dimension, dimension_key)
+
+
+def month_of(day: date) -> str:
+    return day.strftime("%Y-%m")
+
+
+class _Accumulator:
+    """(ユーザー, 期間, 次元, キー) → [たなぼた額, ログ件数, 決済数] の加算"""
+
+    def __init__(self):
+        self.values: Dict[_Key, List[int]] = {}
+
+    def add_transaction(
+        self, user_id: int, month: str, executions: Iterable[Tuple[Any, str, int]], event_kind: str = EVENT_KIND_PAYMENT
+    ) -> None:
+        """1取引分のログ (rule_id, action_type, たなぼた額) を月次と累計へ加算する（決済以外は取引数に数えない）"""
+        tx_count = 1 if event_kind == EVENT_KIND_PAYMENT else 0
+        per_key: Dict[Tuple[str, str], List[int]] = {}
+        for rule_id, action_type, amount in executions:
+            for key in ((DIMENSION_ALL, ALL_KEY), (DIMENSION_RULE, str(rule_id)), (DIMENSION_ACTION_TYPE, action_type)):
+                values = per_key.setdefault(key, [0, 0])
+                values[0] += amount
+                values[1] += 1
+        for period in (month, PERIOD_TOTAL):
+            for (dimension, dimension_key), (amount, count) in per_key.items():
+                values = self.values.setdefault((user_id, period, dimension, dimension_key), [0, 0, 0])
+                values[0] += amount
+                values[1] += count
+                values[2] += tx_count
+
+    def rows(self) -> List[Dict[str, Any]]:
+        now = datetime.now(timezone.utc)
+        return [
+            {
+                "user_id": user_id,
+                "period": period,
+                "dimension": dimension,
+                "dimension_key": dimension_key,
+                "tanabota_amount": amount,
+                "execution_count": count,
+                "transaction_count": tx_count,
+                "updated_at": now,
+            }
+            for (user_id, period, dimension, dimension_key), (amount, count, tx_count) in self.values.items()
+        ]
+
+
+# ------------------------------------------------------------
+# 決済時の加算
+# ------------------------------------------------------------
+def rollup_rows(results: Iterable[Any], day: Optional[date] = None) -> List[Dict[str, Any]]:
+    """
+    services.tanabota.PaymentResult（user_id, event_kind, executions）から加算用の行を作る。
+    ログの無い取引は集計しない。無効時は空リスト。
+    """
+    if not SAVINGS_ROLLUP_ENABLED:
+        return []
+    month = month_of(day or business_day())
+    acc = _Accumulator()
+    for r in results:
+        if r.executions:
+            acc.add_transaction(
+                r.user_id,
+                month,
+                ((e["rule_id"], e["action_type"], int(e["tanabota_amount"])) for e in r.executions),
+                r.event_kind,
+            )
+    return acc.rows()
+
+
+def _upsert(dialect_name: str):
+    return additive_upsert(
+        dialect_name,
+        UserSavingsRollup.__table__,
+        ["user_id", "period", "dimension", "dimension_key"],
+        ["tanabota_amount", "execution_count", "transaction_count"],
+    )
+
+
+def add_savings_rollups(db: Session, rows: List[Dict[str, Any]]) -> None:
+    """rollup_rows の行を加算する（コミットは呼び出し側）"""
+    if rows:
+        db.execute(_upsert(db.get_bind().dialect.name), rows)
+
+
+async def add_savings_rollups_async(db: AsyncSession, rows: List[Dict[str, Any]]) -> None:
+    """add_savings_rollups の非同期版"""
+    if rows:
+        await db.execute(_upsert(db.get_bind().dialect.name), rows)
+
+
+# ------------------------------------------------------------
+# ログからの作り直し（コンパクションジョブ）
+# ------------------------------------------------------------
+def _as_utc(value: datetime) -> datetime:
+    # DateTime 列はタイムゾーン無しで保存されている（UTC）
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+def rebuild_savings_rollups(db: Session, user_ids: Optional[List[int]] = None) -> int:
+    """
+    tanabota_action_logs（とアーカイブ）から集計行を作り直す（user_ids=None で全ユーザー。コミットは呼び出し側）。
+    監査ログの write-behind が有効な場合は、キューが空の時に実行すること（未反映のログは数えられない）。
+    user_ids 指定時は users 行をロックして同じユーザーの決済を待たせる（MySQL 等）。
+    全ユーザーの作り直しは決済を止めた状態で行うこと。
+    作った行数を返す。
+    """
+    if user_ids is not None:
+        lock_user_rows(db, user_ids)
+    stmt = (
+        select(
+            TanabotaTransaction.id,
+            TanabotaTransaction.user_id,
+            TanabotaTransaction.created_at,
+            TanabotaTransaction.event_kind,
+            TanabotaActionLog.rule_id,
+            TanabotaActionLog.action_type,
+            TanabotaActionLog.tanabota_amount,
+        )
+        .join(TanabotaActionLog, TanabotaActionLog.transaction_id == TanabotaTransaction.id)
+        .order_by(TanabotaTransaction.id)
+    )
+    if user_ids is not None:
+        stmt = stmt.where(TanabotaTransaction.user_id.in_(user_ids))
+
+    acc = _Accumulator()
+    current: Optional[Tuple[int, int, str, str]] = None
+    executions: List[Tuple[Any, str, int]] = []
+    for tx_id, user_id, created_at, event_kind, rule_id, action_type, amount in db.execute(
+        stmt.execution_options(yield_per=ROLLUP_REBUILD_FETCH_SIZE)
+    ):
+        if current is None or current[0] != tx_id:
+            if current is not None:
+                acc.add_transaction(current[1], current[2], executions, current[3])
+            current = (tx_id, user_id, month_of(business_day(_as_utc(created_at))), event_kind)
+            executions = []
+        executions.append((rule_id, action_type, int(amount)))
+    if current is not None:
+        acc.add_transaction(current[1], current[2], executions, current[3])
+
+    # アーカイブへ移したログも数える（ヘッダはホット側に残っている）
+    for _, user_id, created_at, event_kind, logs in iter_archived_logs(db, user_ids, ROLLUP_REBUILD_FETCH_SIZE):
+        acc.add_transaction(
+            user_id,
+            month_of(business_day(_as_utc(created_at))),
+            ((l["rule_id"], l["action_type"], int(l["tanabota_amount"])) for l in logs),
+            event_kind,
+        )
+
+    clear = delete(UserSavingsRollup)
+    if user_ids is not None:
+        clear = clear.where(UserSavingsRollup.user_id.in_(user_ids))
+    db.execute(clear)
+    rows = acc.rows()
+    if rows:
+        db.execute(UserSavingsRollup.__table__.insert(), rows)
+    return len(rows)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="たなぼた月次集計をログから作り直す")
+    parser.add_argument("--user-id", type=int, nargs="*", help="対象ユーザー（省略時は全ユーザー）")
+    args = parser.parse_args()
+
+    session = SessionLocal()
+    try:
+        count = rebuild_savings_rollups(session, args.user_id or None)
+        session.commit()
+        print(f"✅ 集計行 {count} 件を作り直しました")
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
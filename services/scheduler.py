@@ -0,0 +1,383 @@
+"""
+時刻トリガー（毎週・月末・特定時刻・リマインダー）のスケジューラ
+ルールを次回発火時刻の最小ヒープで保持し、先頭が期限を迎えた時だけ起きて処理する
+（毎ティックのルールテーブル走査はしない）。
+- 起動時にスケジュール対象ルールだけをストリーミングで読み込み、ヒープを作る
+- 期限を迎えたルールは件数上限までまとめて取り出し、ユーザー単位の取引として保存する
+  （ユーザーの小グループごとに決済と同じロックを取り、1トランザクションでコミット）
+- 支払い無しでは金額にできないルール（支払額の割合・未対応のアクション）は読み込み時に警告して除く
+- ルール編集はプランキャッシュの無効化通知で受け取り、該当ユーザー分だけ読み直す
+  （古いエントリは世代番号で取り出し時に捨てる）。他プロセスでの編集は定期的な全件再読込で拾う
+停止中に過ぎた発火はさかのぼって処理しない。複数プロセスで動かすと二重に発火するため、
+SCHEDULER_ENABLED は1プロセスだけで有効にすること。
+"""
+from __future__ import annotations
+
+import heapq
+import itertools
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import or_
+
+from database import SessionLocal
+from models import Recipe, Trigger
+from services.audit_log_writer import audit_log_writer
+from services.rule_plan_cache import add_invalidation_listener
+from services.rule_registry import schedule_trigger_specs
+from services.tanabota import (
+    CompiledRule,
+    active_rules_query,
+    log_rows,
+    record_scheduled_firings,
+    unpriced_schedule_reason,
+)
+from services.user_locks import user_groups, user_locks
+
+# スケジューラを動かすか（1プロセスだけで有効にする）
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "false").lower() in ["true", "1", "yes"]
+# 1トランザクションで処理する発火件数の上限
+SCHEDULER_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "1000"))
+# 読み込み時のフェッチ件数（ストリーミング）
+SCHEDULER_LOAD_CHUNK = int(os.getenv("SCHEDULER_LOAD_CHUNK", "5000"))
+# 他プロセスでのルール編集を拾うための全件再読込の間隔（秒）。0以下で無効
+SCHEDULER_RESYNC_INTERVAL = float(os.getenv("SCHEDULER_RESYNC_INTERVAL", "3600"))
+# 保存失敗時の再試行間隔（秒）
+SCHEDULER_RETRY_INTERVAL = float(os.getenv("SCHEDULER_RETRY_INTERVAL", "5"))
+
+# ユーザー指定で読み直す時の IN 句1回あたりの件数
+_RELOAD_IN_CHUNK = 1000
+
+# (発火時刻UNIX秒, 挿入順, user_id, 世代, ルール)
+_Entry = Tuple[float, int, int, int, CompiledRule]
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class ScheduledTriggerEngine:
+    """時刻トリガーのルールを次回発火時刻順に保持し、期限到来分を一括で記録する（1プロセス1インスタンス）"""
+
+    def __init__(
+        self,
+        *,
+        enabled: bool = SCHEDULER_ENABLED,
+        batch_size: int = SCHEDULER_BATCH_SIZE,
+        resync_interval: float = SCHEDULER_RESYNC_INTERVAL,
+        session_factory=SessionLocal,
+        clock: Callable[[], datetime] = _utcnow,
+    ):
+        self.enabled = enabled
+        self.batch_size = max(1, int(batch_size))
+        self.resync_interval = float(resync_interval)
+        self.session_factory = session_factory
+        self.clock = clock
+
+        self._heap: List[_Entry] = []
+        self._seq = itertools.count()
+        # ユーザーごとの世代（読み直しで新しい番号を振り、古い世代のエントリは取り出し時に捨てる）
+        # 全件読み直しでは _base_generation を進めて全ユーザー分をまとめて古くする
+        self._generation_counter = itertools.count(1)
+        self._base_generation = 0
+        self._generations: Dict[int, int] = {}
+        # ユーザーごとの有効エントリ数と、ヒープに残っている古いエントリ数
+        self._counts: Dict[int, int] = {}
+        self._stale = 0
+        self._dirty: Set[int] = set()
+        self._reload_all = True
+        self._next_resync = 0.0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._listening = False
+        # 金額にできず除いたルール（user_id → {rule_id: 理由}）
+        self._unpriced: Dict[int, Dict[int, str]] = {}
+        self.fired = 0
+        self.recorded = 0
+        self.skipped = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.failed_firings = 0
+        self.last_error: Optional[str] = None
+
+    # ---------------- 読み込み ----------------
+    def _scheduled_rules_query(self, user_ids: Optional[List[int]] = None):
+        specs = schedule_trigger_specs()
+        stmt = active_rules_query().where(or_(
+            Trigger.id.in_([spec.trigger_id for spec in specs]),
+            Trigger.name.in_([spec.name for spec in specs]),
+        ))
+        if user_ids is not None:
+            stmt = stmt.where(Recipe.user_id.in_(user_ids))
+        return stmt.execution_options(yield_per=SCHEDULER_LOAD_CHUNK)
+
+    def _load_rules(
+        self, user_ids: Optional[List[int]] = None
+    ) -> Tuple[List[Tuple[int, CompiledRule]], Dict[int, Dict[int, str]]]:
+        """(発火させるルール, 金額にできず除いたルール user_id → {rule_id: 理由}) を返す"""
+        db = self.session_factory()
+        try:
+            rules: List[Tuple[int, CompiledRule]] = []
+            unpriced: Dict[int, Dict[int, str]] = {}
+            seen: Set[Tuple[int, int]] = set()
+            for rule, trigger, action, owner_id in db.execute(self._scheduled_rules_query(user_ids)):
+                if (owner_id, rule.id) in seen:
+                    continue
+                seen.add((owner_id, rule.id))
+                compiled = CompiledRule(rule, trigger, action)
+                if compiled.next_fire is None:
+                    continue
+                reason = unpriced_schedule_reason(compiled)
+                if reason is not None:
+                    unpriced.setdefault(owner_id, {})[compiled.rule_id] = reason
+                    continue
+                rules.append((owner_id, compiled))
+            return rules, unpriced
+        finally:
+            db.close()
+
+    def _set_unpriced(self, unpriced: Dict[int, Dict[int, str]], user_ids: Optional[List[int]] = None) -> None:
+        """除いたルールを差し替え、新しく除いたものだけ警告する（全件再読込のたびに同じ警告を出さない）"""
+        with self._lock:
+            previous = {uid: self._unpriced.get(uid, {}) for uid in unpriced}
+            if user_ids is None:
+                self._unpriced = dict(unpriced)
+            else:
+                for uid in user_ids:
+                    self._unpriced.pop(uid, None)
+                self._unpriced.update(unpriced)
+        for uid, reasons in unpriced.items():
+            for rule_id, reason in reasons.items():
+                if rule_id not in previous.get(uid, {}):
+                    print(f"⚠️  時刻トリガーのルールを発火対象から除きました（user_id={uid}, rule_id={rule_id}）: {reason}")
+
+    def _push(self, user_id: int, generation: int, rule: CompiledRule, after: datetime) -> None:
+        # ロック取得済みで呼ぶこと
+        fire_at = rule.next_fire(after)
+        heapq.heappush(self._heap, (fire_at.timestamp(), next(self._seq), user_id, generation, rule))
+        self._counts[user_id] = self._counts.get(user_id, 0) + 1
+
+    def reload(self, user_ids: Optional[Iterable[int]] = None) -> int:
+        """ルールを読み直してヒープに積む（user_ids=None で全件を作り直す）。積んだ件数を返す"""
+        now = self.clock()
+        if user_ids is None:
+            rules, unpriced = self._load_rules()
+            self._set_unpriced(unpriced)
+            with self._lock:
+                self._heap = []
+                self._base_generation = next(self._generation_counter)
+                self._generations = {}
+                self._counts = {}
+                self._stale = 0
+                for uid, rule in rules:
+                    self._push(uid, self._base_generation, rule, now)
+            return len(rules)
+
+        user_ids = list(dict.fromkeys(user_ids))
+        rules = []
+        unpriced: Dict[int, Dict[int, str]] = {}
+        for start in range(0, len(user_ids), _RELOAD_IN_CHUNK):
+            chunk_rules, chunk_unpriced = self._load_rules(user_ids[start:start + _RELOAD_IN_CHUNK])
+            rules.extend(chunk_rules)
+            unpriced.update(chunk_unpriced)
+        self._set_unpriced(unpriced, user_ids)
+        with self._lock:
+            for uid in user_ids:
+                self._generations[uid] = next(self._generation_counter)
+                self._stale += self._counts.pop(uid, 0)
+            self._compact_if_stale()
+            for uid, rule in rules:
+                self._push(uid, self._generations[uid], rule, now)
+        return len(rules)
+
+    def _is_current(self, entry: _Entry) -> bool:
+        # ロック取得済みで呼ぶこと
+        return self._generations.get(entry[2], self._base_generation) == entry[3]
+
+    def _compact_if_stale(self) -> None:
+        # ロック取得済みで呼ぶこと。古い世代のエントリが半分を超えたら作り直す
+        if self._stale > 1024 and self._stale * 2 > len(self._heap):
+            self._heap = [e for e in self._heap if self._is_current(e)]
+            heapq.heapify(self._heap)
+            self._stale = 0
+
+    def notify(self, user_id: Optional[int] = None) -> None:
+        """ルール変更の通知（プランキャッシュの無効化と同時に呼ばれる）"""
+        with self._lock:
+            if user_id is None:
+                self._reload_all = True
+            else:
+                self._dirty.add(user_id)
+        self._wake.set()
+
+    def _reload_pending(self) -> None:
+        with self._lock:
+            if self.resync_interval > 0 and time.monotonic() >= self._next_resync:
+                self._reload_all = True
+            reload_all, self._reload_all = self._reload_all, False
+            dirty, self._dirty = self._dirty, set()
+        if reload_all:
+            self.reload()
+            self._next_resync = time.monotonic() + self.resync_interval
+        elif dirty:
+            self.reload(dirty)
+
+    # ---------------- 発火 ----------------
+    def _pop_due(self, now: datetime) -> List[_Entry]:
+        limit = now.timestamp()
+        due: List[_Entry] = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= limit and len(due) < self.batch_size:
+                entry = heapq.heappop(self._heap)
+                if not self._is_current(entry):
+                    self._stale -= 1
+                    continue  # 読み直し済みユーザーの古いエントリ
+                self._counts[entry[2]] -= 1
+                due.append(entry)
+        return due
+
+    def _record(self, user_ids: List[int], entries: List[_Entry]) -> int:
+        """
+        1グループ分を保存する。決済と同じくプロセス内ロック → users 行ロックの順に取り、
+        1トランザクションでコミットする。記録したログ件数を返す
+        """
+        firings = [
+            (uid, rule, datetime.fromtimestamp(fire_ts, timezone.utc))
+            for fire_ts, _, uid, _, rule in entries
+        ]
+        with user_locks.hold(*user_ids):
+            db = self.session_factory()
+            try:
+                results = record_scheduled_firings(db, firings, defer_logs=audit_log_writer.enabled)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+        if audit_log_writer.enabled:
+            for result in results:
+                audit_log_writer.submit(log_rows(result))
+        return sum(len(result.executions) for result in results)
+
+    def run_due(self, now: Optional[datetime] = None) -> int:
+        """
+        期限を迎えた発火を1バッチ分処理し、次回分を積み直す。処理件数を返す。
+        保存はユーザーの小グループ単位で、失敗したグループの分だけ元の発火時刻のまま戻す
+        （1件でも失敗すれば例外を送出し、次の周回で再試行する）
+        """
+        due = self._pop_due(now or self.clock())
+        if not due:
+            return 0
+        by_user: Dict[int, List[_Entry]] = {}
+        for entry in due:
+            by_user.setdefault(entry[2], []).append(entry)
+
+        done: List[_Entry] = []
+        failed: List[_Entry] = []
+        error: Optional[Exception] = None
+        for group in user_groups(by_user):
+            entries = [entry for uid in group for entry in by_user[uid]]
+            try:
+                recorded = self._record(group, entries)
+            except Exception as e:
+                failed.extend(entries)
+                error = e
+                continue
+            done.extend(entries)
+            self.recorded += recorded
+            self.skipped += len(entries) - recorded
+
+        with self._lock:
+            for entry in failed:
+                heapq.heappush(self._heap, entry)
+                if self._is_current(entry):
+                    self._counts[entry[2]] = self._counts.get(entry[2], 0) + 1
+                else:
+                    self._stale += 1
+            for fire_ts, _, uid, generation, rule in done:
+                if self._generations.get(uid, self._base_generation) == generation:
+                    self._push(uid, generation, rule, datetime.fromtimestamp(fire_ts, timezone.utc))
+        self.fired += len(done)
+        self.batches += 1
+        if error is not None:
+            self.failed_batches += 1
+            self.failed_firings += len(failed)
+            self.last_error = f"{type(error).__name__}: {error}"
+            raise error
+        return len(due)
+
+    def _seconds_until_next(self) -> Optional[float]:
+        with self._lock:
+            if not self._heap:
+                wait = None
+            else:
+                wait = max(0.0, self._heap[0][0] - self.clock().timestamp())
+        if self.resync_interval > 0:
+            until_resync = max(0.0, self._next_resync - time.monotonic())
+            wait = until_resync if wait is None else min(wait, until_resync)
+        return wait
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            # 通知の取りこぼしを防ぐため、待機前ではなく処理前にクリアする
+            self._wake.clear()
+            try:
+                self._reload_pending()
+                if self.run_due():
+                    continue
+            except Exception as e:
+                print(f"⚠️  スケジュール実行に失敗しました（再試行します）: {e}")
+                self._stop.wait(SCHEDULER_RETRY_INTERVAL)
+                continue
+            self._wake.wait(self._seconds_until_next())
+
+    # ---------------- ライフサイクル ----------------
+    def start(self) -> None:
+        """通知の受け取りを登録してスレッドを起動する（ルールの読み込みはスレッド側で行う）"""
+        if not self.enabled or self._thread is not None:
+            return
+        if not self._listening:
+            add_invalidation_listener(self.notify)
+            self._listening = True
+        self._stop.clear()
+        with self._lock:
+            self._reload_all = True
+        self._thread = threading.Thread(target=self._run, name="scheduled-triggers", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            next_ts = self._heap[0][0] if self._heap else None
+            scheduled = len(self._heap) - self._stale
+            unpriced = sum(len(reasons) for reasons in self._unpriced.values())
+        return {
+            "enabled": self.enabled,
+            "running": self._thread is not None,
+            "scheduled": scheduled,
+            "unpriced_rules": unpriced,
+            "next_fire_at": datetime.fromtimestamp(next_ts, timezone.utc).isoformat() if next_ts else None,
+            "fired": self.fired,
+            "recorded": self.recorded,
+            "skipped": self.skipped,
+            "batches": self.batches,
+            "failed_batches": self.failed_batches,
+            "failed_firings": self.failed_firings,
+            "last_error": self.last_error,
+        }
+
+
+scheduled_trigger_engine = ScheduledTriggerEngine()
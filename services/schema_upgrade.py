@@ -0,0 +1,116 @@
+"""
+既存DBのスキーマ追従（create_all では足りない分）
+models.py の create_all は無いテーブルを作るだけで、既存テーブルへ後から足したインデックス・列は作らない。
+ここでまとめて確認・追加する（models の import 時には何もしない）。
+- アプリ起動時（main.py の startup）に upgrade_schema() を1回呼ぶ
+- 単体でも実行できる: python -m services.schema_upgrade
+"""
+from __future__ import annotations
+
+import threading
+from typing import Dict, List, Optional
+
+from sqlalchemy import inspect, select, text, update
+from sqlalchemy.engine import Connection, Engine
+
+from database import engine
+from models import (
+    EVENT_KIND_INCOME,
+    EVENT_KIND_PAYMENT,
+    EVENT_KIND_SCHEDULE,
+    TanabotaActionLog,
+    TanabotaActionLogArchive,
+    TanabotaTransaction,
+)
+from services.action_log_archive import decompress_logs
+
+_lock = threading.Lock()
+# tanabota_action_logs.action_params_json が NULL 可か（None は未確認）
+_action_params_json_nullable: Optional[bool] = None
+
+
+def _log_columns(bind: Engine):
+    return {c["name"]: c for c in inspect(bind).get_columns(TanabotaActionLog.__tablename__)}
+
+
+def _event_kind_of(result_json) -> Optional[str]:
+    """ログの result_json から決済以外の記録の種別を推定する（決済なら None）"""
+    if isinstance(result_json, dict):
+        if "income_amount" in result_json:
+            return EVENT_KIND_INCOME
+        if "scheduled_at" in result_json:
+            return EVENT_KIND_SCHEDULE
+    return None
+
+
+def _backfill_event_kinds(conn: Connection) -> None:
+    """
+    event_kind 追加前の行は全て payment になるため、支払額 0 のヘッダをログ（とアーカイブ）の result_json から振り分け直す
+    """
+    tx = TanabotaTransaction.__table__
+    kinds: Dict[int, str] = {}
+    for tx_id, result_json in conn.execute(
+        select(TanabotaActionLog.transaction_id, TanabotaActionLog.result_json)
+        .join(tx, tx.c.id == TanabotaActionLog.transaction_id)
+        .where(tx.c.amount_paid == 0)
+    ):
+        kind = _event_kind_of(result_json)
+        if kind:
+            kinds[tx_id] = kind
+    for tx_id, payload in conn.execute(
+        select(TanabotaActionLogArchive.transaction_id, TanabotaActionLogArchive.payload)
+        .join(tx, tx.c.id == TanabotaActionLogArchive.transaction_id)
+        .where(tx.c.amount_paid == 0)
+    ):
+        for log in decompress_logs(payload):
+            kind = _event_kind_of(log.get("result_json"))
+            if kind:
+                kinds[tx_id] = kind
+    by_kind: Dict[str, List[int]] = {}
+    for tx_id, kind in kinds.items():
+        by_kind.setdefault(kind, []).append(tx_id)
+    for kind, ids in by_kind.items():
+        conn.execute(update(tx).where(tx.c.id.in_(ids)).values(event_kind=kind))
+
+
+def upgrade_schema(bind: Engine = engine) -> None:
+    """後から追加したインデックス・列を既存テーブルに足す（何度呼んでもよい）"""
+    global _action_params_json_nullable
+
+    # create_all は既存テーブルに後から追加したインデックスを作らないため、個別に確認して作成
+    for index in TanabotaTransaction.__table__.indexes:
+        index.create(bind=bind, checkfirst=True)
+
+    # 既存の tanabota_transactions へ取引種別の列を足し、既存の入金・時刻トリガーの記録を振り分ける
+    if "event_kind" not in {c["name"] for c in inspect(bind).get_columns(TanabotaTransaction.__tablename__)}:
+        with bind.begin() as conn:
+            conn.execute(text(
+                f"ALTER TABLE tanabota_transactions ADD COLUMN event_kind VARCHAR(16) NOT NULL DEFAULT '{EVENT_KIND_PAYMENT}'"
+            ))
+            _backfill_event_kinds(conn)
+
+    # 同様に、既存の tanabota_action_logs へ後から追加した列を足す
+    # （MySQL は action_params_json の NOT NULL も外す。SQLite は外せないため従来どおりJSONも書く）
+    columns = _log_columns(bind)
+    if "action_params_id" not in columns:
+        with bind.begin() as conn:
+            conn.execute(text("ALTER TABLE tanabota_action_logs ADD COLUMN action_params_id BIGINT NULL"))
+            if bind.dialect.name == "mysql":
+                conn.execute(text("ALTER TABLE tanabota_action_logs MODIFY action_params_json JSON NULL"))
+        columns = _log_columns(bind)
+    with _lock:
+        _action_params_json_nullable = bool(columns["action_params_json"]["nullable"])
+
+
+def action_params_json_nullable() -> bool:
+    """False なら旧スキーマ（ログにもパラメータのJSONを書く必要がある）。初回だけDBを確認する"""
+    global _action_params_json_nullable
+    with _lock:
+        if _action_params_json_nullable is None:
+            _action_params_json_nullable = bool(_log_columns(engine)["action_params_json"]["nullable"])
+        return _action_params_json_nullable
+
+
+if __name__ == "__main__":
+    upgrade_schema()
+    print("✅ スキーマを更新しました")
@@ -0,0 +1,181 @@
+"""
+レシピテンプレートのバックテスト（what-if シミュレーション）
+ユーザーの過去の支払い履歴、または任意の支払いストリームに対して
+レシピテンプレートのルールを適用した場合のたなぼた額を試算する（DBには何も書き込まない）。
+評価は services.vectorized_engine で支払い配列ごとに一括で行う。
+デモ用の強制発火（pick_demo_fallback）は実際の節約額ではないため含めない。
+"""
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from models import (
+    EVENT_KIND_PAYMENT,
+    Action,
+    RecipeTemplate,
+    RecipeTemplateRuleTemplate,
+    RuleTemplate,
+    TanabotaTransaction,
+    Trigger,
+    User,
+)
+from services.rng import numpy_rng
+from services.tanabota import CompiledRule
+from services.vectorized_engine import PaymentArrays, VectorRule
+
+# 履歴を読むときの1回あたりの取得件数（ORMオブジェクトは作らず列だけをストリーミング）
+HISTORY_FETCH_SIZE = 5000
+# 履歴の既定の遡り日数
+DEFAULT_LOOKBACK_DAYS = 365
+
+
+# ------------------------------------------------------------
+# 入力の読み込み
+# ------------------------------------------------------------
+def load_payment_history(
+    db: Session, user_id: int, *, days: Optional[int] = DEFAULT_LOOKBACK_DAYS
+) -> PaymentArrays:
+    """
+    ユーザーの TanabotaTransaction 履歴を支払い配列として読み込む（決済だけ。入金などの記録は含めない）。
+    取引ヘッダにはカテゴリを保存していないため、カテゴリは全件「無し」になる。
+    """
+    stmt = select(TanabotaTransaction.amount_paid).where(
+        TanabotaTransaction.user_id == user_id,
+        TanabotaTransaction.event_kind == EVENT_KIND_PAYMENT,
+    )
+    if days is not None and days > 0:
+        since = datetime.now(timezone.utc) - timedelta(days=days)
+        stmt = stmt.where(TanabotaTransaction.created_at >= since)
+    stmt = stmt.order_by(TanabotaTransaction.id).execution_options(yield_per=HISTORY_FETCH_SIZE)
+
+    chunks: List[np.ndarray] = []
+    for part in db.execute(stmt).partitions():
+        chunks.append(np.fromiter((int(row[0]) for row in part), dtype=np.int64, count=len(part)))
+    amounts = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int64)
+    return PaymentArrays(amounts)
+
+
+def load_template_rules(
+    db: Session, template_ids: Sequence[int]
+) -> Dict[int, List[Tuple[CompiledRule, str]]]:
+    """
+    レシピテンプレートID → [(CompiledRule, ルールテンプレート名)] を1クエリで読み込む。
+    存在しない（またはルールを持たない）テンプレートは結果に含まれない。
+    """
+    stmt = (
+        select(RecipeTemplateRuleTemplate.recipe_template_id, RuleTemplate, Trigger, Action)
+        .join(RuleTemplate, RuleTemplate.id == RecipeTemplateRuleTemplate.rule_template_id)
+        .join(Trigger, Trigger.id == RuleTemplate.trigger_id)
+        .join(Action, Action.id == RuleTemplate.action_id)
+        .where(RecipeTemplateRuleTemplate.recipe_template_id.in_(list(template_ids)))
+        .order_by(RecipeTemplateRuleTemplate.recipe_template_id, RuleTemplate.id)
+    )
+    compiled: Dict[int, Tuple[CompiledRule, str]] = {}
+    by_template: Dict[int, List[Tuple[CompiledRule, str]]] = {}
+    for template_id, rule, trig, act in db.execute(stmt).all():
+        # 同じルールテンプレートを複数のレシピで共有していても1回だけコンパイルする
+        if rule.id not in compiled:
+            compiled[rule.id] = (CompiledRule(rule, trig, act), rule.name)
+        by_template.setdefault(template_id, []).append(compiled[rule.id])
+    return by_template
+
+
+# ------------------------------------------------------------
+# 評価
+# ------------------------------------------------------------
+def simulate_templates(
+    rules_by_template: Dict[int, List[Tuple[CompiledRule, str]]],
+    payments: PaymentArrays,
+    rng: Optional[np.random.Generator] = None,
+) -> Dict[int, Dict[str, Any]]:
+    """
+    テンプレートごとの試算結果を返す。
+    ルール単位の金額配列は1回だけ計算し、同じルールを含むテンプレート間で使い回す。
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    n = len(payments)
+    total_paid = int(payments.amounts.sum()) if n else 0
+    per_rule: Dict[int, np.ndarray] = {}
+
+    results: Dict[int, Dict[str, Any]] = {}
+    for template_id, rules in rules_by_template.items():
+        saved = np.zeros(n, dtype=np.int64)
+        items: List[Dict[str, Any]] = []
+        for rule, name in rules:
+            amounts = per_rule.get(rule.rule_id)
+            if amounts is None:
+                amounts = per_rule[rule.rule_id] = VectorRule(rule).evaluate(payments, rng)
+            saved += amounts
+            items.append({
+                "rule_template_id": rule.rule_id,
+                "name": name,
+                "action_type": rule.action_type,
+                "fired_count": int(np.count_nonzero(amounts)),
+                "tanabota_total": int(amounts.sum()),
+            })
+        results[template_id] = {
+            "recipe_template_id": template_id,
+            "payment_count": n,
+            "amount_paid_total": total_paid,
+            "tanabota_total": int(saved.sum()),
+            "fired_payment_count": int(np.count_nonzero(saved)),
+            "rules": items,
+        }
+    return results
+
+
+def _empty_result(template_id: int, payments: PaymentArrays) -> Dict[str, Any]:
+    return {
+        "recipe_template_id": template_id,
+        "payment_count": len(payments),
+        "amount_paid_total": int(payments.amounts.sum()) if len(payments) else 0,
+        "tanabota_total": 0,
+        "fired_payment_count": 0,
+        "rules": [],
+    }
+
+
+# ------------------------------------------------------------
+# 公開API
+# ------------------------------------------------------------
+def simulate_recipe_templates(
+    db: Session,
+    template_ids: Iterable[int],
+    *,
+    user_id: Optional[int] = None,
+    payments: Optional[PaymentArrays] = None,
+    days: Optional[int] = DEFAULT_LOOKBACK_DAYS,
+    seed: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    レシピテンプレート群を試算する。payments を渡せばそれを、
+    渡さなければ user_id の過去履歴（days 日分）を使う。
+    存在しないテンプレートID・ユーザーIDは ValueError。
+    """
+    ids = list(dict.fromkeys(template_ids))
+    found = set(db.execute(select(RecipeTemplate.id).where(RecipeTemplate.id.in_(ids))).scalars())
+    missing = [tid for tid in ids if tid not in found]
+    if missing:
+        raise ValueError(f"レシピテンプレートが見つかりません: {missing}")
+
+    if payments is None:
+        if user_id is None:
+            raise ValueError("user_id または支払いストリームを指定してください")
+        if db.get(User, user_id) is None:
+            raise ValueError("ユーザーが見つかりません")
+        payments = load_payment_history(db, user_id, days=days)
+
+    rng = numpy_rng(seed, "simulate", ids, user_id, days)
+    results = simulate_templates(load_template_rules(db, ids), payments, rng)
+    return [results.get(tid) or _empty_result(tid, payments) for tid in ids]
+
+
+def public_recipe_template_ids(db: Session) -> List[int]:
+    """公開中のレシピテンプレートID一覧"""
+    stmt = select(RecipeTemplate.id).where(RecipeTemplate.is_public.is_(True)).order_by(RecipeTemplate.id)
+    return list(db.execute(stmt).scalars())
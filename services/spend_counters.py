@@ -0,0 +1,216 @@
+"""
+ユーザー別の支出カウンタ（user_spend_counters）
+決済のたびに (ユーザー, 日, カテゴリ) と (ユーザー, 累計, カテゴリ) の行へ加算しておき、
+取引テーブルを集計し直さずにゼロ日・レベルアップのトリガーを判定する。
+- 日付の区切りは時刻トリガーと同じタイムゾーン（SCHEDULE_TIMEZONE）
+- 加算は UPSERT（MySQL: ON DUPLICATE KEY UPDATE / SQLite: ON CONFLICT）の executemany 1回
+- 判定用の読み込みは「当日・前日・累計」の行だけ（主キー範囲の1クエリ）
+"""
+from __future__ import annotations
+
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from models import UserSpendCounter
+from services.rule_registry import SCHEDULE_TZ
+
+# 全カテゴリ合計の行
+ALL_CATEGORIES = "*"
+# 累計の行
+PERIOD_TOTAL = "total"
+
+_Key = Tuple[str, str]  # (period, category)
+
+
+def business_day(now: Optional[datetime] = None) -> date:
+    """カウンタの日付（SCHEDULE_TIMEZONE の暦日）"""
+    return (now or datetime.now(timezone.utc)).astimezone(SCHEDULE_TZ).date()
+
+
+def period_of(day: date) -> str:
+    return day.isoformat()
+
+
+class SpendCounters:
+    """1ユーザー分のカウンタ（当日・前日・累計）。同じユーザーを続けて評価する時は add で加算していく"""
+    __slots__ = ("user_id", "day", "_values")
+
+    def __init__(self, user_id: int, day: date, rows: Iterable[UserSpendCounter] = ()):
+        self.user_id = user_id
+        self.day = day
+        # (period, category) → [支出額, 支出回数, たなぼた額]
+        self._values: Dict[_Key, List[int]] = {
+            (r.period, r.category): [int(r.spend_amount), int(r.spend_count), int(r.tanabota_amount)]
+            for r in rows
+        }
+
+    def _get(self, period: str, category: str) -> List[int]:
+        return self._values.get((period, category), [0, 0, 0])
+
+    def spend(self, category: str = ALL_CATEGORIES, days_ago: int = 0) -> int:
+        return self._get(period_of(self.day - timedelta(days=days_ago)), category)[0]
+
+    def count(self, category: str = ALL_CATEGORIES, days_ago: int = 0) -> int:
+        return self._get(period_of(self.day - timedelta(days=days_ago)), category)[1]
+
+    @property
+    def saved_total(self) -> int:
+        """累計たなぼた額（全カテゴリ）"""
+        return self._get(PERIOD_TOTAL, ALL_CATEGORIES)[2]
+
+    def add(self, amount_paid: int, category: Optional[str], tanabota: int, spend_count: int = 1) -> None:
+        for key in _keys(self.day, category):
+            values = self._values.setdefault(key, [0, 0, 0])
+            values[0] += amount_paid
+            values[1] += spend_count
+            values[2] += tanabota
+
+
+class CounterContext:
+    """カウンタ系トリガーの評価に渡す情報（カウンタはこの決済を加算する前の値）"""
+    __slots__ = ("counters", "category", "tanabota_total")
+
+    def __init__(self, counters: SpendCounters, category: Optional[str], tanabota_total: int):
+        self.counters = counters
+        self.category = category
+        # 同じ決済で通常ルールが確定させたたなぼた額
+        self.tanabota_total = tanabota_total
+
+    @property
+    def day(self) -> date:
+        return self.counters.day
+
+    @property
+    def first_of_day(self) -> bool:
+        """その日最初の支出か（日次のトリガーを1日1回にするため）"""
+        return self.counters.count() == 0
+
+    def spend(self, category: str = ALL_CATEGORIES, days_ago: int = 0) -> int:
+        return self.counters.spend(category, days_ago)
+
+    @property
+    def saved_before(self) -> int:
+        return self.counters.saved_total
+
+    @property
+    def saved_after(self) -> int:
+        return self.counters.saved_total + self.tanabota_total
+
+
+def _keys(day: date, category: Optional[str]) -> List[_Key]:
+    periods = (period_of(day), PERIOD_TOTAL)
+    categories = (ALL_CATEGORIES, category) if category else (ALL_CATEGORIES,)
+    return [(p, c) for p in periods for c in categories]
+
+
+# ------------------------------------------------------------
+# 読み込み
+# ------------------------------------------------------------
+def spend_counters_query(user_ids: List[int], day: date):
+    periods = [period_of(day), period_of(day - timedelta(days=1)), PERIOD_TOTAL]
+    return select(UserSpendCounter).where(
+        UserSpendCounter.user_id.in_(user_ids),
+        UserSpendCounter.period.in_(periods),
+    )
+
+
+def _group(user_ids: List[int], day: date, rows) -> Dict[int, SpendCounters]:
+    by_user: Dict[int, List[UserSpendCounter]] = {uid: [] for uid in user_ids}
+    for row in rows:
+        by_user[row.user_id].append(row)
+    return {uid: SpendCounters(uid, day, user_rows) for uid, user_rows in by_user.items()}
+
+
+def load_spend_counters(db: Session, user_ids: List[int], day: date) -> Dict[int, SpendCounters]:
+    """複数ユーザーの当日・前日・累計カウンタを1クエリで取得する"""
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return {}
+    return _group(user_ids, day, db.execute(spend_counters_query(user_ids, day)).scalars())
+
+
+async def load_spend_counters_async(db: AsyncSession, user_ids: List[int], day: date) -> Dict[int, SpendCounters]:
+    """load_spend_counters の非同期版"""
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return {}
+    return _group(user_ids, day, (await db.execute(spend_counters_query(user_ids, day))).scalars())
+
+
+# ------------------------------------------------------------
+# 加算
+# ------------------------------------------------------------
+def counter_rows(
+    entries: Iterable[Tuple[int, int, Optional[str], int, int]],
+    day: date,
+) -> List[Dict[str, object]]:
+    """
+    (user_id, 支出額, カテゴリ, たなぼた額, 支出回数) から加算用の行を作る。
+    同じキーはまとめるため、一括処理でも1キー1行になる。
+    """
+    merged: Dict[Tuple[int, str, str], List[int]] = {}
+    for user_id, amount_paid, category, tanabota, spend_count in entries:
+        for period, cat in _keys(day, category):
+            values = merged.setdefault((user_id, period, cat), [0, 0, 0])
+            values[0] += amount_paid
+            values[1] += spend_count
+            values[2] += tanabota
+    now = datetime.now(timezone.utc)
+    return [
+        {
+            "user_id": user_id,
+            "period": period,
+            "category": category,
+            "spend_amount": spend,
+            "spend_count": count,
+            "tanabota_amount": tanabota,
+            "updated_at": now,
+        }
+        for (user_id, period, category), (spend, count, tanabota) in merged.items()
+    ]
+
+
+def additive_upsert(dialect_name: str, table, key_columns: List[str], add_columns: List[str]):
+    """
+    キー重複時に add_columns を加算する UPSERT 文（updated_at は新しい値で上書き）。
+    MySQL: ON DUPLICATE KEY UPDATE / SQLite・PostgreSQL: ON CONFLICT DO UPDATE
+    """
+    if dialect_name == "mysql":
+        stmt = mysql.insert(table)
+        new = stmt.inserted
+        return stmt.on_duplicate_key_update(
+            **{c: table.c[c] + new[c] for c in add_columns},
+            updated_at=new.updated_at,
+        )
+    stmt = (postgresql if dialect_name == "postgresql" else sqlite).insert(table)
+    new = stmt.excluded
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c[c] for c in key_columns],
+        set_={**{c: table.c[c] + new[c] for c in add_columns}, "updated_at": new.updated_at},
+    )
+
+
+def _upsert(dialect_name: str):
+    return additive_upsert(
+        dialect_name,
+        UserSpendCounter.__table__,
+        ["user_id", "period", "category"],
+        ["spend_amount", "spend_count", "tanabota_amount"],
+    )
+
+
+def add_spend_counters(db: Session, rows: List[Dict[str, object]]) -> None:
+    """counter_rows の行を加算する（コミットは呼び出し側）"""
+    if rows:
+        db.execute(_upsert(db.get_bind().dialect.name), rows)
+
+
+async def add_spend_counters_async(db: AsyncSession, rows: List[Dict[str, object]]) -> None:
+    """add_spend_counters の非同期版"""
+    if rows:
+        await db.execute(_upsert(db.get_bind().dialect.name), rows)
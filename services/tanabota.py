@@ -1,11 +1,15 @@
 # services/tanabota.py
 from __future__ import annotations
+import asyncio
 import random
-from typing import Dict, Any, List, Tuple, Optional
+from datetime import date, datetime
+from typing import Dict, Any, Iterable, List, Tuple, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sqlalchemy import select, and_
+from sqlalchemy import insert, select
 
 from models import (
+    User,
     TanabotaTransaction,
     TanabotaActionLog,
     Rule,
@@ -13,121 +17,56 @@ from models import (
     RecipeRule,
     Trigger,
     Action,
+    EVENT_KIND_INCOME,
+    EVENT_KIND_PAYMENT,
+    EVENT_KIND_SCHEDULE,
+)
+from services.action_param_snapshots import action_param_snapshots
+from services.pos_metrics import (
+    STAGE_BUILD_LOGS,
+    STAGE_EVALUATE,
+    STAGE_FLUSH,
+    STAGE_LOAD_RULES,
+    count_rules,
+    stage,
+)
+from services.rng import use_rng
+from services.schema_upgrade import action_params_json_nullable
+from services.savings_rollup import add_savings_rollups, add_savings_rollups_async, rollup_rows
+from services.user_locks import lock_user_rows, lock_user_rows_async
+from services.rule_plan_cache import rule_plan_cache
+from services.spend_counters import (
+    CounterContext,
+    SpendCounters,
+    add_spend_counters,
+    add_spend_counters_async,
+    business_day,
+    counter_rows,
+    load_spend_counters,
+    load_spend_counters_async,
+)
+from services.rule_registry import (
+    EVENT_COUNTER,
+    EVENT_INCOME,
+    EVENT_PAYMENT,
+    EVENT_SCHEDULE,
+    FALLBACK_STAGE_GACHA,
+    FallbackFn,
+    NextFireFn,
+    compile_action,
+    compile_action_spec,
+    compile_trigger,
+    compile_trigger_spec,
+    find_action_spec,
+    infer_action_type,
 )
 
 # ------------------------------------------------------------
 # 金額算出（日本円・整数）
 # ------------------------------------------------------------
 def compute_amount(action_params: Dict[str, Any], amount_paid: int) -> int:
-    """
-    既存 seed / マスタに合わせた柔軟な解釈。
-    サポート:
-      - percentage/percent（割合）
-      - amount（固定額）
-      - roundup: {"to": 100}  → 100円単位に切り上げ差額
-      - penalty_over_base: {"base_amount": 700} → max(0, amount - base)
-      - random range: {"min_amount": 1, "max_amount": 1000}
-      - percentage + bonus: {"percentage": 5, "level_bonus": 500}
-      - growth_multiplier: {"growth_multiplier": 1.5} → 150% として扱う
-    """
-    p = action_params or {}
-    a = int(amount_paid)
-
-    t = p.get("type")
-
-    # 型が無い場合はキーから推測
-    if not t:
-        if "percentage" in p or "percent" in p or "growth_multiplier" in p:
-            t = "save_percentage"
-        elif "base_amount" in p:
-            t = "penalty_over_base"
-        elif "min_amount" in p and "max_amount" in p:
-            t = "random_range"
-        elif "amount" in p:
-            t = "fixed"
-        elif "to" in p:
-            t = "roundup"
-        else:
-            return 0
-
-    if t == "save_percentage":
-        # growth_multiplier(1.5) → 150% も受け入れる
-        if "growth_multiplier" in p and "percentage" not in p and "percent" not in p:
-            try:
-                pct = int(round(float(p["growth_multiplier"]) * 100))
-            except (TypeError, ValueError):
-                pct = 0
-        else:
-            try:
-                pct = int(p.get("percent", p.get("percentage", 0)) or 0)
-            except (TypeError, ValueError):
-                pct = 0
-        amt = (a * pct) // 100 if pct > 0 else 0
-
-        # 固定ボーナス加算（例: 109 の level_bonus）
-        try:
-            bonus = int(p.get("level_bonus", 0) or 0)
-        except (TypeError, ValueError):
-            bonus = 0
-        return max(0, amt + bonus)
-
-    if t == "fixed":
-        try:
-            amt = int(p.get("amount", 0) or 0)
-        except (TypeError, ValueError):
-            return 0
-        return max(0, amt)
-
-    if t == "roundup":
-        try:
-            step = int(p.get("to", 100) or 100)
-        except (TypeError, ValueError):
-            return 0
-        if step <= 0:
-            return 0
-        rem = a % step
-        return (step - rem) if rem else 0
-
-    if t == "penalty_over_base":
-        try:
-            base = int(p.get("base_amount", 0) or 0)
-        except (TypeError, ValueError):
-            base = 0
-        return max(0, a - base)
-
-    if t == "random_range":
-        try:
-            lo = int(p.get("min_amount", 0) or 0)
-            hi = int(p.get("max_amount", 0) or 0)
-        except (TypeError, ValueError):
-            return 0
-        if hi < lo:
-            lo, hi = hi, lo
-        return random.randint(lo, hi) if hi > 0 else 0
-
-    return 0
-
-# ------------------------------------------------------------
-# アクションタイプ推測（ログ用）
-# ------------------------------------------------------------
-def infer_action_type(p: Dict[str, Any]) -> str:
-    if not p:
-        return "unknown"
-    if p.get("type"):
-        return str(p["type"])
-    if "percentage" in p or "percent" in p or "growth_multiplier" in p:
-        return "save_percentage"
-    if "amount" in p:
-        return "fixed"
-    if "to" in p:
-        return "roundup"
-    if "base_amount" in p:
-        return "penalty_over_base"
-    if "min_amount" in p and "max_amount" in p:
-        return "random_range"
-    if "level_bonus" in p:
-        return "percentage_plus_bonus"
-    return "unknown"
+    """単発評価用。解釈ルールは services.rule_registry のアクション定義を参照。"""
+    return compile_action(action_params)(int(amount_paid))
 
 # ------------------------------------------------------------
 # トリガ評価
@@ -139,72 +78,8 @@ def trigger_match(
     *,
     category: str | None = None
 ) -> bool:
-    name = (trigger_name or "").strip()
-    tp = trigger_params or {}
-    a = int(amount_paid)
-
-    # 3) 支出発生
-    if name == "支出発生":
-        min_amt = tp.get("min_amount")
-        if min_amt is not None:
-            try:
-                if a < int(min_amt):
-                    return False
-            except (TypeError, ValueError):
-                return False
-        return True
-
-    # 4) 特定カテゴリでの支出
-    if name == "特定カテゴリでの支出":
-        cats = set(tp.get("categories") or [])
-        if not cats:
-            return True  # 定義ミスの保険（categories未設定なら素通し）
-        if not category:
-            return False
-        return category in cats
-
-    # 6) 条件付き支出
-    if name == "条件付き支出":
-        try:
-            thr = int(tp.get("amount"))
-        except (TypeError, ValueError):
-            return False
-        op = (tp.get("operator") or ">").strip()
-
-        # カテゴリ条件が指定されていればチェック（無ければ金額条件だけで判定）
-        cat_cond = tp.get("category")
-        if cat_cond:
-            if not category:
-                return False
-            if category != cat_cond:
-                return False
-
-        if   op == ">":  return a >  thr
-        elif op == ">=": return a >= thr
-        elif op == "<":  return a <  thr
-        elif op == "<=": return a <= thr
-        else:            return True  # 未知演算子は通す（デモ向け）
-
-    # 9) ガチャタイム（支出発生時ランダム）
-    if name == "ガチャタイム（支出発生時ランダム）":
-        try:
-            prob = int(tp.get("trigger_probability", 30))
-        except (TypeError, ValueError):
-            prob = 30
-        prob = max(0, min(100, prob))
-        return random.randint(1, 100) <= prob
-
-    # 12) 推し活同額ミラーリング
-    if name == "推し活同額ミラーリング":
-        cats = set(tp.get("mirror_categories") or [])
-        if not cats:
-            return True  # 定義ミスの保険
-        if not category:
-            return False
-        return category in cats
-
-    # その他（毎週/月末/ゼロ日/レベルアップ/時刻/マイルストーン/リマインダー）はPOS即時では扱わない
-    return False
+    """単発評価用。判定ルールは services.rule_registry のトリガー定義を参照。"""
+    return compile_trigger(trigger_name, trigger_params)(int(amount_paid), category)
 
 # ------------------------------------------------------------
 # デモ用フォールバック候補の選定
@@ -218,160 +93,781 @@ def pick_demo_fallback(
     何もマッチしなかった時に "一番発火しやすい" 候補を選ぶ。
     返り値: (rule, trigger, action, forced_category, force_gacha)
     """
-    # 1. 無条件の「支出発生」
+    by_rule_id: Dict[int, Tuple[Rule, Trigger, Action]] = {}
+    compiled: List[CompiledRule] = []
     for rule, trig, act in rows:
-        if (trig.name or "").strip() == "支出発生":
-            return (rule, trig, act, None, False)
+        if rule.id not in by_rule_id:
+            by_rule_id[rule.id] = (rule, trig, act)
+            compiled.append(CompiledRule(rule, trig, act))
+
+    pick = RulePlan(0, compiled).pick_demo_fallback(int(amount_paid), category)
+    if pick is None:
+        return None
+    picked, forced_cat = pick
+    rule, trig, act = by_rule_id[picked.rule_id]
+    force_gacha = picked.fallback_stage == FALLBACK_STAGE_GACHA
+    return (rule, trig, act, forced_cat, force_gacha)
 
-    # 2. カテゴリ系（最初のカテゴリを強制セット）
-    for rule, trig, act in rows:
-        name = (trig.name or "").strip()
-        tp = rule.trigger_params or {}
-        if name == "特定カテゴリでの支出":
-            cats = tp.get("categories") or []
-            if cats:
-                return (rule, trig, act, str(cats[0]), False)
-        if name == "推し活同額ミラーリング":
-            cats = tp.get("mirror_categories") or []
-            if cats:
-                return (rule, trig, act, str(cats[0]), False)
-
-    # 3. ガチャ（確率を強制成功に）
-    for rule, trig, act in rows:
-        if (trig.name or "").strip() == "ガチャタイム（支出発生時ランダム）":
-            return (rule, trig, act, None, True)
+# ------------------------------------------------------------
+# コンパイル済みルールプラン（ユーザー単位でキャッシュ）
+# ------------------------------------------------------------
+class CompiledRule:
+    """評価に必要な情報だけを保持した、ORM非依存のルール"""
+    __slots__ = (
+        "rule_id", "action_id", "trigger_id", "trigger_name", "event",
+        "trigger_params", "trigger_args", "action_params", "action_args", "action_type",
+        "match", "amount", "fallback_stage", "fallback", "next_fire", "action_params_id",
+    )
 
-    # 4. 条件付き支出（今の金額で条件を満たすもの）
-    for rule, trig, act in rows:
-        if (trig.name or "").strip() == "条件付き支出":
-            tp = rule.trigger_params or {}
-            try:
-                thr = int(tp.get("amount"))
-            except Exception:
-                continue
-            op = (tp.get("operator") or ">").strip()
-            cat_ok = True
-            if tp.get("category"):
-                if category and category == tp["category"]:
-                    cat_ok = True
-                else:
-                    # デモ時は強制カテゴリセット
-                    category = tp["category"]
-                    cat_ok = True
-            if not cat_ok:
-                continue
-            if (op in (">", ">=") and amount_paid >= thr) or (op in ("<", "<=") and amount_paid <= thr):
-                return (rule, trig, act, category, False)
+    def __init__(self, rule: Rule, trigger: Trigger, action: Action):
+        self.rule_id: int = rule.id
+        self.action_id: int = action.id
+        self.trigger_id: int = trigger.id
+        self.trigger_name: str = (trigger.name or "").strip()
+        self.trigger_params: Dict[str, Any] = dict(rule.trigger_params or {})
+        self.action_params: Dict[str, Any] = dict(rule.action_params or {})
+        self.action_type: str = infer_action_type(self.action_params)
+        _, self.action_args, self.amount = compile_action_spec(self.action_params)
+
+        spec, self.trigger_args, self.match = compile_trigger_spec(
+            trigger.id, self.trigger_name, self.trigger_params
+        )
+        self.event: Optional[str] = spec.event if spec else None
+        self.fallback_stage: Optional[int] = spec.fallback_stage if spec else None
+        self.fallback: Optional[FallbackFn] = spec.fallback if spec else None
+        # 時刻トリガーは評価関数が「次回発火時刻」を返す（パラメータ不正なら None＝発火しない）
+        self.next_fire: Optional[NextFireFn] = (
+            self.match if self.event == EVENT_SCHEDULE and self.trigger_args is not None else None
+        )
+        # アクションパラメータのスナップショットID（ログを書くときに attach_action_param_snapshots で解決）
+        self.action_params_id: Optional[int] = None
 
-    # 5. 見つからない場合は None
-    return None
 
-# ------------------------------------------------------------
-# メイン実行
-# ------------------------------------------------------------
-def execute_pos_payment(
-    db: Session,
-    *,
-    user_id: int,
-    amount_paid: int,
-    category: str | None = None,
-) -> Tuple[TanabotaTransaction, List[TanabotaActionLog]]:
+def attach_action_param_snapshots(rules: Iterable[CompiledRule]) -> None:
     """
-    1) ユーザーのレシピに紐づくルール取得
-    2) トリガ一致 → たなぼた額算出（整数円）
-    3) ヘッダ＋ログ保存（コミットは呼び出し側）
-    4) 1件も無ければデモ用フォールバックで必ず1件作る
+    未解決のルールのアクションパラメータをスナップショットIDへ解決し、ルールに保持する
+    （services.action_param_snapshots。未知のパラメータだけ別トランザクションで作成してコミットする）。
+    ログを書く経路からだけ呼ぶ（ドライランや読み取りではスナップショットを作らない）。
     """
-    amount_paid = int(amount_paid)
+    pending = list({id(r): r for r in rules if r.action_params_id is None}.values())
+    if not pending:
+        return
+    ids = action_param_snapshots.resolve_many([r.action_params for r in pending])
+    for rule, snapshot_id in zip(pending, ids):
+        rule.action_params_id = snapshot_id
+
+
+def _execution_rules(results: Iterable[PaymentResult]) -> List[CompiledRule]:
+    return [e["rule"] for r in results for e in r.executions]
+
 
-    # 1) ヘッダ先行（id採番）
-    tx = TanabotaTransaction(
-        user_id=user_id,
-        amount_paid=amount_paid,
-        tanabota_total=0,
+class RulePlan:
+    """ユーザーの有効ルール一覧（重複排除済み・評価関数解決済み）"""
+    __slots__ = (
+        "user_id", "user_exists", "all_rules", "rules", "income_rules", "counter_rules", "_fallback_candidates",
     )
-    db.add(tx)
-    db.flush()  # tx.id
 
-    # 2) ルール取得（重複排除に注意）
-    q = (
-        select(Rule, Trigger, Action)
+    def __init__(self, user_id: int, rules: List[CompiledRule], user_exists: bool = True):
+        self.user_id = user_id
+        # キャッシュ済みプランで存在確認を済ませ、決済ごとの User 取得を省く
+        self.user_exists = user_exists
+        self.all_rules: Tuple[CompiledRule, ...] = tuple(rules)
+        # POS支払いで評価するルールだけを事前に絞り込む（定期実行などは毎回の走査から外す）
+        self.rules: Tuple[CompiledRule, ...] = tuple(r for r in rules if r.event == EVENT_PAYMENT)
+        # 入金で評価するルール（給与日の一括処理では、これが空のユーザーを評価ごと飛ばす）
+        self.income_rules: Tuple[CompiledRule, ...] = tuple(r for r in rules if r.event == EVENT_INCOME)
+        # 支出カウンタで判定するルール（空ならカウンタの読み込み自体を省く）
+        self.counter_rules: Tuple[CompiledRule, ...] = tuple(r for r in rules if r.event == EVENT_COUNTER)
+        # フォールバック段の昇順（同じ段の中は元の順序を保つ）
+        self._fallback_candidates: Tuple[CompiledRule, ...] = tuple(sorted(
+            (r for r in rules if r.fallback is not None),
+            key=lambda r: r.fallback_stage,
+        ))
+
+    def pick_demo_fallback(
+        self, amount_paid: int, category: Optional[str]
+    ) -> Optional[Tuple[CompiledRule, Optional[str]]]:
+        """pick_demo_fallback のコンパイル済み版。返り値: (rule, forced_category)"""
+        for r in self._fallback_candidates:
+            picked, category = r.fallback(r.trigger_args, amount_paid, category)
+            if picked:
+                return (r, category)
+        return None
+
+
+def active_rules_query():
+    """レシピに組み込まれた有効ルール (Rule, Trigger, Action, 所有ユーザーID) の基本クエリ"""
+    return (
+        select(Rule, Trigger, Action, Recipe.user_id)
         .join(RecipeRule, RecipeRule.rule_id == Rule.id)
         .join(Recipe, Recipe.id == RecipeRule.recipe_id)
         .join(Trigger, Trigger.id == Rule.trigger_id)
         .join(Action, Action.id == Rule.action_id)
-        .where(and_(Recipe.user_id == user_id))
     )
-    rows = db.execute(q).all()
 
-    total = 0
-    logs: List[TanabotaActionLog] = []
-    seen_rule_ids: set[int] = set()
 
-    # 2-1) 通常評価
-    for rule, trigger, action in rows:
-        if rule.id in seen_rule_ids:
+def _rule_plan_query(user_ids: List[int]):
+    return active_rules_query().where(Recipe.user_id.in_(user_ids))
+
+
+def _existing_users_query(user_ids: List[int]):
+    return select(User.id).where(User.id.in_(user_ids))
+
+
+def _compile_rule_plans(rows, user_ids: List[int]) -> Dict[int, List[CompiledRule]]:
+    compiled: Dict[int, List[CompiledRule]] = {uid: [] for uid in user_ids}
+    seen: set[Tuple[int, int]] = set()
+    for rule, trigger, action, owner_id in rows:
+        if (owner_id, rule.id) in seen:
             continue
-        seen_rule_ids.add(rule.id)
+        seen.add((owner_id, rule.id))
+        compiled[owner_id].append(CompiledRule(rule, trigger, action))
+    return compiled
 
-        if not trigger_match(trigger.name, rule.trigger_params or {}, amount_paid, category=category):
+
+def _rule_plans(compiled: Dict[int, List[CompiledRule]], existing: set[int]) -> Dict[int, RulePlan]:
+    return {uid: RulePlan(uid, rules, uid in existing) for uid, rules in compiled.items()}
+
+
+def load_rule_plans(db: Session, user_ids: List[int]) -> Dict[int, RulePlan]:
+    """複数ユーザーのルールを1クエリで取得してコンパイルする（キャッシュを介さない）"""
+    user_ids = list(user_ids)
+    rows = db.execute(_rule_plan_query(user_ids)).all()
+    existing = set(db.execute(_existing_users_query(user_ids)).scalars())
+    compiled = _compile_rule_plans(rows, user_ids)
+    return _rule_plans(compiled, existing)
+
+
+def load_rule_plan(db: Session, user_id: int) -> RulePlan:
+    """ユーザーのレシピに紐づくルールを取得してコンパイルする（キャッシュを介さない）"""
+    return load_rule_plans(db, [user_id])[user_id]
+
+
+def get_rule_plan(db: Session, user_id: int) -> RulePlan:
+    """キャッシュ経由でルールプランを取得（ミス時のみDBから構築）"""
+    return rule_plan_cache.get_or_load(user_id, lambda: load_rule_plan(db, user_id))
+
+
+def get_rule_plans(db: Session, user_ids: List[int]) -> Dict[int, RulePlan]:
+    """キャッシュ経由で複数ユーザーのルールプランを取得（ミス分は1クエリでまとめて構築）"""
+    return rule_plan_cache.get_many_or_load(user_ids, lambda missing: load_rule_plans(db, missing))
+
+async def load_rule_plan_async(db: AsyncSession, user_id: int) -> RulePlan:
+    """load_rule_plan の非同期版"""
+    rows = (await db.execute(_rule_plan_query([user_id]))).all()
+    existing = set((await db.execute(_existing_users_query([user_id]))).scalars())
+    compiled = _compile_rule_plans(rows, [user_id])
+    return _rule_plans(compiled, existing)[user_id]
+
+
+async def get_rule_plan_async(db: AsyncSession, user_id: int) -> RulePlan:
+    """get_rule_plan の非同期版（同期版とキャッシュを共有する）"""
+    return await rule_plan_cache.get_or_load_async(user_id, lambda: load_rule_plan_async(db, user_id))
+
+# ------------------------------------------------------------
+# 評価（DB非依存）
+# ------------------------------------------------------------
+# RuleVerdict.phase（どの段階で評価されたか）
+PHASE_PAYMENT = "payment"
+PHASE_COUNTER = "counter"
+PHASE_DEMO_FALLBACK = "demo_fallback"
+
+
+class RuleVerdict:
+    """1ルールの判定結果（説明用。phase が空なら支払いでは評価しないルール）"""
+    __slots__ = ("rule", "phase", "matched", "amount", "forced_category")
+
+    def __init__(
+        self,
+        rule: CompiledRule,
+        phase: str,
+        *,
+        matched: Optional[bool] = None,
+        amount: Optional[int] = None,
+        forced_category: Optional[str] = None,
+    ):
+        self.rule = rule
+        self.phase = phase
+        self.matched = matched
+        # 算出したたなぼた額（トリガ不一致なら None。0円以下は記録されない）
+        self.amount = amount
+        self.forced_category = forced_category
+
+    @property
+    def fired(self) -> bool:
+        return bool(self.matched) and self.amount is not None and self.amount > 0
+
+
+def _evaluate_rules(
+    rules: Tuple[CompiledRule, ...],
+    amount: int,
+    context: str | None,
+    result_json: Optional[Dict[str, Any]] = None,
+    trace: Optional[List[RuleVerdict]] = None,
+    phase: str = "",
+) -> Tuple[int, List[Dict[str, Any]]]:
+    """
+    トリガ一致 → たなぼた額算出（0円以下は記録しない）。支払い・入金で共通
+    trace を渡すとルールごとの判定を phase 付きで追記する（explain_pos_payment 用）
+    """
+    total = 0
+    executions: List[Dict[str, Any]] = []
+    for rule in rules:
+        if not rule.match(amount, context):
+            if trace is not None:
+                trace.append(RuleVerdict(rule, phase, matched=False))
             continue
 
-        amt = compute_amount(rule.action_params or {}, amount_paid)
+        amt = rule.amount(amount)
+        if trace is not None:
+            trace.append(RuleVerdict(rule, phase, matched=True, amount=amt))
         if amt <= 0:
             continue
 
-        log = TanabotaActionLog(
-            transaction_id=tx.id,
-            rule_id=rule.id,
-            action_id=action.id,
-            action_type=infer_action_type(rule.action_params or {}),
-            action_params_json=rule.action_params or {},
-            tanabota_amount=amt,
-            result_json=None,
-        )
-        db.add(log)
-        logs.append(log)
+        executions.append({
+            "rule_id": rule.rule_id,
+            "action_id": rule.action_id,
+            "action_type": rule.action_type,
+            "rule": rule,
+            "tanabota_amount": amt,
+            "result_json": result_json,
+        })
         total += amt
+    return total, executions
+
+
+def evaluate_payment(
+    plan: RulePlan,
+    amount_paid: int,
+    category: str | None = None,
+    counters: Optional[SpendCounters] = None,
+    trace: Optional[List[RuleVerdict]] = None,
+) -> Tuple[int, List[Dict[str, Any]]]:
+    """
+    1) トリガ一致 → たなぼた額算出（整数円）
+    2) 支出カウンタ系のルール（counters を渡した場合のみ。1) の合計を踏まえて判定）
+    3) 1件も無ければデモ用フォールバックで必ず1件作る
+    counters にはこの決済分を加算する（同じユーザーを続けて評価する一括処理用）。
+    trace を渡すと各段階のルールごとの判定（RuleVerdict）を追記する。
+    返り値: (たなぼた合計, 明細のリスト（rule は評価したルール。log_rows でログ行にする）)
+    """
+    # 1) 通常評価
+    total, executions = _evaluate_rules(plan.rules, amount_paid, category, trace=trace, phase=PHASE_PAYMENT)
+
+    # 2) カウンタ評価
+    if plan.counter_rules and counters is not None:
+        counter_total, counter_executions = _evaluate_rules(
+            plan.counter_rules,
+            amount_paid,
+            CounterContext(counters, category, total),
+            trace=trace,
+            phase=PHASE_COUNTER,
+        )
+        total += counter_total
+        executions.extend(counter_executions)
 
     # 3) フォールバック（デモ時に必ず1件）
-    if not logs:
-        pick = pick_demo_fallback(rows, amount_paid, category)
+    if not executions:
+        pick = plan.pick_demo_fallback(amount_paid, category)
         if pick:
-            rule, trigger, action, forced_cat, force_gacha = pick
+            rule, forced_cat = pick
 
             # ガチャは強制成功。カテゴリ系は補完。
-            local_params = dict(rule.action_params or {})
-            local_trigger_name = (trigger.name or "").strip()
             forced_info: Dict[str, Any] = {
                 "demo_forced_fire": True,
-                "original_trigger": local_trigger_name,
+                "original_trigger": rule.trigger_name,
             }
             if forced_cat:
                 forced_info["forced_category"] = forced_cat
 
             # 金額算出（そのままのアクションパラメータでOK）
-            amt = compute_amount(local_params, amount_paid)
+            amt = rule.amount(amount_paid)
 
             # もし計算上ゼロなら、最後の保険として1%（最低1円）を適用
             if amt <= 0:
                 amt = max(1, amount_paid // 100)
-
-            log = TanabotaActionLog(
-                transaction_id=tx.id,
-                rule_id=rule.id,
-                action_id=action.id,
-                action_type=infer_action_type(local_params),
-                action_params_json=local_params,
-                tanabota_amount=amt,
-                result_json=forced_info,
-            )
-            db.add(log)
-            logs.append(log)
+            if trace is not None:
+                trace.append(RuleVerdict(rule, PHASE_DEMO_FALLBACK, matched=True, amount=amt, forced_category=forced_cat))
+
+            executions.append({
+                "rule_id": rule.rule_id,
+                "action_id": rule.action_id,
+                "action_type": rule.action_type,
+                "rule": rule,
+                "tanabota_amount": amt,
+                "result_json": forced_info,
+            })
             total += amt
 
-    # 4) 合計反映
-    tx.tanabota_total = total
+    if counters is not None:
+        counters.add(amount_paid, category, total)
+    return total, executions
+
+
+def evaluate_income(
+    plan: RulePlan,
+    amount_received: int,
+    description: str | None = None,
+) -> Tuple[int, List[Dict[str, Any]]]:
+    """
+    入金1件を評価する（デモ用フォールバックなし）。
+    取引ヘッダは支払額 0（event_kind=income）で記録するため、入金額と摘要はログの result_json に残す。
+    返り値: (たなぼた合計, 明細のリスト（rule は評価したルール。log_rows でログ行にする）)
+    """
+    if not plan.income_rules:
+        return 0, []
+    return _evaluate_rules(
+        plan.income_rules,
+        amount_received,
+        description,
+        {"income_amount": amount_received, "description": description},
+    )
+
+# ------------------------------------------------------------
+# メイン実行
+# ------------------------------------------------------------
+class UserNotFoundError(ValueError):
+    """決済対象のユーザーが存在しない"""
+
+
+class PaymentResult:
+    """決済1件分の保存結果（error が None なら成功）。入金などの記録は event_kind で区別する"""
+    __slots__ = ("transaction_id", "user_id", "amount_paid", "category", "event_kind", "tanabota_total", "executions", "error")
+
+    def __init__(
+        self,
+        user_id: int,
+        amount_paid: int,
+        category: Optional[str] = None,
+        *,
+        event_kind: str = EVENT_KIND_PAYMENT,
+    ):
+        self.transaction_id: Optional[int] = None
+        self.user_id = user_id
+        self.amount_paid = amount_paid
+        self.category = category
+        self.event_kind = event_kind
+        self.tanabota_total = 0
+        self.executions: List[Dict[str, Any]] = []
+        self.error: Optional[str] = None
+
+
+def _returns_header_id(db: Session | AsyncSession) -> bool:
+    return bool(db.get_bind().dialect.insert_returning)
+
+
+def _header_insert(returning: bool):
+    """合計確定済みヘッダのINSERT文（RETURNING 対応DBなら id も同じ往復で受け取る）"""
+    # ORMのバルクINSERTではなくテーブルに対するCore INSERT（非RETURNING時は lastrowid で id を得る）
+    table = TanabotaTransaction.__table__
+    stmt = insert(table)
+    return stmt.returning(table.c.id) if returning else stmt
+
+
+def _evaluate_for_user(
+    plan: RulePlan,
+    user_id: int,
+    amount_paid: int,
+    category: str | None,
+    counters: Optional[SpendCounters],
+) -> PaymentResult:
+    if not plan.user_exists:
+        raise UserNotFoundError("user not found")
+    result = PaymentResult(user_id, int(amount_paid), category)
+    result.tanabota_total, result.executions = evaluate_payment(plan, result.amount_paid, category, counters)
+    count_rules(_evaluated_rule_count(plan, counters), len(result.executions))
+    return result
+
+
+def _evaluated_rule_count(plan: RulePlan, counters: Optional[SpendCounters]) -> int:
+    """計測用：1決済で評価対象になるルール数"""
+    return len(plan.rules) + (len(plan.counter_rules) if counters is not None else 0)
+
+
+def _counter_rows(results: List[PaymentResult], day: date, *, spend: bool = True) -> List[Dict[str, Any]]:
+    """支出カウンタの加算行（入金・時刻トリガーは spend=False でたなぼた額だけ加算）"""
+    return counter_rows(
+        ((r.user_id, r.amount_paid, r.category, r.tanabota_total, 1 if spend else 0) for r in results),
+        day,
+    )
+
+
+def _header_row(result: PaymentResult) -> Dict[str, Any]:
+    return {
+        "user_id": result.user_id,
+        "amount_paid": result.amount_paid,
+        "tanabota_total": result.tanabota_total,
+        "event_kind": result.event_kind,
+    }
+
+
+def log_rows(result: PaymentResult) -> List[Dict[str, Any]]:
+    """
+    TanabotaActionLog のINSERT行（defer_logs=True で保存を呼び出し側に任せた場合にも使う）。
+    パラメータはスナップショットIDで書く（通常は保存時に解決済み。未解決ならここで解決する）。
+    旧スキーマ（action_params_json が NOT NULL）の間はJSONも書き続ける。
+    """
+    attach_action_param_snapshots(_execution_rules([result]))
+    write_json = not action_params_json_nullable()
+    return [
+        {
+            "transaction_id": result.transaction_id,
+            "rule_id": e["rule_id"],
+            "action_id": e["action_id"],
+            "action_type": e["action_type"],
+            "action_params_id": e["rule"].action_params_id,
+            "action_params_json": e["rule"].action_params if write_json else None,
+            "tanabota_amount": e["tanabota_amount"],
+            "result_json": e["result_json"],
+        }
+        for e in result.executions
+    ]
+
+
+def execute_pos_payment(
+    db: Session,
+    *,
+    user_id: int,
+    amount_paid: int,
+    category: str | None = None,
+    defer_logs: bool = False,
+    rng: Optional[random.Random] = None,
+) -> PaymentResult:
+    """
+    1) ユーザーのルールプラン取得（キャッシュ済みならDBアクセスなし。存在確認も兼ねる）
+    2) 評価（evaluate_payment）で明細と合計を先に確定（カウンタ系ルールがあれば支出カウンタを1回読む）
+    3) ヘッダを合計込みで1回INSERT、ログは executemany 1回（コミットは呼び出し側）
+       defer_logs=True ならログは書かない（監査ログの write-behind 用。log_rows で取り出す）
+    4) 支出カウンタ・月次集計へ加算（それぞれ UPSERT 1回）
+    rng を渡すとガチャ・random_range はそれから引く（services.rng.request_rng で決定的にできる）。
+    ユーザーが存在しなければ UserNotFoundError。
+    複数ワーカー間の直列化のため、最初に users の行をロックする（services.user_locks）。
+    各段階の所要時間は services.pos_metrics に記録する（計測無効時は何もしない）。
+    """
+    day = business_day()
+    lock_user_rows(db, [user_id])
+    with stage(STAGE_LOAD_RULES):
+        plan = get_rule_plan(db, user_id)
+        counters = load_spend_counters(db, [user_id], day)[user_id] if plan.counter_rules else None
+    with stage(STAGE_EVALUATE), use_rng(rng):
+        result = _evaluate_for_user(plan, user_id, amount_paid, category, counters)
+    # スナップショットは別トランザクションでコミットするため、この決済の書き込みより前に解決する
+    attach_action_param_snapshots(_execution_rules([result]))
+
+    returning = _returns_header_id(db)
+    with stage(STAGE_FLUSH):
+        header = db.execute(_header_insert(returning), _header_row(result))
+        result.transaction_id = header.scalar_one() if returning else header.inserted_primary_key[0]
+
+    with stage(STAGE_BUILD_LOGS):
+        logs = log_rows(result) if result.executions and not defer_logs else None
+        counter_updates = _counter_rows([result], day)
+        rollups = rollup_rows([result], day)
+    with stage(STAGE_FLUSH):
+        if logs:
+            db.execute(insert(TanabotaActionLog), logs)
+        add_spend_counters(db, counter_updates)
+        add_savings_rollups(db, rollups)
+    return result
+
+
+async def execute_pos_payment_async(
+    db: AsyncSession,
+    *,
+    user_id: int,
+    amount_paid: int,
+    category: str | None = None,
+    defer_logs: bool = False,
+    rng: Optional[random.Random] = None,
+) -> PaymentResult:
+    """execute_pos_payment の非同期版（AsyncSession 用。コミットは呼び出し側）"""
+    day = business_day()
+    await lock_user_rows_async(db, [user_id])
+    with stage(STAGE_LOAD_RULES):
+        plan = await get_rule_plan_async(db, user_id)
+        counters = (await load_spend_counters_async(db, [user_id], day))[user_id] if plan.counter_rules else None
+    with stage(STAGE_EVALUATE), use_rng(rng):
+        result = _evaluate_for_user(plan, user_id, amount_paid, category, counters)
+    # スナップショットは書き込みより前に解決する。作成は同期セッションで行うため、未解決のものがあればスレッドへ逃がす
+    pending = [rule for rule in _execution_rules([result]) if rule.action_params_id is None]
+    if pending:
+        await asyncio.to_thread(attach_action_param_snapshots, pending)
+
+    returning = _returns_header_id(db)
+    with stage(STAGE_FLUSH):
+        header = await db.execute(_header_insert(returning), _header_row(result))
+        result.transaction_id = header.scalar_one() if returning else header.inserted_primary_key[0]
+
+    with stage(STAGE_BUILD_LOGS):
+        logs = log_rows(result) if result.executions and not defer_logs else None
+        counter_updates = _counter_rows([result], day)
+        rollups = rollup_rows([result], day)
+    with stage(STAGE_FLUSH):
+        if logs:
+            await db.execute(insert(TanabotaActionLog), logs)
+        await add_spend_counters_async(db, counter_updates)
+        await add_savings_rollups_async(db, rollups)
+    return result
+
+# ------------------------------------------------------------
+# 説明（ドライラン）
+# ------------------------------------------------------------
+class PaymentExplanation:
+    """explain_pos_payment の結果（result は保存しない PaymentResult。transaction_id は常に None）"""
+    __slots__ = ("result", "verdicts", "counters_loaded")
+
+    def __init__(self, result: PaymentResult, verdicts: List[RuleVerdict], counters_loaded: bool):
+        self.result = result
+        self.verdicts = verdicts
+        self.counters_loaded = counters_loaded
+
+    @property
+    def demo_fallback(self) -> Optional[RuleVerdict]:
+        """デモ用フォールバックで発火したルール（通常のルールが1件でも発火していれば None）"""
+        return next((v for v in self.verdicts if v.phase == PHASE_DEMO_FALLBACK), None)
+
+
+def explain_pos_payment(
+    db: Session,
+    *,
+    user_id: int,
+    amount_paid: int,
+    category: str | None = None,
+    rng: Optional[random.Random] = None,
+) -> PaymentExplanation:
+    """
+    execute_pos_payment と同じプラン（キャッシュ）・支出カウンタ・評価で、保存せずに判定内容を返す。
+    ロック・ヘッダ/ログ/カウンタ/集計の書き込みは行わない（カウンタはこの決済を加算する前の値で評価）。
+    支払いで評価しないルール（入金・時刻トリガー等）も phase 空で含める。
+    ガチャ・random_range は rng が無ければ毎回変わる（TANABOTA_RNG_SEED 設定時は request_rng で実際の決済と一致）。
+    ユーザーが存在しなければ UserNotFoundError。
+    """
+    day = business_day()
+    with stage(STAGE_LOAD_RULES):
+        plan = get_rule_plan(db, user_id)
+        if not plan.user_exists:
+            raise UserNotFoundError("user not found")
+        counters = load_spend_counters(db, [user_id], day)[user_id] if plan.counter_rules else None
+
+    verdicts: List[RuleVerdict] = []
+    result = PaymentResult(user_id, int(amount_paid), category)
+    with stage(STAGE_EVALUATE), use_rng(rng):
+        result.tanabota_total, result.executions = evaluate_payment(
+            plan, result.amount_paid, category, counters, trace=verdicts
+        )
+    verdicts.extend(
+        RuleVerdict(r, "") for r in plan.all_rules if r not in plan.rules and r not in plan.counter_rules
+    )
+    return PaymentExplanation(result, verdicts, counters is not None)
+
+# ------------------------------------------------------------
+# 一括実行
+# ------------------------------------------------------------
+def _insert_transaction_headers(db: Session, rows: List[Dict[str, Any]]) -> List[int]:
+    """ヘッダを一括INSERTし、rows と同じ順序で id を返す"""
+    dialect = db.get_bind().dialect
+    if getattr(dialect, "insert_executemany_returning_sort_by_parameter_order", False):
+        # RETURNING 対応DB: 1文（insertmanyvalues）で id まで取得
+        stmt = insert(TanabotaTransaction).returning(TanabotaTransaction.id, sort_by_parameter_order=True)
+        return list(db.scalars(stmt, rows))
+
+    # MySQL 等: 複数行INSERTで採番結果を順序付きで得られないため、ORMのflushに任せる
+    txs = [TanabotaTransaction(**row) for row in rows]
+    db.add_all(txs)
     db.flush()
+    return [tx.id for tx in txs]
+
+
+def execute_pos_payments_batch(
+    db: Session,
+    payments: List[Tuple[int, int, Optional[str]]],
+    *,
+    defer_logs: bool = False,
+    rng: Optional[random.Random] = None,
+) -> List[PaymentResult]:
+    """
+    (user_id, amount_paid, category) のリストをまとめて処理する（コミットは呼び出し側）。
+    0) 登場ユーザーの users 行をロック（複数ワーカー間の直列化。SQLite では何もしない）
+    1) 登場ユーザーのルールプランを一括取得（ミス分は1クエリ。存在確認も兼ねる）
+    2) 全件を評価（存在しないユーザー・評価に失敗した明細は error として返し、他は続行）
+       カウンタ系ルールを持つユーザーの支出カウンタは1クエリで読み、同じユーザーの決済は順に加算して評価する
+    3) ヘッダは合計確定済みで一括INSERT、ログは executemany 1回で一括INSERT（defer_logs=True なら書かない）
+    4) 支出カウンタ・月次集計へ加算（キーごとにまとめて UPSERT 1回ずつ）
+    rng を渡すと全件をその生成器から順に引いて評価する（同じ payments なら同じ結果）。
+    返り値は payments と同じ順序。
+    """
+    day = business_day()
+    lock_user_rows(db, [uid for uid, _, _ in payments])
+    with stage(STAGE_LOAD_RULES):
+        plans = get_rule_plans(db, [uid for uid, _, _ in payments])
+        counters = load_spend_counters(db, [uid for uid, plan in plans.items() if plan.counter_rules], day)
+
+    results: List[PaymentResult] = []
+    with stage(STAGE_EVALUATE), use_rng(rng):
+        for user_id, amount_paid, category in payments:
+            result = PaymentResult(user_id, int(amount_paid), category)
+            if not plans[user_id].user_exists:
+                result.error = "user not found"
+                results.append(result)
+                continue
+            try:
+                result.tanabota_total, result.executions = evaluate_payment(
+                    plans[user_id], result.amount_paid, category, counters.get(user_id)
+                )
+                count_rules(_evaluated_rule_count(plans[user_id], counters.get(user_id)), len(result.executions))
+            except Exception as e:
+                result.error = f"evaluation failed: {e}"
+            results.append(result)
+
+    _insert_results(db, [r for r in results if r.error is None], defer_logs=defer_logs, day=day)
+    return results
+
+
+def _insert_results(
+    db: Session,
+    results: List[PaymentResult],
+    *,
+    defer_logs: bool,
+    day: Optional[date] = None,
+    spend: bool = True,
+) -> None:
+    """
+    ヘッダを一括INSERTして transaction_id を埋め、ログを executemany 1回で書き（defer_logs=True なら書かない）、
+    支出カウンタ・月次集計へ加算する（入金・時刻トリガーは spend=False）
+    """
+    if not results:
+        return
+    # スナップショットは別トランザクションでコミットするため、書き込みより前にまとめて1回で解決する
+    # （ログを後で書く場合も、ここで解決しておけば log_rows は作成しない）
+    attach_action_param_snapshots(_execution_rules(results))
+    with stage(STAGE_FLUSH):
+        tx_ids = _insert_transaction_headers(db, [_header_row(r) for r in results])
+    for r, tx_id in zip(results, tx_ids):
+        r.transaction_id = tx_id
+
+    with stage(STAGE_BUILD_LOGS):
+        rows = [row for r in results for row in log_rows(r)] if not defer_logs else []
+        day = day or business_day()
+        counter_updates = _counter_rows(results, day, spend=spend)
+        rollups = rollup_rows(results, day)
+    with stage(STAGE_FLUSH):
+        if rows:
+            db.execute(insert(TanabotaActionLog), rows)
+        add_spend_counters(db, counter_updates)
+        add_savings_rollups(db, rollups)
+
+# ------------------------------------------------------------
+# 時刻トリガーの発火記録（services.scheduler から呼ぶ）
+# ------------------------------------------------------------
+def unpriced_schedule_reason(rule: CompiledRule) -> Optional[str]:
+    """
+    時刻トリガーのルールを支払い無し（amount_paid=0）で金額にできない理由（できれば None）。
+    未登録・パラメータ不正のアクションと、支払額から決まり0円にしかならないアクションが該当する。
+    """
+    spec = find_action_spec(rule.action_type)
+    if spec is None or rule.action_args is None:
+        return f"未対応のアクション（{rule.action_type}）"
+    if not spec.randomized and rule.amount(0) <= 0:
+        return f"支払額から決まるアクションのため0円（{rule.action_type}）"
+    return None
+
 
-    return tx, logs
+def record_scheduled_firings(
+    db: Session,
+    firings: Iterable[Tuple[int, CompiledRule, datetime]],
+    *,
+    defer_logs: bool = False,
+) -> List[PaymentResult]:
+    """
+    (user_id, rule, 発火予定時刻) をユーザー単位の取引にまとめて保存する（コミットは呼び出し側）。
+    支払いを伴わないため amount_paid=0・event_kind=schedule で記録し、金額が0以下のルールは記録しない
+    （金額にできないルールはスケジューラが読み込み時に除く。unpriced_schedule_reason）。
+    最初に対象ユーザーの users 行をロックする（決済と同じ直列化）。
+    ヘッダは一括INSERT、ログは executemany 1回（defer_logs=True なら書かない）。
+    """
+    firings = list(firings)
+    lock_user_rows(db, [user_id for user_id, _, _ in firings])
+    by_user: Dict[int, PaymentResult] = {}
+    for user_id, rule, scheduled_at in firings:
+        amt = rule.amount(0)
+        if amt <= 0:
+            continue
+        result = by_user.get(user_id)
+        if result is None:
+            result = by_user[user_id] = PaymentResult(user_id, 0, event_kind=EVENT_KIND_SCHEDULE)
+        result.executions.append({
+            "rule_id": rule.rule_id,
+            "action_id": rule.action_id,
+            "action_type": rule.action_type,
+            "rule": rule,
+            "tanabota_amount": amt,
+            "result_json": {"scheduled_at": scheduled_at.isoformat(), "trigger": rule.trigger_name},
+        })
+        result.tanabota_total += amt
+
+    results = list(by_user.values())
+    _insert_results(db, results, defer_logs=defer_logs, spend=False)
+    return results
+
+# ------------------------------------------------------------
+# 入金（給与・賞与など）
+# ------------------------------------------------------------
+def execute_income(
+    db: Session,
+    *,
+    user_id: int,
+    amount_received: int,
+    description: str | None = None,
+    defer_logs: bool = False,
+    rng: Optional[random.Random] = None,
+) -> PaymentResult:
+    """
+    入金1件を処理する（コミットは呼び出し側）。
+    一致したルールがあれば支払額 0・event_kind=income・たなぼた合計込みのヘッダを1回INSERTし、ログは executemany 1回。
+    何も一致しなければ何も書かない（transaction_id は None）。
+    ユーザーが存在しなければ UserNotFoundError。
+    """
+    return execute_incomes_batch(
+        db, [(user_id, amount_received, description)], defer_logs=defer_logs, strict=True, rng=rng
+    )[0]
+
+
+def execute_incomes_batch(
+    db: Session,
+    incomes: List[Tuple[int, int, Optional[str]]],
+    *,
+    defer_logs: bool = False,
+    strict: bool = False,
+    rng: Optional[random.Random] = None,
+) -> List[PaymentResult]:
+    """
+    (user_id, amount_received, description) のリストをまとめて処理する（コミットは呼び出し側）。
+    ルールプランの一括取得（ミス分は1クエリ）で存在確認も兼ね、入金ルールを持たないユーザーは評価しない。
+    一致したものだけヘッダを一括INSERT・ログを executemany 1回で保存する。
+    返り値は incomes と同じ順序（存在しないユーザーは error。strict=True なら UserNotFoundError）。
+    """
+    lock_user_rows(db, [uid for uid, _, _ in incomes])
+    with stage(STAGE_LOAD_RULES):
+        plans = get_rule_plans(db, [uid for uid, _, _ in incomes])
+
+    results: List[PaymentResult] = []
+    with stage(STAGE_EVALUATE), use_rng(rng):
+        for user_id, amount_received, description in incomes:
+            plan = plans[user_id]
+            result = PaymentResult(user_id, 0, event_kind=EVENT_KIND_INCOME)
+            if not plan.user_exists:
+                if strict:
+                    raise UserNotFoundError("user not found")
+                result.error = "user not found"
+            else:
+                try:
+                    result.tanabota_total, result.executions = evaluate_income(plan, int(amount_received), description)
+                    count_rules(len(plan.income_rules), len(result.executions))
+                except Exception as e:
+                    if strict:
+                        raise
+                    result.error = f"evaluation failed: {e}"
+            results.append(result)
+
+    _insert_results(db, [r for r in results if r.error is None and r.executions], defer_logs=defer_logs, spend=False)
+    return results
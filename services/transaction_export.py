@@ -0,0 +1,181 @@
+"""
+ユーザーの取引履歴のエクスポート（NDJSON / CSV）
+取引ヘッダをサーバーサイドカーソル（yield_per）で古い順に流し、
+取得したチャンクごとにそのチャンク分のログだけを IN 検索で付け足して書き出す。
+履歴の長さに関係なく、メモリに載るのは1チャンク分（EXPORT_FETCH_SIZE 件）だけ。
+- ヘッダのカーソルを開いたまま別のクエリは流せない（MySQL の非バッファカーソル）ため、
+  ログの取得は別セッション（別接続）で行う
+- 各取引に累計たなぼた額（cumulative_tanabota）を付ける（event_kind で絞った場合はその種別の累計）
+- アーカイブへ移した明細もそのチャンク分だけ読み足す
+"""
+from __future__ import annotations
+
+import csv
+import io
+import json
+import os
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from models import EVENT_KIND_PAYMENT, TanabotaActionLog, TanabotaTransaction
+from services.action_log_archive import archived_logs, missing_log_ids
+
+# ヘッダを1回に取得する件数（= ログを IN 検索する単位）
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "1000"))
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+CSV_COLUMNS = [
+    "transaction_id",
+    "created_at",
+    "event_kind",
+    "amount_paid",
+    "tanabota_total",
+    "cumulative_tanabota",
+    "rule_id",
+    "action_id",
+    "action_type",
+    "tanabota_amount",
+    "result_json",
+]
+
+
+def _headers_query(user_id: int, after_id: Optional[int], event_kind: Optional[str]):
+    stmt = (
+        select(
+            TanabotaTransaction.id,
+            TanabotaTransaction.created_at,
+            TanabotaTransaction.event_kind,
+            TanabotaTransaction.amount_paid,
+            TanabotaTransaction.tanabota_total,
+        )
+        .where(TanabotaTransaction.user_id == user_id)
+        .order_by(TanabotaTransaction.id)
+    )
+    if event_kind is not None:
+        stmt = stmt.where(TanabotaTransaction.event_kind == event_kind)
+    if after_id is not None:
+        stmt = stmt.where(TanabotaTransaction.id > after_id)
+    return stmt.execution_options(yield_per=EXPORT_FETCH_SIZE)
+
+
+def _logs_query(transaction_ids: List[int]):
+    return (
+        select(
+            TanabotaActionLog.transaction_id,
+            TanabotaActionLog.rule_id,
+            TanabotaActionLog.action_id,
+            TanabotaActionLog.action_type,
+            TanabotaActionLog.tanabota_amount,
+            TanabotaActionLog.result_json,
+        )
+        .where(TanabotaActionLog.transaction_id.in_(transaction_ids))
+        .order_by(TanabotaActionLog.transaction_id, TanabotaActionLog.id)
+    )
+
+
+def iter_transaction_chunks(
+    user_id: int,
+    *,
+    after_id: Optional[int] = None,
+    event_kind: Optional[str] = EVENT_KIND_PAYMENT,
+    session_factory: Callable[[], Session] = SessionLocal,
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    ユーザーの取引を古い順に、ログ（executions）付きの dict のリストとしてチャンクごとに返す。
+    after_id を渡すとその次の取引から（途中で切れたエクスポートの再開用。累計もそこから数え直す）。
+    event_kind で種別を絞る（既定は決済だけ。None なら入金などの記録も含める）。
+    """
+    header_db = session_factory()
+    log_db = session_factory()
+    try:
+        cumulative = 0
+        for part in header_db.execute(_headers_query(user_id, after_id, event_kind)).partitions():
+            executions: Dict[int, List[Dict[str, Any]]] = {}
+            for tx_id, rule_id, action_id, action_type, amount, result_json in log_db.execute(
+                _logs_query([row.id for row in part])
+            ):
+                executions.setdefault(tx_id, []).append({
+                    "rule_id": rule_id,
+                    "action_id": action_id,
+                    "action_type": action_type,
+                    "tanabota_amount": int(amount),
+                    "result_json": result_json,
+                })
+            # 保存期間を過ぎてアーカイブへ移した明細
+            for tx_id, logs in archived_logs(
+                log_db, missing_log_ids(((row.id, row.tanabota_total) for row in part), executions)
+            ).items():
+                executions[tx_id] = [
+                    {k: l[k] for k in ("rule_id", "action_id", "action_type", "tanabota_amount", "result_json")}
+                    for l in logs
+                ]
+            # ログ側の接続でトランザクションを開きっぱなしにしない
+            log_db.rollback()
+
+            chunk: List[Dict[str, Any]] = []
+            for tx_id, created_at, kind, amount_paid, tanabota_total in part:
+                cumulative += int(tanabota_total)
+                chunk.append({
+                    "id": tx_id,
+                    "created_at": created_at.isoformat() if created_at else None,
+                    "event_kind": kind,
+                    "amount_paid": int(amount_paid),
+                    "tanabota_total": int(tanabota_total),
+                    "cumulative_tanabota": cumulative,
+                    "executions": executions.get(tx_id, []),
+                })
+            yield chunk
+    finally:
+        log_db.close()
+        header_db.close()
+
+
+def _ndjson(chunks: Iterator[List[Dict[str, Any]]]) -> Iterator[bytes]:
+    for chunk in chunks:
+        yield "".join(
+            json.dumps(tx, ensure_ascii=False, separators=(",", ":")) + "\n" for tx in chunk
+        ).encode("utf-8")
+
+
+def _csv(chunks: Iterator[List[Dict[str, Any]]]) -> Iterator[bytes]:
+    """ログ1件につき1行（ログの無い取引は明細列を空にして1行）"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(CSV_COLUMNS)
+    for chunk in chunks:
+        for tx in chunk:
+            head = [
+                tx["id"], tx["created_at"], tx["event_kind"], tx["amount_paid"], tx["tanabota_total"], tx["cumulative_tanabota"],
+            ]
+            if not tx["executions"]:
+                writer.writerow(head + [""] * 5)
+            for e in tx["executions"]:
+                writer.writerow(head + [
+                    e["rule_id"],
+                    e["action_id"],
+                    e["action_type"],
+                    e["tanabota_amount"],
+                    json.dumps(e["result_json"], ensure_ascii=False) if e["result_json"] is not None else "",
+                ])
+        yield buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+def stream_transactions(
+    user_id: int,
+    fmt: str,
+    *,
+    after_id: Optional[int] = None,
+    event_kind: Optional[str] = EVENT_KIND_PAYMENT,
+    session_factory: Callable[[], Session] = SessionLocal,
+) -> Iterator[bytes]:
+    """StreamingResponse に渡すバイト列のイテレータ（セッションは自前で開閉する）"""
+    chunks = iter_transaction_chunks(user_id, after_id=after_id, event_kind=event_kind, session_factory=session_factory)
+    return _csv(chunks) if fmt == "csv" else _ndjson(chunks)
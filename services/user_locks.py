@@ -0,0 +1,234 @@
+"""
+ユーザー単位の決済の直列化
+同じユーザーへの決済が同時に来ると、支出カウンタ（その日最初の支出か・レベルアップ判定）を
+それぞれが同じ値から評価してしまうため、ユーザーごとに評価〜コミットを1件ずつにする。
+別ユーザー同士は並列のまま（全体ロックは取らない）。
+- プロセス内: ユーザーIDをハッシュしたストライプ（threading.Lock の固定長テーブル）
+  非同期側はスレッドを使わずイベントループ上で待つ（解放時に待っているループへ通知する）
+  一括処理は関係するストライプを番号順に取るのでデッドロックしない
+  大きな一括処理はユーザーの小グループ（user_groups）ごとにロック〜コミットする（全ストライプを握り続けない）
+- 複数ワーカー（MySQL 等）: トランザクション先頭で users の該当行を SELECT ... FOR UPDATE
+  （コミット／ロールバックで解放。SQLite は書き込みがDB全体で直列化されるため発行しない）
+待ち時間は services.pos_metrics の lock_wait / row_lock 段階と stats() で確認できる。
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from models import User
+from services.pos_metrics import STAGE_LOCK_WAIT, STAGE_ROW_LOCK, stage
+
+# プロセス内ロックを使うか
+USER_LOCK_ENABLED = os.getenv("USER_LOCK_ENABLED", "true").lower() in ["true", "1", "yes"]
+# ストライプ数（多いほど別ユーザー同士の偶然の衝突が減る）
+USER_LOCK_STRIPES = int(os.getenv("USER_LOCK_STRIPES", "1024"))
+# プロセス内ロックの待ち時間の上限（秒）。超えたら UserLockTimeout
+USER_LOCK_TIMEOUT = float(os.getenv("USER_LOCK_TIMEOUT", "10"))
+# 行ロック（SELECT ... FOR UPDATE）を使うか（SQLite では常に使わない）
+USER_ROW_LOCK = os.getenv("USER_ROW_LOCK", "true").lower() in ["true", "1", "yes"]
+# 一括処理で一度にロックするユーザー数
+USER_LOCK_GROUP_SIZE = int(os.getenv("USER_LOCK_GROUP_SIZE", "16"))
+
+
+class UserLockTimeout(RuntimeError):
+    """同じユーザーの処理が長く続き、ロックを取得できなかった"""
+
+
+def _wake(waiter: "asyncio.Future[None]") -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class _Stripe:
+    """ストライプ1本（threading.Lock ＋ 非同期の待ち手。解放時に待ち手のイベントループへ通知する）"""
+    __slots__ = ("lock", "_waiters", "_mutex")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, "asyncio.Future[None]"]] = []
+        # 「取得を試して失敗したら待ち手に登録」と「解放後の通知」を排他にして、通知の取りこぼしを防ぐ
+        self._mutex = threading.Lock()
+
+    def release(self) -> None:
+        self.lock.release()
+        with self._mutex:
+            waiters, self._waiters = self._waiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+    async def acquire_async(self, timeout: float) -> bool:
+        """スレッドを使わずに待つ（起こされたら取り直す）。timeout 秒で取れなければ False"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            with self._mutex:
+                if self.lock.acquire(blocking=False):
+                    return True
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            remaining = deadline - loop.time()
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError
+                await asyncio.wait_for(waiter, remaining)
+            except BaseException as e:
+                with self._mutex:
+                    if (loop, waiter) in self._waiters:
+                        self._waiters.remove((loop, waiter))
+                if isinstance(e, asyncio.TimeoutError):
+                    return self.lock.acquire(blocking=False)
+                raise
+
+
+class UserLockTable:
+    """ユーザーID → ストライプのロック表（1プロセス1インスタンス。同期・非同期の両方から使う）"""
+
+    def __init__(
+        self,
+        stripes: int = USER_LOCK_STRIPES,
+        *,
+        enabled: bool = USER_LOCK_ENABLED,
+        timeout: float = USER_LOCK_TIMEOUT,
+    ):
+        self.enabled = enabled
+        self.timeout = float(timeout)
+        self._stripes = [_Stripe() for _ in range(max(1, int(stripes)))]
+        self._stats_lock = threading.Lock()
+        self.acquired = 0
+        self.contended = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _stripes_for(self, user_ids: Iterable[int]) -> List[_Stripe]:
+        # 同じストライプは1回だけ、番号順に取る
+        n = len(self._stripes)
+        return [self._stripes[i] for i in sorted({uid % n for uid in user_ids})]
+
+    def _record(self, contended: bool, waited: float) -> None:
+        with self._stats_lock:
+            self.acquired += 1
+            if contended:
+                self.contended += 1
+                self.wait_seconds += waited
+                if waited > self.max_wait_seconds:
+                    self.max_wait_seconds = waited
+
+    def _timed_out(self, held: List[_Stripe]) -> UserLockTimeout:
+        for stripe in reversed(held):
+            stripe.release()
+        with self._stats_lock:
+            self.timeouts += 1
+        return UserLockTimeout("user is busy (another payment is in progress)")
+
+    @contextmanager
+    def hold(self, *user_ids: int) -> Iterator[None]:
+        """with の間、user_ids の決済を他スレッドと直列化する"""
+        if not self.enabled or not user_ids:
+            yield
+            return
+        held: List[_Stripe] = []
+        started = time.perf_counter()
+        contended = False
+        with stage(STAGE_LOCK_WAIT):
+            for stripe in self._stripes_for(user_ids):
+                if not stripe.lock.acquire(blocking=False):
+                    contended = True
+                    if not stripe.lock.acquire(timeout=self.timeout):
+                        raise self._timed_out(held)
+                held.append(stripe)
+        self._record(contended, time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            for stripe in reversed(held):
+                stripe.release()
+
+    @asynccontextmanager
+    async def hold_async(self, *user_ids: int) -> AsyncIterator[None]:
+        """hold の非同期版（待つ場合もスレッドを使わず、イベントループ上で解放の通知を待つ）"""
+        if not self.enabled or not user_ids:
+            yield
+            return
+        held: List[_Stripe] = []
+        started = time.perf_counter()
+        contended = False
+        with stage(STAGE_LOCK_WAIT):
+            for stripe in self._stripes_for(user_ids):
+                if not stripe.lock.acquire(blocking=False):
+                    contended = True
+                    try:
+                        ok = await stripe.acquire_async(self.timeout)
+                    except asyncio.CancelledError:
+                        for h in reversed(held):
+                            h.release()
+                        raise
+                    if not ok:
+                        raise self._timed_out(held)
+                held.append(stripe)
+        self._record(contended, time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            for stripe in reversed(held):
+                stripe.release()
+
+    def stats(self) -> Dict[str, object]:
+        with self._stats_lock:
+            return {
+                "enabled": self.enabled,
+                "stripes": len(self._stripes),
+                "acquired": self.acquired,
+                "contended": self.contended,
+                "timeouts": self.timeouts,
+                "wait_ms_total": round(self.wait_seconds * 1000, 3),
+                "wait_ms_max": round(self.max_wait_seconds * 1000, 3),
+            }
+
+
+user_locks = UserLockTable()
+
+
+def user_groups(user_ids: Iterable[int], group_size: int = USER_LOCK_GROUP_SIZE) -> List[List[int]]:
+    """ユーザーIDを重複なし・ID順に group_size 人ずつに分ける（一括処理はグループごとにロック〜コミットする）"""
+    ids = sorted(set(user_ids))
+    size = max(1, int(group_size))
+    return [ids[start:start + size] for start in range(0, len(ids), size)]
+
+
+# ------------------------------------------------------------
+# 行ロック（複数ワーカー間の直列化）
+# ------------------------------------------------------------
+def _row_lock_query(db: Session | AsyncSession, user_ids: Iterable[int]):
+    if not USER_ROW_LOCK or db.get_bind().dialect.name == "sqlite":
+        return None
+    ids = sorted(set(user_ids))
+    if not ids:
+        return None
+    # id 順に取ってワーカー間のデッドロックを避ける
+    return select(User.id).where(User.id.in_(ids)).order_by(User.id).with_for_update()
+
+
+def lock_user_rows(db: Session, user_ids: Iterable[int]) -> None:
+    """トランザクション内で users の行をロックする（コミット／ロールバックまで保持）"""
+    stmt = _row_lock_query(db, user_ids)
+    if stmt is not None:
+        with stage(STAGE_ROW_LOCK):
+            db.execute(stmt).all()
+
+
+async def lock_user_rows_async(db: AsyncSession, user_ids: Iterable[int]) -> None:
+    """lock_user_rows の非同期版"""
+    stmt = _row_lock_query(db, user_ids)
+    if stmt is not None:
+        with stage(STAGE_ROW_LOCK):
+            (await db.execute(stmt)).all()
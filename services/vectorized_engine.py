@@ -0,0 +1,251 @@
+"""
+NumPy ベクトル化評価エンジン
+バッチ取り込み・バックテスト向けに、支払額の配列に対して
+compute_amount / trigger_match と同じ判定・金額（整数円・切り捨て）を一括で求める。
+乱数を使う種別（ガチャ・random_range）は numpy.random.Generator から引くため、
+シードを固定すれば再現できる（Python の random とは乱数列が異なる）。
+"""
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from services.rule_registry import (
+    EVENT_PAYMENT,
+    compile_action_spec,
+    compile_trigger_spec,
+)
+
+VectorAmountFn = Callable[[np.ndarray, np.random.Generator], np.ndarray]
+VectorMaskFn = Callable[["PaymentArrays", np.random.Generator], np.ndarray]
+
+# カテゴリ無し（None / 空文字）のコード
+NO_CATEGORY = -1
+
+
+class PaymentArrays:
+    """支払いストリームの列指向表現（amounts: int64、カテゴリは整数コード化）"""
+    __slots__ = ("amounts", "category_codes", "vocabulary")
+
+    def __init__(self, amounts: Any, categories: Optional[Sequence[Optional[str]]] = None):
+        self.amounts: np.ndarray = np.asarray(amounts, dtype=np.int64)
+        self.vocabulary: Dict[str, int] = {}
+        if categories is None:
+            self.category_codes = np.full(len(self.amounts), NO_CATEGORY, dtype=np.int32)
+            return
+        if len(categories) != len(self.amounts):
+            raise ValueError("amounts と categories の長さが一致しません")
+        vocab = self.vocabulary
+        self.category_codes = np.fromiter(
+            (vocab.setdefault(c, len(vocab)) if c else NO_CATEGORY for c in categories),
+            dtype=np.int32,
+            count=len(categories),
+        )
+
+    def __len__(self) -> int:
+        return len(self.amounts)
+
+    def codes_for(self, categories: Iterable[str]) -> np.ndarray:
+        """指定カテゴリのコード配列（このストリームに登場しないものは除外）"""
+        return np.array(
+            [self.vocabulary[c] for c in categories if c in self.vocabulary], dtype=np.int32
+        )
+
+
+def _default_rng(rng: Optional[np.random.Generator]) -> np.random.Generator:
+    return rng if rng is not None else np.random.default_rng()
+
+
+# ------------------------------------------------------------
+# アクション（金額配列）
+# ------------------------------------------------------------
+_VECTOR_ACTIONS: Dict[str, Callable[[Any, np.ndarray, np.random.Generator], np.ndarray]] = {}
+
+
+def _vector_action(action_type: str):
+    def decorator(fn):
+        _VECTOR_ACTIONS[action_type] = fn
+        return fn
+    return decorator
+
+
+@_vector_action("save_percentage")
+def _v_save_percentage(p, a: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    amt = (a * p.percentage) // 100 if p.percentage > 0 else np.zeros_like(a)
+    return np.maximum(amt + p.level_bonus, 0)
+
+
+@_vector_action("fixed")
+def _v_fixed(p, a: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    return np.full(a.shape, p.amount, dtype=np.int64)
+
+
+@_vector_action("roundup")
+def _v_roundup(p, a: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    rem = a % p.to
+    return np.where(rem != 0, p.to - rem, 0).astype(np.int64)
+
+
+@_vector_action("penalty_over_base")
+def _v_penalty_over_base(p, a: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    return np.maximum(a - p.base_amount, 0)
+
+
+@_vector_action("random_range")
+def _v_random_range(p, a: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    return rng.integers(p.min_amount, p.max_amount, size=a.shape, endpoint=True, dtype=np.int64)
+
+
+def _zeros(a: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    return np.zeros(a.shape, dtype=np.int64)
+
+
+def compile_action_vector(action_params: Dict[str, Any] | None) -> VectorAmountFn:
+    """action_params を一度だけ解釈し、支払額配列 → たなぼた額配列 の関数を返す。"""
+    spec, params, amount = compile_action_spec(action_params)
+    if spec is None or params is None:
+        return _zeros
+    fn = _VECTOR_ACTIONS.get(spec.action_type)
+    if fn is None:
+        # ベクトル版が未実装の種別はスカラー版を要素ごとに適用（結果は一致させる）
+        return lambda a, rng: np.fromiter((amount(int(x)) for x in a), dtype=np.int64, count=len(a))
+    return lambda a, rng: fn(params, a, rng)
+
+
+def compute_amounts(
+    action_params: Dict[str, Any] | None,
+    amounts: Any,
+    rng: Optional[np.random.Generator] = None,
+) -> np.ndarray:
+    """compute_amount のベクトル版（int64 配列を返す）"""
+    a = np.asarray(amounts, dtype=np.int64)
+    return compile_action_vector(action_params)(a, _default_rng(rng))
+
+
+# ------------------------------------------------------------
+# トリガー（真偽値マスク）
+# ------------------------------------------------------------
+_VECTOR_TRIGGERS: Dict[int, Callable[[Any, PaymentArrays, np.random.Generator], np.ndarray]] = {}
+
+
+def _vector_trigger(*trigger_ids: int):
+    def decorator(fn):
+        for trigger_id in trigger_ids:
+            _VECTOR_TRIGGERS[trigger_id] = fn
+        return fn
+    return decorator
+
+
+@_vector_trigger(3)
+def _m_spend(p, pay: PaymentArrays, rng: np.random.Generator) -> np.ndarray:
+    if p.min_amount is None:
+        return np.ones(len(pay), dtype=bool)
+    return pay.amounts >= p.min_amount
+
+
+@_vector_trigger(4, 12)
+def _m_category_in(p, pay: PaymentArrays, rng: np.random.Generator) -> np.ndarray:
+    if not p.categories:
+        return np.ones(len(pay), dtype=bool)  # 定義ミスの保険（categories未設定なら素通し）
+    return np.isin(pay.category_codes, pay.codes_for(p.categories))
+
+
+@_vector_trigger(9)
+def _m_gacha(p, pay: PaymentArrays, rng: np.random.Generator) -> np.ndarray:
+    return rng.integers(1, 100, size=len(pay), endpoint=True) <= p.probability
+
+
+_VECTOR_OPERATORS = {
+    ">": np.greater,
+    ">=": np.greater_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+}
+
+
+@_vector_trigger(6)
+def _m_conditional_spend(p, pay: PaymentArrays, rng: np.random.Generator) -> np.ndarray:
+    compare = _VECTOR_OPERATORS.get(p.operator)
+    # 未知演算子は通す（デモ向け）
+    mask = compare(pay.amounts, p.amount) if compare is not None else np.ones(len(pay), dtype=bool)
+    if p.category:
+        mask &= pay.category_codes == pay.vocabulary.get(p.category, NO_CATEGORY - 1)
+    return mask
+
+
+def _never_mask(pay: PaymentArrays, rng: np.random.Generator) -> np.ndarray:
+    return np.zeros(len(pay), dtype=bool)
+
+
+def compile_trigger_mask(
+    trigger_name: str | None,
+    trigger_params: Dict[str, Any] | None,
+    trigger_id: Optional[int] = None,
+) -> VectorMaskFn:
+    """trigger_params を一度だけ解釈し、PaymentArrays → 発火マスク の関数を返す。"""
+    spec, params, match = compile_trigger_spec(trigger_id, trigger_name, trigger_params)
+    if spec is None or params is None or spec.event != EVENT_PAYMENT:
+        return _never_mask
+    fn = _VECTOR_TRIGGERS.get(spec.trigger_id)
+    if fn is None:
+        # ベクトル版が未実装のトリガーはスカラー版を要素ごとに適用
+        def scalar_mask(pay: PaymentArrays, rng: np.random.Generator) -> np.ndarray:
+            names = {code: name for name, code in pay.vocabulary.items()}
+            return np.fromiter(
+                (match(int(a), names.get(int(c))) for a, c in zip(pay.amounts, pay.category_codes)),
+                dtype=bool,
+                count=len(pay),
+            )
+        return scalar_mask
+    return lambda pay, rng: fn(params, pay, rng)
+
+
+def trigger_mask(
+    trigger_name: str | None,
+    trigger_params: Dict[str, Any] | None,
+    payments: PaymentArrays,
+    rng: Optional[np.random.Generator] = None,
+    *,
+    trigger_id: Optional[int] = None,
+) -> np.ndarray:
+    """trigger_match のベクトル版（bool 配列を返す）"""
+    return compile_trigger_mask(trigger_name, trigger_params, trigger_id)(payments, _default_rng(rng))
+
+
+# ------------------------------------------------------------
+# コンパイル済みルール単位
+# ------------------------------------------------------------
+class VectorRule:
+    """CompiledRule（services.tanabota）のベクトル版"""
+    __slots__ = ("rule_id", "action_id", "action_type", "mask", "amount")
+
+    def __init__(self, rule: Any):
+        self.rule_id: int = rule.rule_id
+        self.action_id: int = rule.action_id
+        self.action_type: str = rule.action_type
+        self.mask: VectorMaskFn = compile_trigger_mask(rule.trigger_name, rule.trigger_params, rule.trigger_id)
+        self.amount: VectorAmountFn = compile_action_vector(rule.action_params)
+
+    def evaluate(self, payments: PaymentArrays, rng: np.random.Generator) -> np.ndarray:
+        """各支払いでのたなぼた額（不発火・0円以下は 0）"""
+        fired = self.mask(payments, rng)
+        amounts = self.amount(payments.amounts, rng)
+        return np.where(fired & (amounts > 0), amounts, 0)
+
+
+def evaluate_rules(
+    rules: Sequence[Any],
+    payments: PaymentArrays,
+    rng: Optional[np.random.Generator] = None,
+) -> Tuple[List[VectorRule], np.ndarray]:
+    """
+    ルール群を支払いストリーム全体に適用する（デモ用フォールバックは含まない）。
+    返り値: (VectorRule のリスト, shape=(ルール数, 支払い件数) の int64 たなぼた額行列)
+    """
+    rng = _default_rng(rng)
+    compiled = [VectorRule(r) for r in rules]
+    matrix = np.zeros((len(compiled), len(payments)), dtype=np.int64)
+    for i, rule in enumerate(compiled):
+        matrix[i] = rule.evaluate(payments, rng)
+    return compiled, matrix
@@ -0,0 +1,114 @@
+"""
+テスト共通の準備
+一時ディレクトリの SQLite（database.py の sqlite:///./app.db）に対して実行する。
+マスタ（トリガー・アクション・ルール／レシピテンプレート）はセッションで1回だけ投入し、ユーザーはテストごとに作る。
+"""
+import itertools
+import os
+import sys
+import tempfile
+from datetime import date
+
+# アプリのモジュールを読み込む前に接続先を決める（DB_HOST が無ければ SQLite）
+for _name in ("DB_HOST", "DB_NAME", "DB_USER", "DB_PASSWORD"):
+    os.environ.pop(_name, None)
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.chdir(tempfile.mkdtemp(prefix="tanabota-tests-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from sqlalchemy import BigInteger
+from sqlalchemy.ext.compiler import compiles
+
+
+@compiles(BigInteger, "sqlite")
+def _integer_ids_on_sqlite(type_, compiler, **kw):
+    # SQLite は INTEGER PRIMARY KEY だけが自動採番になる
+    return "INTEGER"
+
+
+from database import SessionLocal  # noqa: E402
+import models  # noqa: E402
+from enums import RuleCategory  # noqa: E402
+from models import Recipe, RecipeRule, Rule, User  # noqa: E402
+from services.rule_plan_cache import rule_plan_cache  # noqa: E402
+from services.schema_upgrade import upgrade_schema  # noqa: E402
+
+upgrade_schema()
+
+_user_ids = itertools.count(1000)
+
+
+@pytest.fixture(scope="session")
+def master_data():
+    from seeds.data import (
+        insert_sample_actions,
+        insert_sample_recipe_rule_relations,
+        insert_sample_recipe_templates,
+        insert_sample_rule_templates,
+        insert_sample_triggers,
+    )
+
+    db = SessionLocal()
+    try:
+        insert_sample_triggers(db)
+        insert_sample_actions(db)
+        insert_sample_rule_templates(db)
+        insert_sample_recipe_templates(db)
+        insert_sample_recipe_rule_relations(db)
+        db.commit()
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def db(master_data):
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.rollback()
+        session.close()
+        rule_plan_cache.invalidate()
+
+
+@pytest.fixture
+def make_user(db):
+    """テスト専用のユーザーを作る（他のテストの取引・カウンタと混ざらないよう毎回新しいID）"""
+    def make() -> int:
+        uid = next(_user_ids)
+        db.add(User(
+            id=uid, last_name="テスト", first_name="太郎", email=f"user{uid}@example.com",
+            birthdate=date(2000, 1, 1), postal_code="1000001", address="東京都", phone_number="0000000000",
+            occupation="会社員", company_name="テスト", password_hash="x",
+        ))
+        db.commit()
+        return uid
+    return make
+
+
+@pytest.fixture
+def add_rule(db):
+    """ユーザーのレシピにルールを1件追加する"""
+    def add(user_id: int, trigger_id: int, trigger_params: dict, action_id: int, action_params: dict) -> Rule:
+        rule = Rule(
+            user_id=user_id, name=f"rule-{trigger_id}-{action_id}", description="test",
+            category=list(RuleCategory)[0], trigger_id=trigger_id, trigger_params=trigger_params,
+            action_id=action_id, action_params=action_params,
+        )
+        recipe = Recipe(name="test", description="test", user_id=user_id)
+        db.add_all([rule, recipe])
+        db.flush()
+        db.add(RecipeRule(recipe_id=recipe.id, rule_id=rule.id))
+        db.commit()
+        rule_plan_cache.invalidate(user_id)
+        return rule
+    return add
+
+
+@pytest.fixture
+def client(master_data):
+    from fastapi.testclient import TestClient
+    from main import app
+
+    return TestClient(app)
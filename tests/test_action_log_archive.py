@@ -0,0 +1,94 @@
+"""たなぼたログのアーカイブ（services.action_log_archive）と読み出しのフォールバック"""
+import json
+import time
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import func, select
+
+from models import TanabotaActionLog, TanabotaActionLogArchive, TanabotaTransaction
+from services.action_log_archive import archive_action_logs
+from services.savings_rollup import rebuild_savings_rollups
+
+
+@pytest.fixture
+def archived_user(client, db, make_user, add_rule):
+    """古い取引（アーカイブ対象）と新しい取引を持つユーザー。返り値: (user_id, 古い取引ID, 新しい取引ID, 境目, ルールID)"""
+    uid = make_user()
+    rule = add_rule(uid, 3, {}, 101, {"amount": 30})
+    add_rule(uid, 3, {}, 102, {"percentage": 5})
+    old_ids = [client.post("/pos/execute", json={"user_id": uid, "amount": 1000 + i}).json()["transaction_id"] for i in range(6)]
+    # アーカイブの境目（これより前の取引はすべて退避される。他のテストの取引も含むが、読み出しは透過的）
+    time.sleep(0.01)
+    cutoff = datetime.now(timezone.utc)
+    time.sleep(0.01)
+    new_ids = [client.post("/pos/execute", json={"user_id": uid, "amount": 2000 + i}).json()["transaction_id"] for i in range(3)]
+    return uid, old_ids, new_ids, cutoff, rule.id
+
+
+def _reads(client, uid, tx_ids):
+    out = [client.get(f"/pos/transactions/{i}").json() for i in tx_ids]
+    out += [client.get(f"/pos/async/transactions/{i}").json() for i in tx_ids]
+    out.append(client.get("/pos/transactions", params={"user_id": uid, "include_executions": True, "limit": 200}).json())
+    out.append(client.get("/pos/async/transactions", params={"user_id": uid, "include_executions": True, "limit": 200}).json())
+    out.append(client.get("/pos/transactions", params={"user_id": uid, "ids": ",".join(map(str, tx_ids)), "include_executions": True}).json())
+    out.append(client.get("/pos/transactions/export", params={"user_id": uid}).text)
+    out.append(client.get("/pos/transactions/export", params={"user_id": uid, "format": "csv"}).text)
+    return json.dumps(out, sort_keys=True, ensure_ascii=False)
+
+
+def _hot_logs(db, tx_ids):
+    db.expire_all()
+    return db.execute(
+        select(func.count()).select_from(TanabotaActionLog).where(TanabotaActionLog.transaction_id.in_(tx_ids))
+    ).scalar()
+
+
+def test_reads_fall_back_to_archive(client, db, archived_user):
+    uid, old_ids, new_ids, cutoff, _ = archived_user
+    before = _reads(client, uid, old_ids + new_ids)
+    listed = client.get("/pos/transactions", params={"user_id": uid, "include_executions": True}).json()
+    assert len(listed) == len(old_ids) + len(new_ids) and all(tx["executions"] for tx in listed)
+
+    result = archive_action_logs(older_than=cutoff, batch_size=4)
+    assert result["transactions"] >= len(old_ids) and result["batches"] >= 2
+    assert _hot_logs(db, old_ids) == 0
+    assert _hot_logs(db, new_ids) == 2 * len(new_ids)
+    assert db.query(TanabotaActionLogArchive).filter(TanabotaActionLogArchive.transaction_id.in_(old_ids)).count() == len(old_ids)
+
+    assert _reads(client, uid, old_ids + new_ids) == before
+    # 2回目は何も移さない
+    assert archive_action_logs(older_than=cutoff)["transactions"] == 0
+
+
+def test_late_log_is_merged_into_existing_archive_row(db, archived_user):
+    _, old_ids, _, cutoff, rule_id = archived_user
+    archive_action_logs(older_than=cutoff)
+    target = old_ids[0]
+    archived = db.get(TanabotaActionLogArchive, target)
+    count, amount = archived.log_count, int(archived.tanabota_amount)
+
+    # 退避後に届いたログ（write-behind の遅延など）
+    db.add(TanabotaActionLog(
+        transaction_id=target, rule_id=rule_id, action_id=101, action_type="fixed",
+        action_params_json={"amount": 1}, tanabota_amount=1,
+    ))
+    db.commit()
+    archive_action_logs(older_than=cutoff)
+    db.expire_all()
+    merged = db.get(TanabotaActionLogArchive, target)
+    assert (merged.log_count, int(merged.tanabota_amount)) == (count + 1, amount + 1)
+    assert _hot_logs(db, [target]) == 0
+
+
+def test_rollup_rebuild_counts_archived_logs(client, db, archived_user):
+    uid, _, _, cutoff, _ = archived_user
+    before = client.get("/pos/summary", params={"user_id": uid, "granularity": "total"}).json()
+    archive_action_logs(older_than=cutoff)
+    rebuild_savings_rollups(db, [uid])
+    db.commit()
+    assert client.get("/pos/summary", params={"user_id": uid, "granularity": "total"}).json() == before
+    total = db.execute(
+        select(func.sum(TanabotaTransaction.tanabota_total)).where(TanabotaTransaction.user_id == uid)
+    ).scalar()
+    assert before["periods"][0]["tanabota_amount"] == int(total)
@@ -0,0 +1,102 @@
+"""POS決済の Idempotency-Key（routers.pos /pos/execute と services.idempotency）"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import func, select
+
+from models import PosIdempotencyKey, TanabotaTransaction
+from services.idempotency import idempotency_cache, purge_expired_keys, retention_cutoff
+
+
+@pytest.fixture
+def user_id(make_user, add_rule):
+    uid = make_user()
+    add_rule(uid, 3, {}, 101, {"amount": 30})
+    return uid
+
+
+def _transactions(db, user_id: int) -> int:
+    db.expire_all()
+    return db.execute(
+        select(func.count()).select_from(TanabotaTransaction).where(TanabotaTransaction.user_id == user_id)
+    ).scalar()
+
+
+def _pay(client, user_id: int, key: str, amount: int = 800):
+    return client.post("/pos/execute", json={"user_id": user_id, "amount": amount}, headers={"Idempotency-Key": key})
+
+
+def _forget(key: str) -> None:
+    # プロセス内キャッシュだけ消す（別ワーカー・再起動後と同じ状態）
+    with idempotency_cache._lock:
+        idempotency_cache._entries.pop(key, None)
+
+
+def test_retry_replays_first_response(client, db, user_id):
+    key = f"retry-{user_id}"
+    first = _pay(client, user_id, key)
+    assert first.status_code == 200 and "Idempotent-Replayed" not in first.headers
+
+    second = _pay(client, user_id, key)
+    assert second.status_code == 200
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert second.json() == first.json()
+
+    # プロセス内に無くても DB の保存済み応答を返す
+    _forget(key)
+    third = _pay(client, user_id, key)
+    assert third.json() == first.json() and third.headers["Idempotent-Replayed"] == "true"
+    assert _transactions(db, user_id) == 1
+
+
+def test_reused_key_with_different_body_is_rejected(client, db, user_id):
+    key = f"conflict-{user_id}"
+    assert _pay(client, user_id, key, 800).status_code == 200
+    assert _pay(client, user_id, key, 900).status_code == 422
+    assert _transactions(db, user_id) == 1
+
+
+def test_concurrent_retries_execute_once(client, db, user_id):
+    key = f"concurrent-{user_id}"
+    with ThreadPoolExecutor(8) as pool:
+        responses = list(pool.map(lambda _: _pay(client, user_id, key, 1234), range(16)))
+    assert {r.status_code for r in responses} == {200}
+    assert len({r.json()["transaction_id"] for r in responses}) == 1
+    assert _transactions(db, user_id) == 1
+
+
+def test_expired_key_is_processed_as_new_request(client, db, user_id):
+    key = f"expired-{user_id}"
+    first = _pay(client, user_id, key)
+    db.execute(
+        PosIdempotencyKey.__table__.update()
+        .where(PosIdempotencyKey.idempotency_key == key)
+        .values(created_at=retention_cutoff() - timedelta(minutes=1))
+    )
+    db.commit()
+    _forget(key)
+
+    again = _pay(client, user_id, key)
+    assert again.status_code == 200 and "Idempotent-Replayed" not in again.headers
+    assert again.json()["transaction_id"] != first.json()["transaction_id"]
+    # 保存し直した応答が次のリトライで返る
+    assert _pay(client, user_id, key).json() == again.json()
+    assert _transactions(db, user_id) == 2
+
+
+def test_purge_deletes_only_expired_keys(client, db, user_id):
+    old_key, new_key = f"purge-old-{user_id}", f"purge-new-{user_id}"
+    _pay(client, user_id, old_key, 100)
+    _pay(client, user_id, new_key, 200)
+    db.execute(
+        PosIdempotencyKey.__table__.update()
+        .where(PosIdempotencyKey.idempotency_key == old_key)
+        .values(created_at=datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=30))
+    )
+    db.commit()
+
+    assert purge_expired_keys(batch_size=1) >= 1
+    db.expire_all()
+    assert db.get(PosIdempotencyKey, old_key) is None
+    assert db.get(PosIdempotencyKey, new_key) is not None
@@ -0,0 +1,73 @@
+"""入金（POST /pos/income）の記録と、支払い履歴を読む処理からの除外"""
+import json
+
+import pytest
+
+from models import EVENT_KIND_INCOME, EVENT_KIND_PAYMENT, TanabotaTransaction
+from services.cohort_backtest import run_cohort_backtest
+from services.savings_rollup import rebuild_savings_rollups
+from services.simulator import public_recipe_template_ids
+
+
+@pytest.fixture
+def paid_user(client, make_user, add_rule):
+    """決済1件と、給与の入金で発火するルールを持つユーザー"""
+    uid = make_user()
+    add_rule(uid, 3, {}, 101, {"amount": 30})
+    add_rule(uid, 5, {"keyword": "給与"}, 101, {"amount": 500})
+    assert client.post("/pos/execute", json={"user_id": uid, "amount": 1000}).status_code == 200
+    return uid
+
+
+def _receive_salary(client, uid: int) -> int:
+    response = client.post("/pos/income", json={"user_id": uid, "amount": 300000, "description": "給与 10月分"})
+    assert response.status_code == 200 and response.json()["tanabota_total"] == 500
+    return response.json()["transaction_id"]
+
+
+def _payment_counts(client, db, uid: int):
+    template_ids = public_recipe_template_ids(db)
+    simulated = client.get("/onboarding/recipe_templates/simulate", params={"user_id": uid}).json()
+    backtest = run_cohort_backtest(template_ids, user_ids=[uid], workers=1)
+    return (
+        [t["payment_count"] for t in simulated],
+        [(t["payment_count"], t["amount_paid_total"]) for t in backtest["templates"]],
+    )
+
+
+def test_income_is_not_replayed_as_payment(client, db, paid_user):
+    before = _payment_counts(client, db, paid_user)
+    assert before[0] and all(count == 1 for count in before[0])
+
+    tx_id = _receive_salary(client, paid_user)
+    assert db.get(TanabotaTransaction, tx_id).event_kind == EVENT_KIND_INCOME
+    assert _payment_counts(client, db, paid_user) == before
+
+
+def test_income_is_listed_only_when_requested(client, paid_user):
+    tx_id = _receive_salary(client, paid_user)
+
+    for prefix in ("/pos", "/pos/async"):
+        listed = client.get(f"{prefix}/transactions", params={"user_id": paid_user}).json()
+        assert [tx["event_kind"] for tx in listed] == [EVENT_KIND_PAYMENT]
+        everything = client.get(f"{prefix}/transactions", params={"user_id": paid_user, "event_kind": "all"}).json()
+        assert [(tx["id"], tx["event_kind"], tx["amount_paid"]) for tx in everything][0] == (tx_id, EVENT_KIND_INCOME, 0)
+        assert client.get(f"{prefix}/transactions/{tx_id}").json()["event_kind"] == EVENT_KIND_INCOME
+
+    exported = client.get("/pos/transactions/export", params={"user_id": paid_user}).text.splitlines()
+    assert [json.loads(line)["event_kind"] for line in exported] == [EVENT_KIND_PAYMENT]
+    incomes = client.get("/pos/transactions/export", params={"user_id": paid_user, "event_kind": "income"}).text
+    assert [json.loads(line)["id"] for line in incomes.splitlines()] == [tx_id]
+    csv_rows = client.get("/pos/transactions/export", params={"user_id": paid_user, "format": "csv", "event_kind": "all"}).text
+    assert {row.split(",")[2] for row in csv_rows.splitlines()[1:]} == {EVENT_KIND_PAYMENT, EVENT_KIND_INCOME}
+    assert client.get("/pos/transactions", params={"user_id": paid_user, "event_kind": "bad"}).status_code == 422
+
+
+def test_income_savings_are_rolled_up_without_counting_a_transaction(client, db, paid_user):
+    _receive_salary(client, paid_user)
+    total = client.get("/pos/summary", params={"user_id": paid_user, "granularity": "total"}).json()["periods"][0]
+    assert (total["tanabota_amount"], total["transaction_count"]) == (530, 1)
+
+    rebuild_savings_rollups(db, [paid_user])
+    db.commit()
+    assert client.get("/pos/summary", params={"user_id": paid_user, "granularity": "total"}).json()["periods"][0] == total
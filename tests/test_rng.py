@@ -0,0 +1,51 @@
+"""ガチャ・random_range の乱数（services.rng）の決定的モード"""
+import pytest
+
+from services import rng as rng_module
+
+
+@pytest.fixture
+def deterministic(monkeypatch):
+    monkeypatch.setattr(rng_module, "TANABOTA_RNG_SEED", "test-seed")
+
+
+def _random_rules(uid: int, add_rule):
+    for _ in range(5):
+        add_rule(uid, 9, {"trigger_probability": 50}, 107, {"min_amount": 1, "max_amount": 1000})
+
+
+def _draws(response_json):
+    return [(e["rule_id"], e["tanabota_amount"]) for e in response_json["executions"]]
+
+
+def test_same_request_draws_same_numbers(client, make_user, add_rule, deterministic):
+    uid = make_user()
+    _random_rules(uid, add_rule)
+    payment = {"user_id": uid, "amount": 1234}
+
+    explained = [client.post("/pos/explain", json=payment).json() for _ in range(2)]
+    assert _draws(explained[0]) == _draws(explained[1])
+    # 冪等キー無しの /execute はドライランと同じ乱数になる
+    assert _draws(client.post("/pos/execute", json=payment).json()) == _draws(explained[0])
+
+
+def test_request_contents_change_draws(client, make_user, add_rule, deterministic):
+    uid = make_user()
+    _random_rules(uid, add_rule)
+    draws = {
+        tuple(_draws(client.post("/pos/explain", json={"user_id": uid, "amount": amount}).json()))
+        for amount in range(1000, 1010)
+    }
+    assert len(draws) > 1
+
+
+def test_idempotency_key_seeds_generator(deterministic):
+    a = rng_module.request_rng("batch", [1, 2], key="k1")
+    b = rng_module.request_rng("other", key="k1")
+    assert [a.random() for _ in range(3)] == [b.random() for _ in range(3)]
+    assert rng_module.request_rng("x", key="k2").random() != rng_module.request_rng("x", key="k1").random()
+
+
+def test_no_seed_uses_default_generator(monkeypatch):
+    monkeypatch.setattr(rng_module, "TANABOTA_RNG_SEED", None)
+    assert rng_module.request_rng("anything") is None
@@ -0,0 +1,162 @@
+"""レジストリ方式の評価（services.rule_registry）と、導入前の if 連鎖（baseline_evaluator）の差分テスト"""
+import random
+
+import pytest
+
+from models import RuleTemplate
+from services import rule_registry
+from services.rng import use_rng
+from services.rule_registry import EVENT_PAYMENT, InvalidParams, compile_trigger_spec, register_trigger
+from services.tanabota import CompiledRule, RulePlan, compute_amount, evaluate_payment, pick_demo_fallback, trigger_match
+from tests import baseline_evaluator as baseline
+
+AMOUNTS = [0, 1, 99, 100, 101, 499, 500, 501, 700, 701, 999, 1000, 12345]
+CATEGORIES = [None, "", "推し活", "コンビニ", "食費-ランチ", "エンタメ", "無いカテゴリ"]
+
+# シードに無い・壊れたパラメータ
+EDGE_ACTION_PARAMS = [
+    None,
+    {},
+    {"type": "roundup", "to": 100},
+    {"to": 0},
+    {"to": "x"},
+    {"percent": "x"},
+    {"percentage": 0, "level_bonus": -5},
+    {"percentage": 7, "level_bonus": 20},
+    {"growth_multiplier": 1.5},
+    {"growth_multiplier": "x"},
+    {"amount": "a"},
+    {"amount": -10},
+    {"min_amount": 5, "max_amount": 1},
+    {"min_amount": 0, "max_amount": 0},
+    {"base_amount": None},
+    {"base_amount": 700},
+    {"type": "unknown_type", "amount": 100},
+]
+EDGE_TRIGGERS = [
+    ("支出発生", {}),
+    ("支出発生", {"min_amount": 100}),
+    ("支出発生", {"min_amount": "x"}),
+    ("特定カテゴリでの支出", {}),
+    ("特定カテゴリでの支出", {"categories": ["コンビニ", "推し活"]}),
+    ("条件付き支出", {"amount": "500", "operator": "<="}),
+    ("条件付き支出", {"amount": 500, "operator": "!"}),
+    ("条件付き支出", {"amount": 500, "operator": ">", "category": "コンビニ"}),
+    ("条件付き支出", {"amount": None}),
+    ("ガチャタイム（支出発生時ランダム）", {"trigger_probability": 30}),
+    ("ガチャタイム（支出発生時ランダム）", {"trigger_probability": "x"}),
+    ("ガチャタイム（支出発生時ランダム）", {"trigger_probability": 150}),
+    ("推し活同額ミラーリング", {}),
+    ("推し活同額ミラーリング", {"mirror_categories": ["推し活"]}),
+    ("定期実行 (毎週)", {"day_of_week": "friday"}),
+    ("存在しないトリガー", {}),
+]
+
+
+@pytest.fixture
+def templates(db):
+    return db.query(RuleTemplate).all()
+
+
+def _current(fn, seed, *args, **kwargs):
+    # ガチャ・random_range は services.rng の生成器から引く
+    with use_rng(random.Random(seed)):
+        return fn(*args, **kwargs)
+
+
+def _baseline(fn, seed, *args, **kwargs):
+    # 導入前はグローバルの random から引いていた（同じシードなら同じ列）
+    random.seed(seed)
+    return fn(*args, **kwargs)
+
+
+def test_amounts_match_baseline(templates):
+    params_list = [t.action_params for t in templates] + EDGE_ACTION_PARAMS
+    mismatches = [
+        (p, a)
+        for p in params_list
+        for a in AMOUNTS
+        if _current(compute_amount, a, p, a) != _baseline(baseline.compute_amount, a, p, a)
+    ]
+    assert mismatches == []
+
+
+def test_triggers_match_baseline(templates):
+    triggers = [(t.trigger.name, t.trigger_params) for t in templates] + EDGE_TRIGGERS
+    mismatches = [
+        (name, params, a, c)
+        for name, params in triggers
+        for a in AMOUNTS
+        for c in CATEGORIES
+        if _current(trigger_match, a, name, params, a, category=c)
+        != _baseline(baseline.trigger_match, a, name, params, a, category=c)
+    ]
+    assert mismatches == []
+
+
+def test_demo_fallback_matches_baseline(templates):
+    rows = [(t, t.trigger, t.action) for t in templates]
+    # 先頭から順に候補を減らし、各段（無条件・カテゴリ・ガチャ・条件付き）が選ばれる場合を通す
+    for start in range(len(rows)):
+        for a in AMOUNTS:
+            for c in CATEGORIES:
+                picked = pick_demo_fallback(rows[start:], a, c)
+                expected = baseline.pick_demo_fallback(rows[start:], a, c)
+                if expected is None:
+                    assert picked is None
+                    continue
+                assert picked is not None
+                assert (picked[0].id, picked[3], picked[4]) == (expected[0].id, expected[3], expected[4])
+
+
+def test_payment_evaluation_matches_baseline(templates):
+    # シードのテンプレートからユーザーのルール構成を作り、決済1件の評価（通常評価＋デモ用フォールバック）を比べる
+    picker = random.Random(0)
+    mismatches = []
+    for n in range(200):
+        rows = [(t, t.trigger, t.action) for t in picker.sample(templates, picker.randint(1, 6))]
+        plan = RulePlan(0, [CompiledRule(*row) for row in rows])
+        for a in AMOUNTS:
+            for c in CATEGORIES:
+                seed = n * 100003 + a
+                total, executions = _current(evaluate_payment, seed, plan, a, c)
+                current = (total, [
+                    (e["rule_id"], e["action_id"], e["action_type"], e["tanabota_amount"], e["result_json"])
+                    for e in executions
+                ])
+                expected = _baseline(baseline.evaluate_payment, seed, rows, a, c)
+                if current != expected:
+                    mismatches.append(([r[0].id for r in rows], a, c, current, expected))
+    assert mismatches == []
+
+
+def test_registered_trigger_is_compiled_once_and_evaluated():
+    class OddParams:
+        __slots__ = ("step",)
+
+        def __init__(self, step: int):
+            self.step = step
+
+        @classmethod
+        def parse(cls, p):
+            step = int(p.get("step", 0) or 0)
+            if step <= 0:
+                raise InvalidParams("step must be positive")
+            return cls(step)
+
+    @register_trigger(9001, "テスト用トリガー", OddParams, event=EVENT_PAYMENT)
+    def _multiple_of(p, a, category):
+        return a % p.step == 0
+
+    try:
+        spec, params, match = compile_trigger_spec(9001, "テスト用トリガー", {"step": 3})
+        assert spec is not None and params.step == 3
+        assert [a for a in range(10) if match(a, None)] == [0, 3, 6, 9]
+        # パラメータ不正は発火しない
+        _, params, match = compile_trigger_spec(9001, "テスト用トリガー", {"step": 0})
+        assert params is None and not match(3, None)
+        # 名前で引いても同じ定義
+        assert trigger_match("テスト用トリガー", {"step": 5}, 10)
+    finally:
+        rule_registry._TRIGGERS_BY_ID.pop(9001, None)
+        rule_registry._TRIGGERS_BY_NAME.pop("テスト用トリガー", None)
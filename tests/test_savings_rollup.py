@@ -0,0 +1,75 @@
+"""たなぼた額の月次集計（services.savings_rollup と GET /pos/summary）"""
+from sqlalchemy import func, select
+
+from models import TanabotaActionLog, TanabotaTransaction, UserSavingsRollup
+from services.savings_rollup import rebuild_savings_rollups
+
+
+def _pay_with_rules(client, make_user, add_rule):
+    uid = make_user()
+    fixed = add_rule(uid, 3, {}, 101, {"amount": 30})
+    percent = add_rule(uid, 3, {}, 102, {"percentage": 10})
+    for i in range(5):
+        assert client.post("/pos/execute", json={"user_id": uid, "amount": 1000 + i}).status_code == 200
+    assert client.post("/pos/async/execute", json={"user_id": uid, "amount": 500}).status_code == 200
+    batch = client.post("/pos/execute_batch", json={"items": [{"user_id": uid, "amount": 300}] * 3}).json()
+    assert batch["failed"] == 0
+    return uid, fixed, percent
+
+
+def _rollup_rows(db, uid: int):
+    db.expire_all()
+    return sorted(
+        (r.period, r.dimension, r.dimension_key, int(r.tanabota_amount), r.execution_count, r.transaction_count)
+        for r in db.query(UserSavingsRollup).filter(UserSavingsRollup.user_id == uid)
+    )
+
+
+def _log_totals(db, uid: int, *group_by):
+    return {
+        tuple(row[:-2]): (int(row[-2]), row[-1])
+        for row in db.execute(
+            select(*group_by, func.sum(TanabotaActionLog.tanabota_amount), func.count())
+            .join(TanabotaTransaction, TanabotaTransaction.id == TanabotaActionLog.transaction_id)
+            .where(TanabotaTransaction.user_id == uid)
+            .group_by(*group_by)
+        )
+    }
+
+
+def test_summary_matches_action_logs(client, db, make_user, add_rule):
+    uid, fixed, percent = _pay_with_rules(client, make_user, add_rule)
+
+    total = client.get("/pos/summary", params={"user_id": uid, "granularity": "total"}).json()["periods"]
+    monthly = client.get("/pos/summary", params={"user_id": uid}).json()["periods"]
+    assert len(total) == 1 and len(monthly) == 1
+
+    by_rule = _log_totals(db, uid, TanabotaActionLog.rule_id)
+    by_type = _log_totals(db, uid, TanabotaActionLog.action_type)
+    for period in (total[0], monthly[0]):
+        assert period["tanabota_amount"] == sum(amount for amount, _ in by_rule.values())
+        assert period["execution_count"] == sum(count for _, count in by_rule.values())
+        assert period["transaction_count"] == 9
+        assert {i["rule_id"]: (i["tanabota_amount"], i["execution_count"]) for i in period["by_rule"]} == {
+            rule_id: totals for (rule_id,), totals in by_rule.items()
+        }
+        assert {i["action_type"]: (i["tanabota_amount"], i["execution_count"]) for i in period["by_action_type"]} == {
+            action_type: totals for (action_type,), totals in by_type.items()
+        }
+    assert {i["rule_id"] for i in total[0]["by_rule"]} == {fixed.id, percent.id}
+
+
+def test_rebuild_reproduces_incremental_rollups(client, db, make_user, add_rule):
+    uid, _, _ = _pay_with_rules(client, make_user, add_rule)
+    incremental = _rollup_rows(db, uid)
+    assert incremental
+
+    rebuild_savings_rollups(db, [uid])
+    db.commit()
+    assert _rollup_rows(db, uid) == incremental
+
+
+def test_summary_month_filters(client, make_user, add_rule):
+    uid, _, _ = _pay_with_rules(client, make_user, add_rule)
+    assert client.get("/pos/summary", params={"user_id": uid, "from_month": "2999-01"}).json()["periods"] == []
+    assert client.get("/pos/summary", params={"user_id": uid, "from_month": "bad"}).status_code == 422
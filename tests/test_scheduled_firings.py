@@ -0,0 +1,47 @@
+"""時刻トリガーの発火記録（services.scheduler）と、支払い履歴を読む処理からの除外"""
+from datetime import datetime, timedelta, timezone
+
+from models import EVENT_KIND_PAYMENT, EVENT_KIND_SCHEDULE, TanabotaTransaction
+from services.cohort_backtest import run_cohort_backtest
+from services.scheduler import ScheduledTriggerEngine
+from services.simulator import public_recipe_template_ids
+
+
+def _payment_counts(client, db, uid: int):
+    template_ids = public_recipe_template_ids(db)
+    simulated = client.get("/onboarding/recipe_templates/simulate", params={"user_id": uid}).json()
+    backtest = run_cohort_backtest(template_ids, user_ids=[uid], workers=1)
+    return (
+        [t["payment_count"] for t in simulated],
+        [(t["payment_count"], t["amount_paid_total"]) for t in backtest["templates"]],
+    )
+
+
+def test_scheduled_firings_are_not_payments(client, db, make_user, add_rule):
+    uid = make_user()
+    add_rule(uid, 3, {}, 101, {"amount": 30})
+    daily = add_rule(uid, 11, {"hour": 9}, 101, {"amount": 200})
+    assert client.post("/pos/execute", json={"user_id": uid, "amount": 1000}).status_code == 200
+    before = _payment_counts(client, db, uid)
+
+    start = datetime.now(timezone.utc)
+    engine = ScheduledTriggerEngine(enabled=False, clock=lambda: start)
+    assert engine.reload([uid]) == 1
+    # 2日進めると1回分（取り出した分は次回時刻で積み直す）
+    assert engine.run_due(start + timedelta(days=2)) == 1
+    assert engine.recorded == 1
+
+    db.expire_all()
+    firings = db.query(TanabotaTransaction).filter(
+        TanabotaTransaction.user_id == uid, TanabotaTransaction.event_kind == EVENT_KIND_SCHEDULE
+    ).all()
+    assert [(int(tx.amount_paid), int(tx.tanabota_total)) for tx in firings] == [(0, 200)]
+
+    assert _payment_counts(client, db, uid) == before
+    listed = client.get("/pos/transactions", params={"user_id": uid, "include_executions": True}).json()
+    assert [tx["event_kind"] for tx in listed] == [EVENT_KIND_PAYMENT]
+    scheduled = client.get("/pos/transactions", params={"user_id": uid, "event_kind": "schedule", "include_executions": True}).json()
+    assert [(tx["id"], [e["rule_id"] for e in tx["executions"]]) for tx in scheduled] == [(firings[0].id, [daily.id])]
+
+    total = client.get("/pos/summary", params={"user_id": uid, "granularity": "total"}).json()["periods"][0]
+    assert (total["tanabota_amount"], total["transaction_count"]) == (230, 1)
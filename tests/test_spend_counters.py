@@ -0,0 +1,85 @@
+"""支出カウンタ（services.spend_counters）とカウンタで判定するトリガー"""
+from datetime import timedelta
+
+from sqlalchemy import func, select
+
+from models import SPEND_CATEGORY_MAX_LENGTH, TanabotaTransaction, UserSpendCounter
+from services.spend_counters import ALL_CATEGORIES, business_day, period_of
+
+
+def _fired(response_json, rule_id: int) -> bool:
+    return any(e["rule_id"] == rule_id for e in response_json["executions"])
+
+
+def test_counters_match_saved_transactions(client, db, make_user, add_rule):
+    uid = make_user()
+    add_rule(uid, 3, {}, 101, {"amount": 30})
+    for amount, category in [(1000, "コンビニ"), (250, "カフェ"), (400, None)]:
+        assert client.post("/pos/execute", json={"user_id": uid, "amount": amount, "category": category}).status_code == 200
+    batch = client.post("/pos/execute_batch", json={"items": [
+        {"user_id": uid, "amount": 120, "category": "コンビニ"},
+        {"user_id": uid, "amount": 80},
+    ]})
+    assert batch.json()["failed"] == 0
+    assert client.post("/pos/async/execute", json={"user_id": uid, "amount": 60, "category": "カフェ"}).status_code == 200
+
+    counters = client.get("/pos/spend_counters", params={"user_id": uid}).json()
+    db.expire_all()
+    spend, tanabota, count = db.execute(
+        select(
+            func.sum(TanabotaTransaction.amount_paid),
+            func.sum(TanabotaTransaction.tanabota_total),
+            func.count(),
+        ).where(TanabotaTransaction.user_id == uid)
+    ).one()
+    for items in (counters["daily"], counters["cumulative"]):
+        by_category = {i["category"]: i for i in items}
+        assert (by_category[None]["spend_amount"], by_category[None]["tanabota_amount"], by_category[None]["spend_count"]) == (
+            int(spend), int(tanabota), count,
+        )
+        assert (by_category["コンビニ"]["spend_amount"], by_category["コンビニ"]["spend_count"]) == (1120, 2)
+        assert (by_category["カフェ"]["spend_amount"], by_category["カフェ"]["spend_count"]) == (310, 2)
+
+
+def test_level_up_fires_when_cumulative_savings_cross_threshold(client, make_user, add_rule):
+    uid = make_user()
+    add_rule(uid, 3, {}, 101, {"amount": 300})
+    level_up = add_rule(uid, 10, {"threshold_amount": 1000}, 106, {"amount": 5000})
+
+    # 一括処理（同じユーザーが続く）と単発の両方でカウンタを引き継ぐ
+    batch = client.post("/pos/execute_batch", json={"items": [{"user_id": uid, "amount": 100}] * 4}).json()
+    fired = [_fired(r["result"], level_up.id) for r in batch["results"]]
+    for _ in range(3):
+        fired.append(_fired(client.post("/pos/execute", json={"user_id": uid, "amount": 100}).json(), level_up.id))
+
+    # 累計 300, 600, 900, 1200(+5000), 6500, 6800, 7100(+5000)
+    assert fired == [False, False, False, True, False, False, True]
+
+
+def test_zero_day_fires_once_on_first_spend_of_day(client, db, make_user, add_rule):
+    fresh = make_user()
+    zero_day = add_rule(fresh, 8, {"categories": ["コンビニ"]}, 106, {"amount": 150})
+    first = client.post("/pos/execute", json={"user_id": fresh, "amount": 500, "category": "カフェ"}).json()
+    second = client.post("/pos/execute", json={"user_id": fresh, "amount": 500, "category": "カフェ"}).json()
+    assert _fired(first, zero_day.id) and not _fired(second, zero_day.id)
+
+    # 前日に対象カテゴリの支出があれば発火しない
+    spent_yesterday = make_user()
+    other = add_rule(spent_yesterday, 8, {"categories": ["コンビニ"]}, 106, {"amount": 150})
+    yesterday = period_of(business_day() - timedelta(days=1))
+    for category in (ALL_CATEGORIES, "コンビニ"):
+        db.add(UserSpendCounter(
+            user_id=spent_yesterday, period=yesterday, category=category,
+            spend_amount=300, spend_count=1, tanabota_amount=0,
+        ))
+    db.commit()
+    response = client.post("/pos/execute", json={"user_id": spent_yesterday, "amount": 500}).json()
+    assert not _fired(response, other.id)
+
+
+def test_category_longer_than_counter_column_is_rejected(client, make_user):
+    uid = make_user()
+    too_long = "あ" * (SPEND_CATEGORY_MAX_LENGTH + 1)
+    assert client.post("/pos/execute", json={"user_id": uid, "amount": 100, "category": too_long}).status_code == 422
+    fits = "あ" * SPEND_CATEGORY_MAX_LENGTH
+    assert client.post("/pos/execute", json={"user_id": uid, "amount": 100, "category": fits}).status_code == 200